@@ -1,28 +1,286 @@
-from pydicom import dcmread
+import contextlib
 import os
 from typing import Optional
+import logging
 import shutil
-import fdb
-from path_utils import replace_drive_with_folder
+import struct
+import time
+
+import db_connection
+from deduplication import clone_file
+from path_table import PathTable
+from path_utils import image_path_rewriter
+
+# pydicom, tqdm and the de-identification profile (pydicom, PyYAML) are imported in the functions that use them:
+# they take most of the import time, and the database steps and short runs do not need them at all.
+
+# Transfer syntaxes whose dataset is not stored as plain elements (deflate) or is retired and rare (big endian).
+# Such files are processed with a full read and re-serialization.
+FULL_REWRITE_TRANSFER_SYNTAXES = {
+    '1.2.840.10008.1.2.1.99',  # Deflated Explicit VR Little Endian
+    '1.2.840.10008.1.2.2',  # Explicit VR Big Endian
+}
+
+COPY_CHUNK_SIZE = 1024 * 1024
+SNAPSHOT_CHUNK_SIZE = 64 * 1024 * 1024
+
+UPDATED_DATABASE_FILENAME = 'Medical_update.gdb'
+
+# Explicit VR encodings with a 2-byte reserved field and a 4-byte length
+EXPLICIT_VR_LONG_LENGTH = {b'OB', b'OD', b'OF', b'OL', b'OV', b'OW', b'SQ', b'UC', b'UN', b'UR', b'UT'}
+UNDEFINED_LENGTH = 0xFFFFFFFF
+
+
+def _anonymize_dataset(dicom_data):
+    # All rules come from the de-identification profile (deidentification_profile.yaml)
+    from deidentification import apply_profile, get_profile  # noqa: WPS433
+
+    profile = get_profile()
+    apply_profile(dicom_data, profile)
+    if getattr(dicom_data, 'file_meta', None) is not None:
+        apply_profile(dicom_data.file_meta, profile)
+
+
+def _element_end(source_file, offset, is_implicit_vr):
+    """
+    Return the offset right after the little endian data element starting at `offset`.
+
+    Encapsulated (undefined length) pixel data is followed item by item up to the sequence
+    delimiter without reading the fragments. Returns `offset` at the end of the file and None if
+    the element cannot be parsed.
+    """
+    source_file.seek(offset)
+    header = source_file.read(8)
+    if not header:
+        return offset
+    if len(header) < 8:
+        return None
+    if is_implicit_vr:
+        length = struct.unpack('<L', header[4:8])[0]
+        position = offset + 8
+    elif header[4:6] in EXPLICIT_VR_LONG_LENGTH:
+        long_length = source_file.read(4)
+        if len(long_length) < 4:
+            return None
+        length = struct.unpack('<L', long_length)[0]
+        position = offset + 12
+    else:
+        length = struct.unpack('<H', header[6:8])[0]
+        position = offset + 8
+
+    if length != UNDEFINED_LENGTH:
+        return position + length
+
+    while True:
+        source_file.seek(position)
+        item = source_file.read(8)
+        if len(item) < 8:
+            return None
+        group, element, item_length = struct.unpack('<HHL', item)
+        position += 8
+        if (group, element) == (0xFFFE, 0xE0DD):
+            return position
+        if (group, element) != (0xFFFE, 0xE000) or item_length == UNDEFINED_LENGTH:
+            return None
+        position += item_length
+
+
+def _copy_file_tail(source_file, destination_file, offset):
+    """
+    Append everything from `offset` to the end of `source_file` to `destination_file`.
+
+    Uses `os.copy_file_range` (in-kernel copy, no pass through Python memory) when available
+    and falls back to a chunked copy otherwise.
+    """
+    destination_file.flush()
+    copied = 0
+    if hasattr(os, 'copy_file_range'):
+        source_fd = source_file.fileno()
+        destination_fd = destination_file.fileno()
+        os.lseek(source_fd, offset, os.SEEK_SET)
+        try:
+            while True:
+                count = os.copy_file_range(source_fd, destination_fd, COPY_CHUNK_SIZE)
+                if count == 0:
+                    return
+                copied += count
+        except OSError:
+            # Not supported by this kernel or filesystem pair - continue with the chunked copy
+            pass
+
+    source_file.seek(offset + copied)
+    shutil.copyfileobj(source_file, destination_file, COPY_CHUNK_SIZE)
+
+
+def _read_header_for_rewrite(source_file):
+    """
+    Parse the dataset of an open DICOM file up to (7FE0,0010) Pixel Data.
+
+    Returns:
+        Optional[Tuple[Dataset, int]]: The dataset and the offset of the pixel data element, or None if the
+                                       file needs a full rewrite: its transfer syntax is not supported here, or
+                                       there are elements after the pixel data (for example private groups
+                                       above 7FE0), which the profile has to see.
+    """
+    from pydicom import dcmread  # noqa: WPS433
+
+    dicom_data = dcmread(source_file, stop_before_pixels=True)
+    transfer_syntax = getattr(dicom_data.file_meta, 'TransferSyntaxUID', None)
+    if transfer_syntax is None or transfer_syntax in FULL_REWRITE_TRANSFER_SYNTAXES:
+        return None
+    pixel_data_offset = source_file.tell()
+    pixel_data_end = _element_end(source_file, pixel_data_offset, dicom_data.is_implicit_VR)
+    if pixel_data_end != os.fstat(source_file.fileno()).st_size:
+        return None
+    return dicom_data, pixel_data_offset
+
+
+def _anonymize_dicom_header_only(dicom_file_path, output_file_path):
+    """
+    Rewrite the header of a DICOM file and stream the pixel data unchanged.
+
+    The dataset is parsed only up to (7FE0,0010) Pixel Data. The anonymized header is written in the
+    original encoding and the remaining bytes of the source file are copied as is, so memory use does
+    not depend on the size of the frames.
+
+    Returns:
+        bool: False if nothing was written because the file needs a full rewrite (see `_read_header_for_rewrite`).
+    """
+    with open(dicom_file_path, 'rb') as source_file:
+        header = _read_header_for_rewrite(source_file)
+        if header is None:
+            return False
+        dicom_data, pixel_data_offset = header
+
+        _anonymize_dataset(dicom_data)
+
+        # Write to a temporary file next to the output, so that the source can also be the destination
+        temp_path = f'{output_file_path}.{os.getpid()}.tmp'
+        try:
+            with open(temp_path, 'wb') as destination_file:
+                dicom_data.save_as(destination_file, write_like_original=True)
+                _copy_file_tail(source_file, destination_file, pixel_data_offset)
+        except BaseException:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(temp_path)
+            raise
+
+    os.replace(temp_path, output_file_path)
+    return True
 
 
 def anonymize_dicom_file(dicom_file_path, output_file_path):
+    os.makedirs(os.path.dirname(output_file_path), exist_ok=True)
+
+    if _anonymize_dicom_header_only(dicom_file_path, output_file_path):
+        return
+
+    from pydicom import dcmread  # noqa: WPS433
+
     dicom_data = dcmread(dicom_file_path)
+    _anonymize_dataset(dicom_data)
+    # Like the header-only path: the output may be a hardlink shared with other outputs, or the source itself,
+    # so it is replaced by a new file and never truncated, and a crash leaves no partial file under its name
+    temp_path = f'{output_file_path}.{os.getpid()}.tmp'
+    try:
+        dicom_data.save_as(temp_path)
+    except BaseException:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(temp_path)
+        raise
+    os.replace(temp_path, output_file_path)
+
 
-    if 'PatientName' in dicom_data:
-        dicom_data.PatientName = 'Anonymous'
+def _copy_with_progress(source_file, destination_file, progress):
+    """
+    Copy the rest of `source_file` in-kernel with `os.copy_file_range` where possible (server-side
+    copy on NFS/SMB, implicit reflink on XFS), otherwise in chunks through Python.
+
+    Returns:
+        str: The method that copied the data.
+    """
+    method = 'chunked copy'
+    if hasattr(os, 'copy_file_range'):
+        source_fd = source_file.fileno()
+        destination_fd = destination_file.fileno()
+        try:
+            while True:
+                count = os.copy_file_range(source_fd, destination_fd, SNAPSHOT_CHUNK_SIZE)
+                if count == 0:
+                    return 'copy_file_range'
+                progress.update(count)
+        except OSError:
+            # Not supported by this kernel or filesystem pair - continue from the current offsets
+            source_file.seek(os.lseek(source_fd, 0, os.SEEK_CUR))
+            destination_file.seek(os.lseek(destination_fd, 0, os.SEEK_CUR))
+            method = 'copy_file_range + chunked copy' if progress.n else method
 
-    if 'PatientID' in dicom_data:
-        dicom_data.PatientID = '00000000'
+    while True:
+        chunk = source_file.read(SNAPSHOT_CHUNK_SIZE)
+        if not chunk:
+            return method
+        destination_file.write(chunk)
+        progress.update(len(chunk))
 
-    os.makedirs(os.path.dirname(output_file_path), exist_ok=True)
-    dicom_data.save_as(output_file_path)
+
+def copy_database_file(source_path: str, destination_path: str) -> str:
+    """
+    Copy a database file as fast as the filesystem allows.
+
+    A reflink (FICLONE) is tried first: on btrfs, XFS and other copy-on-write filesystems the copy is
+    instant and shares the data blocks until they are changed. Otherwise the file is copied with
+    `os.copy_file_range` or in chunks, with a progress bar. The copy is written to a temporary file
+    and renamed, so an interrupted snapshot never looks complete.
+
+    Returns:
+        str: The method that was used: 'reflink', 'copy_file_range' or 'chunked copy'.
+    """
+    from tqdm import tqdm  # noqa: WPS433
+
+    temp_path = f'{destination_path}.{os.getpid()}.tmp'
+    try:
+        try:
+            clone_file(source_path, temp_path)
+            method = 'reflink'
+        except OSError:
+            with open(source_path, 'rb') as source_file, open(temp_path, 'wb') as destination_file:
+                size = os.fstat(source_file.fileno()).st_size
+                progress = tqdm(total=size, desc='Copying database', unit='B', unit_scale=True, unit_divisor=1024)
+                with progress:
+                    method = _copy_with_progress(source_file, destination_file, progress)
+        shutil.copystat(source_path, temp_path)
+        os.replace(temp_path, destination_path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    return method
+
+
+def snapshot_medical_database(database_path_medical: str, output_dir: str) -> str:
+    """
+    Copy the medical database to `output_dir` as 'Medical_update.gdb' with `copy_database_file`.
+
+    A SQLite stand-in database keeps its own suffix, so that the copy is opened with the same backend.
+
+    Returns:
+        str: The path to the copy.
+    """
+    new_database_filename = UPDATED_DATABASE_FILENAME
+    if db_connection.is_sqlite(database_path_medical):
+        new_database_filename = os.path.splitext(new_database_filename)[0] + os.path.splitext(database_path_medical)[1]
+    new_database_path = os.path.join(output_dir, new_database_filename)
+    # The file must not be attached by pooled connections while it is copied
+    db_connection.close_all(database_path_medical)
+    method = copy_database_file(database_path_medical, new_database_path)
+    print(f"Database snapshot {new_database_path} created ({method})")
+    return new_database_path
 
 
 def anonymize_medical_database(
         database_path_medical: str,
         output_dir: Optional[str] = None,
-        update_paths: bool = True) -> None:
+        update_paths: bool = True) -> int:
     """
     Anonymize a medical database by removing sensitive information and updating image paths.
 
@@ -38,74 +296,123 @@ def anonymize_medical_database(
         update_paths (bool): Whether to update image paths in the database.
 
     Returns:
-        None
+        int: The number of rewritten image paths.
     """
     # Determine the database path to work on
     if output_dir is not None:
-        new_database_path = os.path.join(output_dir, 'Medical_update.gdb')
-        shutil.copyfile(database_path_medical, new_database_path)
+        new_database_path = snapshot_medical_database(database_path_medical, output_dir)
     else:
         new_database_path = database_path_medical
 
     # Connect to the database
-    con_medical = fdb.connect(
-        dsn=new_database_path,
-        user='sysdba',
-        password='masterkey',
-        charset='UTF8',
+    rewritten_paths = 0
+    with db_connection.connection(new_database_path) as con_medical:
+        _drop_patient_data(con_medical)
+
+        if update_paths:
+            rewritten_paths = _rewrite_image_paths(con_medical)
+
+    # Release the file, so that the updated database can be copied or opened by other programs
+    db_connection.close_all(new_database_path)
+    return rewritten_paths
+
+
+def existing_patient_objects(cur_medical, profile):
+    """
+    Return the indices and columns of the profile's patient table that still exist in the database.
+
+    Returns:
+        Tuple[List[str], List[str]]: Names of the remaining indices and columns from the profile.
+    """
+    cur_medical.execute(
+        'SELECT TRIM(rdb$index_name) FROM rdb$indices WHERE rdb$relation_name = ?',
+        (profile.database_table,),
+    )
+    existing_indices = {row[0] for row in cur_medical.fetchall()}
+    cur_medical.execute(
+        'SELECT TRIM(rdb$field_name) FROM rdb$relation_fields WHERE rdb$relation_name = ?',
+        (profile.database_table,),
     )
+    existing_columns = {row[0] for row in cur_medical.fetchall()}
+
+    indices = [index for index in profile.drop_indices if index in existing_indices]
+    columns = [column for column in profile.drop_columns if column in existing_columns]
+    return indices, columns
+
+
+def _drop_patient_data(con_medical):
+    """
+    Drop the patient indices and columns in a single transaction.
+
+    Only objects that still exist are dropped, so a repeated run does not fail. Firebird checks
+    metadata changes on commit, therefore an error rolls back the whole step.
+    """
+    from deidentification import get_profile  # noqa: WPS433
+
+    profile = get_profile()
     cur_medical = con_medical.cursor()
+    indices, columns = existing_patient_objects(cur_medical, profile)
 
-    # Deleting indices
-    indices_to_remove = ['PAT_IDX1', 'PAT_IDX2', 'PAT_IDX3']
-    for index in indices_to_remove:
-        try:
+    try:
+        for index in indices:
             cur_medical.execute(f'DROP INDEX {index}')
-            con_medical.commit()
-        except fdb.DatabaseError as e:
-            print(f"Error dropping index {index}: {e}")
-
-    # Deleting unnecessary columns
-    columns_to_remove = [
-        'PATIENT_NAME',
-        'PATIENT_NAME_R',
-        'PATIENT_CASE_HISTORY_NUMBER',
-        'PATIENT_ADDRESS_REGION',
-        'PATIENT_ADDRESS_AREA',
-        'PATIENT_ADDRESS_CITY',
-        'PATIENT_ADDRESS_SHF',
-        'PATIENT_NAME_STD'
-    ]
-    for column in columns_to_remove:
-        try:
-            cur_medical.execute(f'ALTER TABLE patients DROP {column}')
-            con_medical.commit()
-        except fdb.DatabaseError as e:
-            print(f"Error dropping column {column}: {e}")
+        if columns:
+            # One ALTER TABLE creates one new table format instead of one per column
+            drops = ', '.join(f'DROP {column}' for column in columns)
+            cur_medical.execute(f'ALTER TABLE {profile.database_table} {drops}')
+        con_medical.commit()
+    except db_connection.DatabaseError as e:
+        # The patient data must not silently stay in the copy: the error is raised, the transaction is
+        # rolled back by db_connection.connection and the caller (pipeline stage) fails
+        logging.error(f"Error dropping patient indices {indices} and columns {columns}: {e}")
+        raise
 
-    if update_paths:
-        # Update image paths if they are absolute
-        try:
-            cur_medical.execute("SELECT IMAGE_PATH FROM IMAGES")
-            images = cur_medical.fetchall()
-
-            for image in images:
-                original_image_path = str(image[0])
-                if os.path.isabs(original_image_path):
-                    # If path is absolute, replace drive with 'images' folder
-                    new_image_path = replace_drive_with_folder(original_image_path, 'images')
-                else:
-                    # If path is relative, prepend 'images'
-                    new_image_path = os.path.join('images', original_image_path)
-
-                # Update the database with the new path
-                cur_medical.execute(
-                    "UPDATE IMAGES SET IMAGE_PATH = ? WHERE IMAGE_PATH = ?",
-                    (new_image_path, original_image_path)
-                )
-                con_medical.commit()
-        except fdb.DatabaseError as e:
-            print(f"Error updating image paths: {e}")
-
-    # Close the database connection
-    con_medical.close()
+
+def _rewrite_image_paths(con_medical, batch_size=10000):
+    """
+    Rewrite IMAGE_PATH of all images in a single transaction.
+
+    Rows are addressed by RDB$DB_KEY, which is stable within the transaction and does not need
+    an index, and the updates are sent with `executemany` in batches of `batch_size` rows, so only
+    the keys and a compact PathTable of the current paths are held for the whole table.
+    """
+    cur_medical = con_medical.cursor()
+    started = time.perf_counter()
+    try:
+        cur_medical.execute('SELECT RDB$DB_KEY, IMAGE_PATH FROM IMAGES')
+        # All rows are read before the first UPDATE; the paths are kept in a compact table
+        db_keys = []
+        image_paths = PathTable()
+        rows = cur_medical.fetchmany(batch_size)
+        while rows:
+            for db_key, image_path in rows:
+                db_keys.append(db_key)
+                image_paths.append(str(image_path))
+            rows = cur_medical.fetchmany(batch_size)
+
+        updated = 0
+        updates = []
+        # Absolute paths lose the drive, relative ones are put into 'images'; every directory is translated
+        # once, and the paths keep the separators of the system that wrote them
+        new_image_paths = image_path_rewriter.iter_rewrite_table(image_paths)
+        for index, (original_image_path, new_image_path) in enumerate(zip(image_paths, new_image_paths)):
+            if new_image_path != original_image_path:
+                updates.append((new_image_path, db_keys[index]))
+            if len(updates) >= batch_size:
+                cur_medical.executemany('UPDATE IMAGES SET IMAGE_PATH = ? WHERE RDB$DB_KEY = ?', updates)
+                updated += len(updates)
+                updates = []
+        if updates:
+            cur_medical.executemany('UPDATE IMAGES SET IMAGE_PATH = ? WHERE RDB$DB_KEY = ?', updates)
+            updated += len(updates)
+        con_medical.commit()
+    except db_connection.DatabaseError:
+        # The copy must not keep the original image paths while the run reports success
+        con_medical.rollback()
+        logging.exception("Error updating image paths")
+        raise
+
+    elapsed = time.perf_counter() - started
+    rate = updated / elapsed if elapsed > 0 else float('inf')
+    print(f"Updated {updated} image paths in {elapsed:.1f} s ({rate:.0f} rows/s)")
+    return updated
@@ -3,26 +3,26 @@
 import argparse
 import os
 import sys
-from anonymization_utils import anonymize_dicom_file, anonymize_medical_database
-from tqdm import tqdm
+from anonymization_utils import anonymize_medical_database
+from dicom_discovery import iter_dicom_files
+from parallel_processing import default_workers, iter_anonymize_files
+from processing_manifest import MANIFEST_FILENAME, iter_pending_tasks, open_manifest, record_results
 
 
 def find_dicom_files(directory):
     """
-    Recursively find all .dcm files in the given directory and its subdirectories.
+    Recursively find all DICOM files in the given directory and its subdirectories.
+
+    Files are recognized by the 'DICM' magic bytes, so files without the .dcm extension are found too.
+    The directory tree is scanned in parallel and the paths are produced while the scan is running.
 
     Parameters:
         directory (str): The root directory to start the search.
 
     Returns:
-        list: A list of full paths to .dcm files.
+        Iterator[str]: Full paths to DICOM files, in no particular order.
     """
-    dicom_files = []
-    for root, dirs, files in os.walk(directory):
-        for file in files:
-            if file.lower().endswith('.dcm'):
-                dicom_files.append(os.path.join(root, file))
-    return dicom_files
+    return iter_dicom_files(directory)
 
 
 def main():
@@ -37,22 +37,53 @@ def main():
         'database_path',
         help='Path to the medical database file to anonymize.'
     )
+    parser.add_argument(
+        '--workers',
+        type=int,
+        default=default_workers(),
+        help='Number of worker processes for DICOM anonymization (default: number of CPUs).'
+    )
+    parser.add_argument(
+        '--manifest',
+        help=f'Path to the manifest of processed files (default: {MANIFEST_FILENAME} in the DICOM directory).'
+    )
+    parser.add_argument(
+        '--force',
+        action='store_true',
+        help='Process all files again, even those already recorded in the manifest.'
+    )
     args = parser.parse_args()
 
     dicom_directory = args.dicom_directory
     database_path = args.database_path
 
-    # Anonymize DICOM files
-    dicom_files = find_dicom_files(dicom_directory)
-    if not dicom_files:
+    # Anonymize DICOM files: overwrite the originals as they are discovered,
+    # skipping those already anonymized by a previous run
+    manifest_path = args.manifest or os.path.join(dicom_directory, MANIFEST_FILENAME)
+    manifest = open_manifest(manifest_path)
+    counts = {'processed': 0, 'skipped': 0}
+
+    def count_skipped(source, destination):
+        counts['skipped'] += 1
+
+    tasks = ((dicom_file_path, dicom_file_path) for dicom_file_path in find_dicom_files(dicom_directory))
+    if not args.force:
+        tasks = iter_pending_tasks(manifest, tasks, on_skip=count_skipped)
+
+    results = record_results(manifest, iter_anonymize_files(tasks, workers=args.workers))
+    try:
+        for result in results:
+            counts['processed'] += 1
+            if result.error is not None:
+                print(f"Error anonymizing DICOM file {result.source}: {result.error}", file=sys.stderr)
+    finally:
+        results.close()
+        manifest.close()
+
+    if counts['processed'] == 0 and counts['skipped'] == 0:
         print(f"No DICOM files found in directory: {dicom_directory}")
     else:
-        for dicom_file_path in tqdm(dicom_files, desc="Anonymizing DICOM files", unit="file"):
-            output_file_path = dicom_file_path  # Overwrite the original file
-            try:
-                anonymize_dicom_file(dicom_file_path, output_file_path)
-            except Exception as e:
-                print(f"Error anonymizing DICOM file {dicom_file_path}: {e}", file=sys.stderr)
+        print(f"Anonymized {counts['processed']} DICOM files, skipped {counts['skipped']} already anonymized")
 
     # Anonymize medical database
     try:
@@ -60,6 +91,7 @@ def main():
         print(f"Anonymized medical database: {database_path}")
     except Exception as e:
         print(f"Error anonymizing medical database {database_path}: {e}", file=sys.stderr)
+        sys.exit(1)
 
 
 if __name__ == '__main__':
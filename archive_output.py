@@ -0,0 +1,239 @@
+import glob
+import io
+import os
+import shutil
+import tarfile
+import tempfile
+import time
+import zipfile
+
+# Archive formats of the output: tar, compressed tar or zip (zip64 extensions are used when needed)
+ARCHIVE_FORMATS = ('tar', 'tar.gz', 'tar.zst', 'zip')
+
+DEFAULT_SHARD_SIZE = 4 * 1024 ** 3
+
+# Suffix of a shard that is still being written; it is renamed when complete and can be transferred then
+PARTIAL_SUFFIX = '.partial'
+
+# Tar members larger than this are spooled to a temporary file when read, smaller ones are kept in memory
+READ_SPOOL_SIZE = 16 * 1024 ** 2
+
+# Level of the zstd compression: fast, DICOM pixel data compresses little anyway
+ZSTD_LEVEL = 3
+
+
+def _import_zstandard():
+    try:
+        import zstandard  # noqa: WPS433
+    except ImportError:
+        raise RuntimeError('tar.zst archives require zstandard: pip install zstandard') from None
+    return zstandard
+
+
+def check_archive_format(archive_format):
+    """
+    Raise ValueError for an unknown archive format and RuntimeError if its dependencies are missing.
+    """
+    if archive_format not in ARCHIVE_FORMATS:
+        raise ValueError(f'Unknown archive format: {archive_format}')
+    if archive_format == 'tar.zst':
+        _import_zstandard()
+
+
+class _CountingWriter(io.RawIOBase):
+    """Write-only file object that passes data to `raw` and counts the bytes, for the size of a shard."""
+
+    def __init__(self, raw):
+        super().__init__()
+        self.raw = raw
+        self.written = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        count = self.raw.write(data)
+        self.written += count
+        return count
+
+
+class ShardedArchiveWriter:
+    """
+    Writes files into a series of archives ("shards") of about `shard_size` bytes each.
+
+    Shards are named `<base_name>_00001.<format>` and so on. A shard is written under a name with the
+    `.partial` suffix and renamed when it is complete, so finished shards can be transferred while the
+    next ones are still being written. A member is never split: a shard is closed before a member that
+    would take it over `shard_size`, a single larger member gets a shard of its own.
+
+    Not thread-safe: members are added from one thread, e.g. the one that collects worker results.
+    """
+
+    def __init__(self, output_dir, base_name, archive_format='tar', shard_size=DEFAULT_SHARD_SIZE):
+        check_archive_format(archive_format)
+        self.output_dir = output_dir
+        self.base_name = base_name
+        self.archive_format = archive_format
+        self.shard_size = shard_size
+        self.shards = []
+        self._number = 0
+        self._file = None
+        self._counter = None
+        self._compressor = None
+        self._archive = None
+        self._members = 0
+
+    def _shard_path(self):
+        return os.path.join(self.output_dir, f'{self.base_name}_{self._number:05d}.{self.archive_format}')
+
+    def _open_shard(self):
+        self._number += 1
+        self._file = open(self._shard_path() + PARTIAL_SUFFIX, 'wb')
+        self._counter = _CountingWriter(self._file)
+        self._members = 0
+        if self.archive_format == 'zip':
+            self._archive = zipfile.ZipFile(self._counter, 'w', zipfile.ZIP_STORED, allowZip64=True)
+        elif self.archive_format == 'tar.zst':
+            zstandard = _import_zstandard()
+            self._compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL).stream_writer(self._counter, closefd=False)
+            self._archive = tarfile.open(fileobj=self._compressor, mode='w|')
+        else:
+            mode = 'w|gz' if self.archive_format == 'tar.gz' else 'w|'
+            self._archive = tarfile.open(fileobj=self._counter, mode=mode)
+
+    def _close_shard(self):
+        self._archive.close()
+        if self._compressor is not None:
+            self._compressor.close()
+            self._compressor = None
+        self._file.close()
+        path = self._shard_path()
+        os.replace(path + PARTIAL_SUFFIX, path)
+        self.shards.append(path)
+        self._archive = None
+
+    def _reserve(self, size):
+        if self._archive is not None and self._members and self._counter.written + size > self.shard_size:
+            self._close_shard()
+        if self._archive is None:
+            self._open_shard()
+        self._members += 1
+
+    def add_bytes(self, name, data):
+        """
+        Add a member with the content `data` under the archive path `name` (with '/' separators).
+        """
+        self._reserve(len(data))
+        if self.archive_format == 'zip':
+            info = zipfile.ZipInfo(name, time.localtime()[:6])
+            info.external_attr = 0o644 << 16
+            self._archive.writestr(info, data)
+            return
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        info.mtime = int(time.time())
+        self._archive.addfile(info, io.BytesIO(data))
+
+    def add_file(self, name, path):
+        """
+        Add the file at `path` under the archive path `name`; the content is streamed, not loaded at once.
+        """
+        self._reserve(os.path.getsize(path))
+        if self.archive_format == 'zip':
+            self._archive.write(path, name)
+        else:
+            self._archive.add(path, name, recursive=False)
+
+    def close(self):
+        """
+        Complete the current shard and return the paths of all shards.
+        """
+        if self._archive is not None:
+            self._close_shard()
+        return self.shards
+
+    def abort(self):
+        """
+        Stop writing after an error; the incomplete shard is left with the .partial suffix.
+        """
+        if self._archive is not None:
+            self._file.close()
+            self._archive = None
+            self._compressor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+def _shard_format(path):
+    for archive_format in sorted(ARCHIVE_FORMATS, key=len, reverse=True):
+        if path.endswith('.' + archive_format):
+            return archive_format
+    return None
+
+
+def find_shards(output_dir):
+    """
+    Find the archive shards written to `output_dir`.
+
+    Returns:
+        Tuple[List[str], List[str]]: Sorted paths of the complete shards and of the shards left with the
+        .partial suffix by an interrupted run.
+    """
+    complete, partial = [], []
+    for path in sorted(glob.glob(os.path.join(glob.escape(output_dir), '*_[0-9][0-9][0-9][0-9][0-9].*'))):
+        if path.endswith(PARTIAL_SUFFIX) and _shard_format(path[:-len(PARTIAL_SUFFIX)]) is not None:
+            partial.append(path)
+        elif _shard_format(path) is not None:
+            complete.append(path)
+    return complete, partial
+
+
+def iter_archive_members(path):
+    """
+    Read a shard written by ShardedArchiveWriter member by member, without extracting it.
+
+    Yields:
+        Tuple[str, Optional[BinaryIO]]: The archive path of every member and a seekable file object with its
+        content, valid until the next member is read; None instead of the file object for members that are not
+        regular files (directories are skipped). Tar members are read from a stream (compressed tar cannot be
+        read at random) and copied to a temporary file if they exceed READ_SPOOL_SIZE.
+    """
+    archive_format = _shard_format(path)
+    if archive_format is None:
+        raise ValueError(f'Unknown archive format: {path}')
+    if archive_format == 'zip':
+        with zipfile.ZipFile(path) as archive:
+            for info in archive.infolist():
+                if info.is_dir():
+                    continue
+                with archive.open(info) as member:
+                    yield info.filename, member
+        return
+
+    with open(path, 'rb') as f:
+        reader = None
+        if archive_format == 'tar.zst':
+            reader = _import_zstandard().ZstdDecompressor().stream_reader(f, closefd=False)
+            archive = tarfile.open(fileobj=reader, mode='r|')
+        else:
+            archive = tarfile.open(fileobj=f, mode='r|gz' if archive_format == 'tar.gz' else 'r|')
+        with archive:
+            for info in archive:
+                if info.isdir():
+                    continue
+                if not info.isfile():
+                    yield info.name, None
+                    continue
+                with tempfile.SpooledTemporaryFile(READ_SPOOL_SIZE) as member:
+                    shutil.copyfileobj(archive.extractfile(info), member)
+                    member.seek(0)
+                    yield info.name, member
+        if reader is not None:
+            reader.close()
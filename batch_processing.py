@@ -0,0 +1,324 @@
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import sys
+import threading
+import time
+from collections import Counter, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import yaml
+
+from mkb10_cache import load_mkb10_values
+from parallel_processing import default_workers
+from processing import FETCH_CHUNK_SIZE, OUTPUT_FORMATS, fetch_mkb10_values, logging_setup, run_processing
+from results_writers import RESULT_FILENAMES, check_output_format, combine_results
+
+BatchJob = namedtuple('BatchJob', ['name', 'medical_db', 'mkb10_db', 'image_root', 'workers'])
+
+COMBINED_RESULTS_PREFIX = 'combined_'
+
+# Seconds of the I/O rate a job may get ahead of the budget at once
+IO_BURST_SECONDS = 1.0
+
+
+class WorkerBudget:
+    """
+    Global budget of anonymization worker processes shared by concurrently running jobs.
+
+    A job takes its workers before it starts and returns them when it ends, so the jobs together never
+    run more worker processes (and concurrent file copies) than the budget allows. The rate of the copies
+    is limited separately by IOBudget.
+    """
+
+    def __init__(self, total):
+        self.total = total
+        self._available = total
+        self._condition = threading.Condition()
+
+    def acquire(self, count, cancel_event=None):
+        count = min(count, self.total)
+        with self._condition:
+            while self._available < count:
+                if cancel_event is not None and cancel_event.is_set():
+                    return 0
+                self._condition.wait(timeout=0.5)
+            self._available -= count
+        return count
+
+    def release(self, count):
+        with self._condition:
+            self._available += count
+            self._condition.notify_all()
+
+
+class IOBudget:
+    """
+    Global limit of the image data rate (bytes per second) shared by concurrently running jobs.
+
+    Every job reports the bytes of its finished files. A job ahead of the shared rate waits before it takes
+    the next results, so its worker processes soon have no files left to read and write (the number of
+    submitted files is bounded) until the budget catches up. A job may get IO_BURST_SECONDS ahead.
+    """
+
+    def __init__(self, bytes_per_second):
+        self.bytes_per_second = bytes_per_second
+        self._lock = threading.Lock()
+        # Time at which everything reported so far is paid for at the budget rate
+        self._paid_until = time.monotonic()
+
+    def consume(self, size, cancel_event=None):
+        with self._lock:
+            now = time.monotonic()
+            self._paid_until = max(self._paid_until, now) + size / self.bytes_per_second
+            delay = self._paid_until - now - IO_BURST_SECONDS
+        if delay > 0:
+            if cancel_event is not None:
+                cancel_event.wait(delay)
+            else:
+                time.sleep(delay)
+
+
+def load_batch_manifest(path):
+    """
+    Read the batch manifest (YAML or JSON) and return the settings and the list of jobs.
+
+    Format:
+
+        mkb10_db: /data/MKB10.GDB        # shared MKB10 dictionary, can be overridden per job
+        jobs:
+          - name: clinic_a               # output subdirectory, defaults to the database file name
+            medical_db: /data/a/MEDICAL.GDB
+            image_root: /mnt/a/images    # base of relative image paths, defaults to the database directory
+            workers: 4                   # per-job limit of worker processes
+
+    Relative paths are resolved against the directory of the manifest.
+    """
+    with open(path, encoding='utf-8') as f:
+        manifest = yaml.safe_load(f) or {}
+    base_dir = os.path.dirname(os.path.abspath(path))
+
+    def resolve(value):
+        return os.path.join(base_dir, value) if value else value
+
+    jobs = []
+    names = set()
+    for number, job in enumerate(manifest.get('jobs') or [], 1):
+        if not job.get('medical_db'):
+            raise ValueError(f'Job {number} in {path} has no medical_db')
+        mkb10_db = job.get('mkb10_db') or manifest.get('mkb10_db')
+        if not mkb10_db:
+            raise ValueError(f'Job {number} in {path} has no mkb10_db and there is no shared one')
+        name = str(job.get('name') or os.path.splitext(os.path.basename(job['medical_db']))[0])
+        if name in names:
+            raise ValueError(f'Duplicate job name {name!r} in {path}')
+        names.add(name)
+        jobs.append(BatchJob(
+            name, resolve(job['medical_db']), resolve(mkb10_db), resolve(job.get('image_root')), job.get('workers'),
+        ))
+    return manifest, jobs
+
+
+def _io_throttle(io_budget, cancel_event):
+    # on_progress of run_processing that charges the bytes of the finished files of one job to io_budget
+    reported = 0
+
+    def on_progress(bytes_done=0, **counters):
+        nonlocal reported
+        if bytes_done > reported:
+            io_budget.consume(bytes_done - reported, cancel_event)
+            reported = bytes_done
+
+    return on_progress
+
+
+def _run_job(job, output_dir, budget, io_budget, mkb10_dictionaries, options, cancel_event):
+    job_output_dir = os.path.join(output_dir, job.name)
+    os.makedirs(job_output_dir, exist_ok=True)
+    summary = {'name': job.name, 'medical_db': job.medical_db, 'output_dir': job_output_dir}
+    started = time.perf_counter()
+    workers = budget.acquire(job.workers or options['job_workers'], cancel_event)
+    try:
+        if workers == 0:
+            summary['status'] = 'cancelled'
+            return summary
+        mkb10_values = mkb10_dictionaries[job.mkb10_db]
+        if isinstance(mkb10_values, Exception):
+            raise mkb10_values
+        summary['workers'] = workers
+        logging.info(f"Batch job '{job.name}' started with {workers} workers")
+        report_path = run_processing(
+            job.medical_db, job.mkb10_db, job_output_dir, workers=workers, chunk_size=options['chunk_size'],
+            output_format=options['output_format'], cancel_event=cancel_event, image_root=job.image_root,
+            mkb10_values=mkb10_values, on_progress=_io_throttle(io_budget, cancel_event) if io_budget else None,
+        )
+        with open(report_path, encoding='utf-8') as f:
+            summary['report'] = json.load(f)
+        summary['status'] = summary['report']['status']
+    except Exception as e:
+        # A failing database does not stop the other jobs
+        logging.exception(f"Batch job '{job.name}' failed")
+        summary['status'] = 'failed'
+        summary['error'] = f'{type(e).__name__}: {e}'
+    finally:
+        budget.release(workers)
+        summary['wall_s'] = round(time.perf_counter() - started, 3)
+    return summary
+
+
+def run_batch(jobs, output_dir, max_parallel_jobs=2, total_workers=None, job_workers=None,
+              chunk_size=FETCH_CHUNK_SIZE, output_format='csv', cancel_event=None, io_limit=None):
+    """
+    Process several medical databases concurrently and combine their results.
+
+    Every job runs the full pipeline (`processing.run_processing`) into `output_dir`/<job name>. MKB10
+    dictionaries are loaded once and shared by all jobs that use them. The jobs share a budget of
+    `total_workers` worker processes and, with `io_limit`, a rate of image data; a failing job is recorded
+    in the report and the others go on.
+    At the end the result files of the successful jobs are combined into one file with the database
+    name as an extra column, and a combined report is written to `output_dir`/logs.
+
+    Parameters:
+        jobs (List[BatchJob]): Jobs from `load_batch_manifest`.
+        output_dir (str): Output directory of the batch.
+        max_parallel_jobs (int): Number of databases processed at the same time.
+        total_workers (Optional[int]): Global worker budget. Defaults to the number of CPUs.
+        job_workers (Optional[int]): Workers of a job without its own limit. Defaults to an equal share of
+                                     the budget.
+        chunk_size (int): Rows per fetch from the database.
+        output_format (str): Format of the result files.
+        cancel_event (Optional[threading.Event]): Event to cancel the batch from outside.
+        io_limit (Optional[float]): Global limit of anonymized image data written by all jobs, in bytes per
+                                    second (see IOBudget). Unlimited by default.
+
+    Returns:
+        dict: The combined report.
+    """
+    check_output_format(output_format)
+    cancel_event = cancel_event or threading.Event()
+    total_workers = total_workers or default_workers()
+    budget = WorkerBudget(total_workers)
+    io_budget = IOBudget(io_limit) if io_limit else None
+    options = {
+        'job_workers': job_workers or max(total_workers // max(min(max_parallel_jobs, len(jobs)), 1), 1),
+        'chunk_size': chunk_size,
+        'output_format': output_format,
+    }
+    logs_dir = os.path.join(output_dir, 'logs')
+    os.makedirs(logs_dir, exist_ok=True)
+    started_at = datetime.now()
+    started = time.perf_counter()
+
+    mkb10_dictionaries = {}
+    for mkb10_db in sorted({job.mkb10_db for job in jobs}):
+        try:
+            mkb10_dictionaries[mkb10_db] = load_mkb10_values(mkb10_db, fetch_mkb10_values)
+        except Exception as e:
+            # Only the jobs that use this dictionary fail
+            logging.exception(f'Could not load MKB10 dictionary {mkb10_db}')
+            mkb10_dictionaries[mkb10_db] = e
+
+    with ThreadPoolExecutor(max_workers=max_parallel_jobs, thread_name_prefix='batch-job') as executor:
+        futures = [
+            executor.submit(_run_job, job, output_dir, budget, io_budget, mkb10_dictionaries, options, cancel_event)
+            for job in jobs
+        ]
+        try:
+            summaries = [future.result() for future in futures]
+        except KeyboardInterrupt:
+            cancel_event.set()
+            raise
+
+    succeeded = [summary for summary in summaries if summary['status'] == 'done']
+    combined_path = None
+    if succeeded:
+        result_filename = RESULT_FILENAMES[output_format]
+        combined_path = os.path.join(output_dir, COMBINED_RESULTS_PREFIX + result_filename)
+        parts = [(summary['name'], os.path.join(summary['output_dir'], result_filename)) for summary in succeeded]
+        combine_results(parts, combined_path, output_format)
+
+    counters = Counter()
+    failures = Counter()
+    for summary in summaries:
+        counters.update(summary.get('report', {}).get('counters', {}))
+        failures.update(summary.get('report', {}).get('failures', {}))
+    report = {
+        'started_at': started_at.strftime('%Y-%m-%dT%H:%M:%S'),
+        'wall_s': round(time.perf_counter() - started, 3),
+        'jobs_total': len(summaries),
+        'jobs_done': len(succeeded),
+        'jobs_failed': sum(summary['status'] != 'done' for summary in summaries),
+        'total_workers': total_workers,
+        'io_limit': io_limit,
+        'max_parallel_jobs': max_parallel_jobs,
+        'output_format': output_format,
+        'combined_results': combined_path,
+        'counters': dict(counters),
+        'failures': dict(failures),
+        'jobs': summaries,
+    }
+    report_path = os.path.join(logs_dir, f'batch_report_{started_at.strftime("%d_%m_%Y_%H_%M_%S")}.json')
+    with open(report_path, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    report['report_path'] = report_path
+    return report
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Пакетная обработка нескольких баз Medical (клиник) по манифесту: базы обрабатываются '
+                    'параллельно, результаты объединяются в один файл, общий отчёт пишется в logs.',
+    )
+    parser.add_argument('manifest', help='Манифест заданий (YAML или JSON), см. load_batch_manifest.')
+    parser.add_argument('output_dir', help='Директория для результатов всех баз.')
+    parser.add_argument(
+        '--jobs', type=int, default=2, help='Сколько баз обрабатывать одновременно (по умолчанию 2).',
+    )
+    parser.add_argument(
+        '--workers', type=int, default=default_workers(),
+        help='Общий лимит процессов анонимизации изображений на все базы (по умолчанию - число ядер).',
+    )
+    parser.add_argument(
+        '--job-workers', type=int, default=None,
+        help='Процессов на базу без собственного лимита workers (по умолчанию - равная доля общего лимита).',
+    )
+    parser.add_argument(
+        '--chunk-size', type=int, default=FETCH_CHUNK_SIZE,
+        help=f'Размер порции строк при чтении из базы (по умолчанию {FETCH_CHUNK_SIZE}).',
+    )
+    parser.add_argument('--output-format', choices=OUTPUT_FORMATS, default='csv')
+    parser.add_argument(
+        '--io-limit', type=float, default=None,
+        help='Общий лимит записи изображений на все базы, МБ/с (по умолчанию без ограничения).',
+    )
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    try:
+        _, jobs = load_batch_manifest(args.manifest)
+        check_output_format(args.output_format)
+    except (OSError, ValueError, RuntimeError, yaml.YAMLError) as e:
+        print(f'Ошибка: {e}', file=sys.stderr)
+        return 2
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    logging_setup(args.output_dir)
+    report = run_batch(
+        jobs, args.output_dir, max_parallel_jobs=args.jobs, total_workers=args.workers,
+        job_workers=args.job_workers, chunk_size=args.chunk_size, output_format=args.output_format,
+        io_limit=args.io_limit * 1024 * 1024 if args.io_limit else None,
+    )
+    for summary in report['jobs']:
+        print(f"{summary['name']}: {summary['status']}" + (f" ({summary['error']})" if 'error' in summary else ''))
+    print(f"Обработано баз: {report['jobs_done']} из {report['jobs_total']}. Отчёт: {report['report_path']}")
+    return 0 if report['jobs_failed'] == 0 else 1
+
+
+if __name__ == '__main__':
+    multiprocessing.freeze_support()
+    sys.exit(main())
@@ -0,0 +1,116 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+from run_benchmarks import BENCHMARKS_DIR, git_revision
+
+ROOT_DIR = os.path.dirname(BENCHMARKS_DIR)
+DEFAULT_RESULTS_PATH = os.path.join(BENCHMARKS_DIR, 'import_results.jsonl')
+DEFAULT_MODULES = ['main', 'processing', 'batch_processing', 'watch_mode', 'verification', 'anonymize_copied_database']
+# Команда "пустого" запуска: разбор аргументов без обработки
+NOOP_COMMAND = ['main.py', '--help']
+# Модули, которые не должны загружаться при импорте main (загружаются при первом использовании)
+HEAVY_MODULES = ('pydicom', 'fdb', 'tqdm', 'yaml', 'pyarrow', 'tkinter', 'zstandard')
+
+
+def measure_import(module, repeat):
+    """
+    Import `module` in a fresh interpreter `repeat` times with -X importtime.
+
+    Returns:
+        dict: The best cumulative import time of the module in ms, and the cumulative time in ms of every
+              module it loaded in that run.
+    """
+    best = None
+    for _ in range(repeat):
+        completed = subprocess.run(
+            [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+            cwd=ROOT_DIR, capture_output=True, text=True, check=True,
+        )
+        loaded = {}
+        for line in completed.stderr.splitlines():
+            if not line.startswith('import time:') or 'cumulative' in line:
+                continue
+            _, cumulative, name = line[len('import time:'):].split('|')
+            loaded[name.strip()] = int(cumulative) / 1000
+        if best is None or loaded[module] < best['ms']:
+            best = {'ms': loaded[module], 'loaded': loaded}
+    return best
+
+
+def measure_command(command, repeat):
+    # Лучшее время запуска команды в новом процессе, мс
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        subprocess.run(command, cwd=ROOT_DIR, capture_output=True, check=True)
+        elapsed = (time.perf_counter() - started) * 1000
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Бенчмарк времени запуска: время импорта модулей-точек входа (python -X importtime) и '
+                    'время пустого запуска main.py --help; результаты сохраняются для сравнения между коммитами.',
+    )
+    parser.add_argument('--modules', nargs='+', default=DEFAULT_MODULES, help='Импортируемые модули.')
+    parser.add_argument('--repeat', type=int, default=5, help='Число повторов, берётся лучшее время.')
+    parser.add_argument(
+        '--top', type=int, default=10, help='Сколько самых долгих импортов показать для каждого модуля.',
+    )
+    parser.add_argument(
+        '--command', nargs='+', default=None,
+        help='Команда пустого запуска вместо "python main.py --help", например собранный exe с --help.',
+    )
+    parser.add_argument(
+        '--budget-ms', type=float, default=None,
+        help='Код возврата 1, если пустой запуск дольше стольких миллисекунд (для проверки в CI).',
+    )
+    parser.add_argument('--results', default=DEFAULT_RESULTS_PATH, help='Файл JSON Lines с результатами.')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    commit, dirty = git_revision()
+    command = args.command or [sys.executable] + NOOP_COMMAND
+
+    modules = {}
+    for module in args.modules:
+        measurement = measure_import(module, args.repeat)
+        loaded = measurement['loaded']
+        heavy = sorted(name for name in loaded if name in HEAVY_MODULES)
+        modules[module] = {'ms': measurement['ms'], 'heavy_modules': heavy}
+        print(f"\nimport {module}: {measurement['ms']:.1f} мс" + (f" (загружены {', '.join(heavy)})" if heavy else ''))
+        slowest = sorted((item for item in loaded.items() if item[0] != module), key=lambda item: -item[1])
+        for name, ms in slowest[:args.top]:
+            print(f'  {name:<45} {ms:>8.1f} мс')
+
+    noop_ms = measure_command(command, args.repeat)
+    print(f"\nПустой запуск ({' '.join(command)}): {noop_ms:.1f} мс")
+
+    result = {
+        'commit': commit,
+        'dirty': dirty,
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': sys.version.split()[0],
+        'modules': modules,
+        'noop_command': command,
+        'noop_ms': round(noop_ms, 1),
+    }
+    with open(args.results, 'a', encoding='utf-8') as f:
+        f.write(json.dumps(result, ensure_ascii=False) + '\n')
+    print(f'Результаты добавлены в {args.results}')
+
+    if args.budget_ms is not None and noop_ms > args.budget_ms:
+        print(f'Пустой запуск дольше {args.budget_ms:.0f} мс', file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,180 @@
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import db_connection  # noqa: E402
+from parallel_processing import default_workers  # noqa: E402
+from processing import OUTPUT_FORMATS, run_processing  # noqa: E402
+from synthetic_data import create_stand_in_databases, generate_dicom_corpus  # noqa: E402
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_RESULTS_PATH = os.path.join(BENCHMARKS_DIR, 'results.jsonl')
+DEFAULT_WORK_DIR = os.path.join(BENCHMARKS_DIR, 'work')
+CORPUS_MARKER = 'corpus.json'
+
+
+def git_revision():
+    # Коммит и наличие незакоммиченных изменений, чтобы результаты можно было сравнивать между коммитами
+    try:
+        commit = subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=BENCHMARKS_DIR, capture_output=True, text=True, check=True,
+        ).stdout.strip()
+        dirty = bool(subprocess.run(
+            ['git', 'status', '--porcelain', '--untracked-files=no'], cwd=BENCHMARKS_DIR,
+            capture_output=True, text=True, check=True,
+        ).stdout.strip())
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+    return commit, dirty
+
+
+def prepare_data(scale_dir, scale, args):
+    """
+    Generate the corpus and the stand-in databases for one scale, or reuse them if they were generated
+    with the same parameters. Returns the generation timings (empty when reused).
+    """
+    params = {
+        'images': scale,
+        'files': min(scale, args.max_files) if args.max_files else scale,
+        'rows': args.rows,
+        'columns': args.columns,
+        'images_per_series': args.images_per_series,
+        'series_per_study': args.series_per_study,
+        'seed': args.seed,
+    }
+    marker_path = os.path.join(scale_dir, CORPUS_MARKER)
+    if not args.regenerate and os.path.exists(marker_path):
+        with open(marker_path, encoding='utf-8') as f:
+            if json.load(f) == params:
+                return params, {}
+
+    shutil.rmtree(scale_dir, ignore_errors=True)
+    os.makedirs(scale_dir)
+    timings = {}
+
+    started = time.perf_counter()
+    corpus_bytes = generate_dicom_corpus(
+        scale_dir, params['files'], args.rows, args.columns, args.images_per_series, args.series_per_study,
+    )
+    timings['generate_dicom_s'] = round(time.perf_counter() - started, 3)
+    timings['corpus_bytes'] = corpus_bytes
+
+    started = time.perf_counter()
+    create_stand_in_databases(
+        os.path.join(scale_dir, 'MEDICAL.sqlite'), os.path.join(scale_dir, 'MKB10.sqlite'), scale,
+        args.images_per_series, args.series_per_study, file_count=params['files'], seed=args.seed,
+    )
+    timings['generate_databases_s'] = round(time.perf_counter() - started, 3)
+
+    with open(marker_path, 'w', encoding='utf-8') as f:
+        json.dump(params, f)
+    return params, timings
+
+
+def run_once(scale_dir, output_dir, args):
+    # Один запуск конвейера; отчёт RunMetrics содержит время этапов, счётчики и задержки
+    report_path = run_processing(
+        os.path.join(scale_dir, 'MEDICAL.sqlite'), os.path.join(scale_dir, 'MKB10.sqlite'), output_dir,
+        workers=args.workers, output_format=args.output_format,
+    )
+    db_connection.close_all()
+    with open(report_path, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def load_previous_results(results_path):
+    previous = {}
+    if os.path.exists(results_path):
+        with open(results_path, encoding='utf-8') as f:
+            for line in f:
+                if line.strip():
+                    result = json.loads(line)
+                    previous[json.dumps(result['params'], sort_keys=True)] = result
+    return previous
+
+
+def print_comparison(result, previous):
+    print(f"\nМасштаб {result['params']['images']} изображений ({result['params']['files']} файлов):")
+    stages = result['cold']['stages']
+    previous_stages = previous['cold']['stages'] if previous else {}
+    for name, stage in stages.items():
+        line = f"  {name:<25} {stage['wall_s']:>10.3f} s"
+        if name in previous_stages and previous_stages[name]['wall_s'] > 0:
+            change = stage['wall_s'] / previous_stages[name]['wall_s'] - 1
+            line += f"   {change:+.1%} к {previous['commit']}"
+        print(line)
+    print(f"  {'total (cold)':<25} {result['cold']['wall_s']:>10.3f} s")
+    print(f"  {'total (rerun, manifest)':<25} {result['rerun']['wall_s']:>10.3f} s")
+    latency = result['cold']['latencies'].get('file')
+    if latency:
+        print(f"  file latency p50/p95: {latency['p50_ms']:.2f} / {latency['p95_ms']:.2f} ms")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Синтетический бенчмарк конвейера: генерирует DICOM файлы и SQLite-заменители баз '
+                    'Medical и MKB10, запускает обработку и сохраняет время этапов для сравнения между коммитами.',
+    )
+    parser.add_argument(
+        '--scales', type=int, nargs='+', default=[1000],
+        help='Число изображений (строк IMAGES) для каждого прогона, например 1000 100000 1000000.',
+    )
+    parser.add_argument(
+        '--max-files', type=int, default=None,
+        help='Не больше N различных файлов: строки IMAGES ссылаются на них по кругу (масштаб базы без '
+             'генерации миллиона файлов).',
+    )
+    parser.add_argument('--rows', type=int, default=64, help='Высота изображения в пикселях.')
+    parser.add_argument('--columns', type=int, default=64, help='Ширина изображения в пикселях.')
+    parser.add_argument('--images-per-series', type=int, default=10)
+    parser.add_argument('--series-per-study', type=int, default=2)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workers', type=int, default=default_workers())
+    parser.add_argument('--output-format', choices=OUTPUT_FORMATS, default='csv')
+    parser.add_argument('--work-dir', default=DEFAULT_WORK_DIR, help='Директория для данных и результатов прогонов.')
+    parser.add_argument('--results', default=DEFAULT_RESULTS_PATH, help='Файл JSON Lines с результатами.')
+    parser.add_argument('--regenerate', action='store_true', help='Сгенерировать данные заново.')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    commit, dirty = git_revision()
+    previous_results = load_previous_results(args.results)
+
+    for scale in args.scales:
+        scale_dir = os.path.join(args.work_dir, f'scale_{scale}')
+        params, generation = prepare_data(scale_dir, scale, args)
+        params.update(workers=args.workers, output_format=args.output_format)
+
+        output_dir = os.path.join(scale_dir, 'output')
+        shutil.rmtree(output_dir, ignore_errors=True)
+        os.makedirs(output_dir)
+        cold = run_once(scale_dir, output_dir, args)
+        # Повторный запуск в ту же директорию: изображения пропускаются по манифесту
+        rerun = run_once(scale_dir, output_dir, args)
+
+        result = {
+            'commit': commit,
+            'dirty': dirty,
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'params': params,
+            'generation': generation,
+            'cold': cold,
+            'rerun': rerun,
+        }
+        print_comparison(result, previous_results.get(json.dumps(params, sort_keys=True)))
+        with open(args.results, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(result, ensure_ascii=False) + '\n')
+
+    print(f'\nРезультаты добавлены в {args.results}')
+
+
+if __name__ == '__main__':
+    main()
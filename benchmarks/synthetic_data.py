@@ -0,0 +1,227 @@
+import io
+import os
+import random
+import sqlite3
+import sys
+
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.uid import ExplicitVRLittleEndian
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from deidentification import get_profile  # noqa: E402
+
+# Root of the synthetic UIDs; every UID has a fixed length, so it can be patched into a serialized template
+UID_ROOT = '1.2.826.0.1.3680043.10.543'
+CT_IMAGE_STORAGE = '1.2.840.10008.5.1.4.1.1.2'
+
+FILES_PER_DIRECTORY = 1000
+INSERT_BATCH_SIZE = 10000
+
+# Placeholders of the template, all replaced by values of exactly the same length
+_STUDY_PLACEHOLDER = f'{UID_ROOT}.1.1{0:012d}'
+_SERIES_PLACEHOLDER = f'{UID_ROOT}.2.1{0:012d}'
+_INSTANCE_PLACEHOLDER = f'{UID_ROOT}.3.1{0:012d}'
+_PATIENT_ID_PLACEHOLDER = 'P' + 'X' * 9
+_PATIENT_NAME_PLACEHOLDER = 'Patient^' + 'X' * 9
+
+
+def _uid(kind, number):
+    return f'{UID_ROOT}.{kind}.1{number:012d}'
+
+
+def _dicom_template(rows, columns):
+    """
+    Serialize a CT image with placeholder identifiers and return it split into the header and the pixel data.
+    """
+    meta = FileMetaDataset()
+    meta.MediaStorageSOPClassUID = CT_IMAGE_STORAGE
+    meta.MediaStorageSOPInstanceUID = _INSTANCE_PLACEHOLDER
+    meta.TransferSyntaxUID = ExplicitVRLittleEndian
+
+    dataset = Dataset()
+    dataset.file_meta = meta
+    dataset.is_little_endian = True
+    dataset.is_implicit_VR = False
+    dataset.SOPClassUID = CT_IMAGE_STORAGE
+    dataset.SOPInstanceUID = _INSTANCE_PLACEHOLDER
+    dataset.StudyInstanceUID = _STUDY_PLACEHOLDER
+    dataset.SeriesInstanceUID = _SERIES_PLACEHOLDER
+    dataset.PatientName = _PATIENT_NAME_PLACEHOLDER
+    dataset.PatientID = _PATIENT_ID_PLACEHOLDER
+    dataset.PatientBirthDate = '19700101'
+    dataset.PatientSex = 'O'
+    dataset.StudyDate = '20240101'
+    dataset.StudyTime = '120000'
+    dataset.InstitutionName = 'Synthetic Hospital'
+    dataset.ReferringPhysicianName = 'Doctor^Synthetic'
+    dataset.Modality = 'CT'
+    dataset.Rows = rows
+    dataset.Columns = columns
+    dataset.SamplesPerPixel = 1
+    dataset.PhotometricInterpretation = 'MONOCHROME2'
+    dataset.BitsAllocated = 16
+    dataset.BitsStored = 12
+    dataset.HighBit = 11
+    dataset.PixelRepresentation = 0
+    # Pixel data is not compressed, its content does not matter for the pipeline
+    dataset.PixelData = bytes(range(256)) * (rows * columns * 2 // 256) + bytes(rows * columns * 2 % 256)
+
+    buffer = io.BytesIO()
+    dataset.save_as(buffer, write_like_original=False)
+    content = buffer.getvalue()
+    pixel_data_offset = content.rindex(b'\xe0\x7f\x10\x00')
+    return content[:pixel_data_offset], content[pixel_data_offset:]
+
+
+def image_relative_path(index):
+    return os.path.join('corpus', f'{index // FILES_PER_DIRECTORY:05d}', f'{index:08d}.dcm')
+
+
+def generate_dicom_corpus(directory, count, rows=64, columns=64, images_per_series=10, series_per_study=2):
+    """
+    Write `count` synthetic DICOM files below `directory`/corpus.
+
+    One template is serialized with pydicom and the identifiers are patched into its header, so
+    generation runs at disk speed. Images are grouped into series and studies like in
+    `create_stand_in_databases`, every study belongs to its own patient.
+
+    Parameters:
+        directory (str): Base directory; file paths are `image_relative_path(index)` relative to it.
+        count (int): Number of files.
+        rows (int): Image height in pixels.
+        columns (int): Image width in pixels.
+        images_per_series (int): Number of images in every series.
+        series_per_study (int): Number of series in every study.
+
+    Returns:
+        int: Total size of the written files in bytes.
+    """
+    header, pixel_data = _dicom_template(rows, columns)
+    total_size = 0
+    for index in range(count):
+        series = index // images_per_series
+        study = series // series_per_study
+        file_header = (
+            header
+            .replace(_STUDY_PLACEHOLDER.encode(), _uid(1, study).encode())
+            .replace(_SERIES_PLACEHOLDER.encode(), _uid(2, series).encode())
+            .replace(_INSTANCE_PLACEHOLDER.encode(), _uid(3, index).encode())
+            .replace(_PATIENT_ID_PLACEHOLDER.encode(), f'P{study:09d}'.encode())
+            .replace(_PATIENT_NAME_PLACEHOLDER.encode(), f'Patient^{study:09d}'.encode())
+        )
+        path = os.path.join(directory, image_relative_path(index))
+        if index % FILES_PER_DIRECTORY == 0:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(file_header)
+            f.write(pixel_data)
+        total_size += len(file_header) + len(pixel_data)
+    return total_size
+
+
+def mkb10_values(count=2000):
+    """
+    Return `count` synthetic MKB10 dictionary rows in the 'CODE Description' format of the MKB10 table.
+    """
+    values = []
+    for number in range(count):
+        letter = chr(ord('A') + number // 100 % 26)
+        values.append(f'{letter}{number % 100:02d}.{number // 2600} Synthetic diagnosis {number}')
+    return values
+
+
+def _executemany_in_batches(con, statement, rows):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= INSERT_BATCH_SIZE:
+            con.executemany(statement, batch)
+            batch = []
+    if batch:
+        con.executemany(statement, batch)
+
+
+def create_stand_in_databases(medical_path, mkb10_path, image_count, images_per_series=10, series_per_study=2,
+                              file_count=None, absolute_share=0.5, missing_mkb_share=0.1, seed=0):
+    """
+    Create SQLite stand-ins of MEDICAL.GDB and MKB10.GDB with the tables and columns used by the processing.
+
+    STUDIES, SERIES and IMAGES reference the files of `generate_dicom_corpus`; IMAGE_PATH is relative to the
+    directory of `medical_path` or, for `absolute_share` of the images, absolute. PATIENTS has the columns
+    and indices of the de-identification profile. A `missing_mkb_share` of studies has a code that is not in
+    the dictionary.
+
+    Parameters:
+        medical_path (str): Path of the medical database to create (suffix from db_connection.SQLITE_SUFFIXES).
+        mkb10_path (str): Path of the MKB10 database to create.
+        image_count (int): Number of IMAGES rows.
+        images_per_series (int): Number of images in every series.
+        series_per_study (int): Number of series in every study.
+        file_count (Optional[int]): Number of distinct files; image i refers to file i % file_count.
+                                    Allows database-scale runs with a smaller corpus. Defaults to image_count.
+        absolute_share (float): Share of absolute image paths.
+        missing_mkb_share (float): Share of studies without a valid MKB code.
+        seed (int): Seed of the random choices, for reproducible databases.
+    """
+    rng = random.Random(seed)
+    file_count = file_count or image_count
+    base_dir = os.path.dirname(os.path.abspath(medical_path))
+    profile = get_profile()
+    codes = [value.split(' ')[0] for value in mkb10_values()]
+
+    for path in (medical_path, mkb10_path):
+        if os.path.exists(path):
+            os.remove(path)
+
+    with sqlite3.connect(mkb10_path) as con:
+        con.execute('CREATE TABLE MKB10 (MKB_VALUES VARCHAR(512))')
+        con.executemany('INSERT INTO MKB10 VALUES (?)', [(value,) for value in mkb10_values()])
+    con.close()
+
+    series_count = -(-image_count // images_per_series)
+    study_count = -(-series_count // series_per_study)
+
+    def studies():
+        for study in range(study_count):
+            code = 'Z99.9' if rng.random() < missing_mkb_share else rng.choice(codes)
+            yield _uid(1, study), f'{code} synthetic result', study
+
+    def series():
+        for number in range(series_count):
+            yield _uid(2, number), _uid(1, number // series_per_study)
+
+    def images():
+        for index in range(image_count):
+            path = image_relative_path(index % file_count)
+            if rng.random() < absolute_share:
+                path = os.path.join(base_dir, path)
+            yield _uid(3, index), path, _uid(2, index // images_per_series)
+
+    def patients():
+        for study in range(study_count):
+            yield (study,) + tuple(f'Synthetic {column} {study}' for column in profile.drop_columns)
+
+    with sqlite3.connect(medical_path) as con:
+        con.execute('PRAGMA journal_mode=WAL')
+        con.execute(
+            'CREATE TABLE STUDIES (STUDY_UID VARCHAR(64) PRIMARY KEY, STUDY_RESULT VARCHAR(512), PATIENT_ID INTEGER)',
+        )
+        con.execute('CREATE TABLE SERIES (SERIES_UID VARCHAR(64) PRIMARY KEY, STUDY_UID VARCHAR(64))')
+        con.execute('CREATE TABLE IMAGES (IMAGE_UID VARCHAR(64), IMAGE_PATH VARCHAR(512), SERIES_UID VARCHAR(64))')
+        patient_columns = ', '.join(f'{column} VARCHAR(128)' for column in profile.drop_columns)
+        con.execute(f'CREATE TABLE {profile.database_table} (PATIENT_ID INTEGER PRIMARY KEY, {patient_columns})')
+
+        _executemany_in_batches(con, 'INSERT INTO STUDIES VALUES (?, ?, ?)', studies())
+        _executemany_in_batches(con, 'INSERT INTO SERIES VALUES (?, ?)', series())
+        _executemany_in_batches(con, 'INSERT INTO IMAGES VALUES (?, ?, ?)', images())
+        placeholders = ', '.join('?' * (len(profile.drop_columns) + 1))
+        _executemany_in_batches(con, f'INSERT INTO {profile.database_table} VALUES ({placeholders})', patients())
+
+        # Foreign key indices like in the production database, and the patient indices the profile drops
+        con.execute('CREATE INDEX SERIES_STUDY ON SERIES (STUDY_UID)')
+        con.execute('CREATE INDEX IMAGES_SERIES ON IMAGES (SERIES_UID)')
+        for number, index in enumerate(profile.drop_indices):
+            column = profile.drop_columns[number % len(profile.drop_columns)]
+            con.execute(f'CREATE INDEX {index} ON {profile.database_table} ({column})')
+    con.close()
@@ -0,0 +1,150 @@
+import functools
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+import sqlite_adapter
+
+MAX_IDLE_CONNECTIONS = 4
+
+# Databases with these suffixes are SQLite stand-ins (benchmarks, tests) opened through sqlite_adapter
+SQLITE_SUFFIXES = ('.sqlite', '.sqlite3', '.db')
+
+
+_settings = {
+    'user': os.environ.get('SKVRNGN_DB_USER', 'sysdba'),
+    'password': os.environ.get('SKVRNGN_DB_PASSWORD', 'masterkey'),
+    'charset': os.environ.get('SKVRNGN_DB_CHARSET', 'UTF8'),
+}
+_idle_connections = {}
+_lock = threading.Lock()
+
+
+def _fdb():
+    # fdb is imported on the first Firebird connection: it is slow to import, and runs on SQLite
+    # stand-ins or without any database work (--help, argument errors) do not need it
+    import fdb  # noqa: WPS433
+    return fdb
+
+
+@functools.lru_cache(maxsize=None)
+def _read_only_tpb():
+    # Read-only snapshot: all SELECTs of one stage see the same consistent state of the database
+    fdb = _fdb()
+    return bytes([fdb.isc_tpb_version3, fdb.isc_tpb_read, fdb.isc_tpb_concurrency, fdb.isc_tpb_wait])
+
+
+@functools.lru_cache(maxsize=None)
+def _database_error():
+    try:
+        return (_fdb().DatabaseError, sqlite3.DatabaseError)
+    except ImportError:
+        return (sqlite3.DatabaseError,)
+
+
+def __getattr__(name):
+    # Attributes that need fdb are created on first access (PEP 562):
+    # DatabaseError - errors raised by either backend; catch this instead of fdb.DatabaseError
+    if name == 'DatabaseError':
+        return _database_error()
+    if name == 'READ_ONLY_TPB':
+        return _read_only_tpb()
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+
+def configure(user=None, password=None, charset=None):
+    """
+    Change the credentials and charset used for new connections.
+
+    Defaults come from $SKVRNGN_DB_USER, $SKVRNGN_DB_PASSWORD and $SKVRNGN_DB_CHARSET
+    (sysdba / masterkey / UTF8). Already pooled connections are closed.
+    """
+    for key, value in (('user', user), ('password', password), ('charset', charset)):
+        if value is not None:
+            _settings[key] = value
+    close_all()
+
+
+def is_sqlite(dsn):
+    return dsn.lower().endswith(SQLITE_SUFFIXES)
+
+
+def _acquire(dsn):
+    with _lock:
+        idle = _idle_connections.get(dsn)
+        if idle:
+            return idle.pop()
+    if is_sqlite(dsn):
+        return sqlite_adapter.connect(dsn)
+    return _fdb().connect(dsn=dsn, **_settings)
+
+
+def _release(dsn, con):
+    if con.closed:
+        return
+    with _lock:
+        idle = _idle_connections.setdefault(dsn, [])
+        if len(idle) < MAX_IDLE_CONNECTIONS:
+            idle.append(con)
+            return
+    con.close()
+
+
+@contextmanager
+def connection(dsn, read_only=False):
+    """
+    Take a connection to `dsn` from the pool and return it there afterwards.
+
+    The transaction is committed when the block succeeds and rolled back on an exception.
+    With `read_only` the block runs in a read-only snapshot transaction.
+
+    Parameters:
+        dsn (str): The path (or server:path) of the database. Files with a SQLITE_SUFFIXES suffix are
+                   opened as SQLite stand-in databases with the same interface.
+        read_only (bool): Start a read-only transaction.
+
+    Yields:
+        fdb.Connection: The connection.
+    """
+    con = _acquire(dsn)
+    try:
+        if read_only:
+            con.begin(tpb=None if is_sqlite(dsn) else _read_only_tpb())
+        yield con
+        con.commit()
+    except BaseException:
+        if not con.closed:
+            con.rollback()
+        raise
+    finally:
+        _release(dsn, con)
+
+
+@contextmanager
+def cursor(dsn, read_only=False):
+    """
+    Same as `connection`, but yields a cursor which is closed after the block.
+    """
+    with connection(dsn, read_only) as con:
+        cur = con.cursor()
+        try:
+            yield cur
+        finally:
+            cur.close()
+
+
+def close_all(dsn=None):
+    """
+    Close idle pooled connections to `dsn`, or to all databases if `dsn` is None.
+
+    Needed before a database file is copied, moved or handed over to another program.
+    """
+    with _lock:
+        if dsn is None:
+            connections = [con for idle in _idle_connections.values() for con in idle]
+            _idle_connections.clear()
+        else:
+            connections = _idle_connections.pop(dsn, [])
+    for con in connections:
+        con.close()
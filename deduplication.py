@@ -0,0 +1,221 @@
+import logging
+import os
+import shutil
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+from parallel_processing import FileResult, file_digest
+from processing_manifest import find_output_by_digest, find_unhashed_outputs, has_source_size, set_source_digest
+
+# ioctl FICLONE (linux/fs.h): the new file shares the data extents of the source (btrfs, XFS, ...)
+FICLONE = 0x40049409
+
+
+def clone_file(source, destination):
+    """
+    Create `destination` as a reflink (copy-on-write clone) of `source`.
+
+    Raises:
+        OSError: If the platform or filesystem does not support reflinks.
+    """
+    if fcntl is None:
+        raise OSError('Reflinks are not supported on this platform')
+    with open(source, 'rb') as source_file, open(destination, 'wb') as destination_file:
+        try:
+            fcntl.ioctl(destination_file.fileno(), FICLONE, source_file.fileno())
+        except OSError:
+            destination_file.close()
+            os.remove(destination)
+            raise
+
+
+def link_or_clone(existing_path, new_path):
+    """
+    Replace `new_path` with a hardlink to `existing_path`, or with a reflink if hardlinks are not possible.
+
+    Raises:
+        OSError: If neither a hardlink nor a reflink can be created. `new_path` is left unchanged.
+    """
+    temp_path = f'{new_path}.{os.getpid()}.link'
+    try:
+        os.link(existing_path, temp_path)
+    except OSError:
+        clone_file(existing_path, temp_path)
+    os.replace(temp_path, new_path)
+
+
+def iter_unique_tasks(tasks, on_duplicate=None):
+    """
+    Drop repeated tasks, so that every output file is written once.
+
+    Tasks are compared as (source, destination) pairs: the same source referenced under different paths
+    has several destinations, and each of them is still produced (the repeated ones are usually replaced
+    by links by `ContentDeduplicator`, as their source digests match).
+
+    Parameters:
+        tasks (Iterable[Tuple[str, str]]): Pairs of (source path, destination path).
+        on_duplicate (Optional[Callable[[str, str], None]]): Called for every dropped task.
+
+    Yields:
+        Tuple[str, str]: The first occurrence of every task.
+    """
+    seen = set()
+    for task in tasks:
+        if task in seen:
+            if on_duplicate is not None:
+                on_duplicate(*task)
+            continue
+        seen.add(task)
+        yield task
+
+
+class ContentDeduplicator:
+    """
+    Anonymizes each distinct source content once and links the other outputs of the same content to it.
+
+    Anonymization is deterministic, so identical sources give identical outputs. Files are compared
+    by size first, which is free; only a file whose size matches another source (of this run or, through
+    the manifest, of earlier runs) is hashed, before it is submitted, together with the file it collides
+    with. A task whose digest matches an earlier output is not submitted: its output is linked to that
+    output as soon as it exists.
+
+    `iter_tasks` filters the tasks going into `parallel_processing.iter_anonymize_files` and `iter_results`
+    completes its results with the digests and the linked outputs; both must be used on the same run.
+    Results must then be passed through `processing_manifest.record_results`, which makes the sizes and
+    digests visible to later lookups. Memory use depends only on the files in flight and their duplicates.
+    """
+
+    def __init__(self, con):
+        self.con = con
+        # Submitted, unfinished tasks by source size: {size: {destination: [source, digest or None]}}
+        self._in_flight = {}
+        self._in_flight_sizes = {}
+        # Digests of the submitted, unfinished tasks: {digest: destination}
+        self._in_flight_digests = {}
+        # Duplicates waiting for an unfinished task with their content, by its destination
+        self._waiting = {}
+        # Duplicates whose output can be linked right away: (source, destination, digest, existing output)
+        self._ready = []
+
+    def _hash_in_flight(self, size):
+        for destination, entry in self._in_flight.get(size, {}).items():
+            if entry[1] is None:
+                try:
+                    entry[1] = file_digest(entry[0])
+                except OSError:
+                    continue
+                self._in_flight_digests.setdefault(entry[1], destination)
+
+    def _hash_recorded(self, size):
+        for output_path, source_path, source_size, source_mtime_ns in find_unhashed_outputs(self.con, size):
+            # The digest must describe the source the output was made from: skip sources changed since
+            try:
+                stat = os.stat(source_path)
+                if (stat.st_size, stat.st_mtime_ns) != (source_size, source_mtime_ns):
+                    continue
+                set_source_digest(self.con, output_path, file_digest(source_path))
+            except OSError:
+                continue
+
+    def _submit(self, source, destination, size, digest):
+        self._in_flight.setdefault(size, {})[destination] = [source, digest]
+        self._in_flight_sizes[destination] = size
+        if digest is not None:
+            self._in_flight_digests.setdefault(digest, destination)
+
+    def iter_tasks(self, tasks):
+        """
+        Yield the tasks that have to be anonymized and hold back the content duplicates.
+
+        Parameters:
+            tasks (Iterable[Tuple[str, str]]): Pairs of (source path, destination path).
+
+        Yields:
+            Tuple[str, str]: The tasks to submit.
+        """
+        for source, destination in tasks:
+            try:
+                size = os.path.getsize(source)
+            except OSError:
+                # The worker reports the error
+                yield source, destination
+                continue
+
+            if size not in self._in_flight and not has_source_size(self.con, size):
+                self._submit(source, destination, size, None)
+                yield source, destination
+                continue
+
+            try:
+                digest = file_digest(source)
+            except OSError:
+                yield source, destination
+                continue
+            self._hash_in_flight(size)
+            self._hash_recorded(size)
+
+            in_flight_destination = self._in_flight_digests.get(digest)
+            existing_path = find_output_by_digest(self.con, digest)
+            if in_flight_destination is not None and in_flight_destination != destination:
+                self._waiting.setdefault(in_flight_destination, []).append((source, destination, digest))
+            elif existing_path is not None and existing_path != destination:
+                self._ready.append((source, destination, digest, existing_path))
+            else:
+                self._submit(source, destination, size, digest)
+                yield source, destination
+
+    @staticmethod
+    def _link(source, destination, digest, existing_path):
+        try:
+            os.makedirs(os.path.dirname(destination), exist_ok=True)
+            size = os.path.getsize(existing_path)
+            try:
+                link_or_clone(existing_path, destination)
+            except OSError as e:
+                logging.warning(f'Could not link {destination} to {existing_path}, copied instead: {e}')
+                shutil.copyfile(existing_path, destination)
+                return FileResult(source, destination, None, size, digest)
+        except OSError as e:
+            return FileResult(source, destination, f'{type(e).__name__}: {e}', digest=digest)
+        return FileResult(source, destination, None, size, digest, linked_to=existing_path)
+
+    def _drain_ready(self):
+        while self._ready:
+            yield self._link(*self._ready.pop())
+
+    def iter_results(self, results):
+        """
+        Pass the results of the submitted tasks through, with their source digests, and add a result for
+        every held back duplicate once its output is linked.
+
+        Parameters:
+            results (Iterable[FileResult]): Results of the tasks from `iter_tasks`.
+
+        Yields:
+            FileResult: The results; `linked_to` is set for outputs that are links to another output.
+        """
+        for result in results:
+            yield from self._drain_ready()
+            size = self._in_flight_sizes.pop(result.destination, None)
+            if size is None:
+                yield result
+                continue
+
+            _, digest = self._in_flight[size].pop(result.destination)
+            if not self._in_flight[size]:
+                del self._in_flight[size]
+            if digest is not None and self._in_flight_digests.get(digest) == result.destination:
+                del self._in_flight_digests[digest]
+            result = result._replace(digest=digest)
+            yield result
+
+            for source, destination, duplicate_digest in self._waiting.pop(result.destination, ()):
+                if result.error is None:
+                    yield self._link(source, destination, duplicate_digest, result.destination)
+                else:
+                    # The same content fails the same way
+                    yield FileResult(source, destination, result.error, digest=duplicate_digest)
+        yield from self._drain_ready()
@@ -0,0 +1,233 @@
+import functools
+import hashlib
+import logging
+import os
+import re
+import secrets
+import sys
+from collections import namedtuple
+
+import yaml
+from pydicom.datadict import dictionary_VR, tag_for_keyword
+from pydicom.tag import Tag
+
+PROFILE_ENV = 'SKVRNGN_PROFILE'
+UID_SALT_ENV = 'SKVRNGN_UID_SALT'
+UID_SALT_FILE_ENV = 'SKVRNGN_UID_SALT_FILE'
+DEFAULT_PROFILE_FILENAME = 'deidentification_profile.yaml'
+
+ACTIONS = {'D', 'Z', 'X', 'K', 'U'}
+
+# Dummy values for action D without an explicit value
+DUMMY_VALUES = {
+    'PN': 'Anonymous',
+    'DA': '19000101',
+    'TM': '000000',
+    'DT': '19000101000000',
+    'AS': '000Y',
+    'DS': '0',
+    'IS': '0',
+    'US': 0,
+    'SS': 0,
+    'UL': 0,
+    'SL': 0,
+    'FL': 0.0,
+    'FD': 0.0,
+}
+DEFAULT_DUMMY_VALUE = 'ANONYMOUS'
+
+CompiledProfile = namedtuple(
+    'CompiledProfile',
+    ['actions', 'remove_private_tags', 'uid_salt', 'database_table', 'drop_indices', 'drop_columns'],
+)
+
+_TAG_PATTERN = re.compile(r'\(?\s*([0-9A-Fa-f]{4})\s*,\s*([0-9A-Fa-f]{4})\s*\)?')
+
+
+def default_profile_path():
+    # In the PyInstaller executable data files are unpacked to sys._MEIPASS
+    base_dir = getattr(sys, '_MEIPASS', os.path.dirname(os.path.abspath(__file__)))
+    return os.path.join(base_dir, DEFAULT_PROFILE_FILENAME)
+
+
+def default_uid_salt_path():
+    return os.environ.get(UID_SALT_FILE_ENV) or os.path.join(os.path.expanduser('~'), '.config', 'skvrngn', 'uid_salt')
+
+
+def installation_uid_salt(path=None):
+    """
+    Return the secret UID salt of this installation, generating it on first use.
+
+    Without a secret salt the remapped UIDs are a plain hash of the source UIDs and can be matched
+    against known UIDs. The salt is stored (readable by the owner only) and reused, so repeated exports
+    keep giving the same UIDs; it must be kept and backed up with the results. Concurrent processes
+    agree on one salt: the file is published with a hardlink, which fails if another process was first.
+
+    Parameters:
+        path (Optional[str]): Salt file, by default $SKVRNGN_UID_SALT_FILE or ~/.config/skvrngn/uid_salt.
+
+    Returns:
+        str: The salt.
+    """
+    path = path or default_uid_salt_path()
+    try:
+        with open(path, encoding='ascii') as f:
+            salt = f.read().strip()
+        if salt:
+            return salt
+    except FileNotFoundError:
+        pass
+
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    temp_path = f'{path}.{os.getpid()}.tmp'
+    fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'w', encoding='ascii') as f:
+        f.write(secrets.token_hex(32))
+    try:
+        os.link(temp_path, path)
+        logging.warning(f'Generated a new secret UID salt in {path}; keep this file to get the same UIDs later')
+    except FileExistsError:
+        pass
+    finally:
+        os.remove(temp_path)
+    with open(path, encoding='ascii') as f:
+        salt = f.read().strip()
+    if not salt:
+        raise ValueError(f'UID salt file {path} is empty; delete it or set {UID_SALT_ENV}')
+    return salt
+
+
+def _parse_tag(name):
+    match = _TAG_PATTERN.fullmatch(str(name))
+    if match:
+        return Tag(int(match[1], 16), int(match[2], 16))
+    tag = tag_for_keyword(str(name))
+    if tag is None:
+        raise ValueError(f'Unknown DICOM attribute in de-identification profile: {name}')
+    return Tag(tag)
+
+
+def _dummy_value(tag):
+    try:
+        vr = dictionary_VR(tag)
+    except KeyError:
+        return DEFAULT_DUMMY_VALUE
+    return DUMMY_VALUES.get(vr, DEFAULT_DUMMY_VALUE)
+
+
+def compile_profile(profile):
+    """
+    Turn a profile loaded from YAML into a lookup table from tag to (action, dummy value).
+
+    Parameters:
+        profile (dict): The profile, see deidentification_profile.yaml for the format.
+
+    Returns:
+        CompiledProfile: The compiled profile.
+    """
+    actions = {}
+    for name, rule in (profile.get('dicom') or {}).items():
+        if isinstance(rule, dict):
+            action = rule.get('action')
+            value = rule.get('value')
+        else:
+            action = rule
+            value = None
+        action = str(action).upper()
+        if action not in ACTIONS:
+            raise ValueError(f'Unknown action {action!r} for {name} in de-identification profile')
+        tag = _parse_tag(name)
+        if action == 'D' and value is None:
+            value = _dummy_value(tag)
+        actions[tag] = (action, value)
+
+    database = profile.get('database') or {}
+    return CompiledProfile(
+        actions=actions,
+        remove_private_tags=bool(profile.get('remove_private_tags', True)),
+        uid_salt=os.environ.get(UID_SALT_ENV) or str(profile.get('uid_salt') or '') or installation_uid_salt(),
+        database_table=str(database.get('table', 'PATIENTS')).upper(),
+        drop_indices=[str(index).upper() for index in database.get('drop_indices') or []],
+        drop_columns=[str(column).upper() for column in database.get('drop_columns') or []],
+    )
+
+
+def load_profile(path):
+    with open(path, encoding='utf-8') as f:
+        return compile_profile(yaml.safe_load(f) or {})
+
+
+@functools.lru_cache(maxsize=None)
+def get_profile(path=None):
+    """
+    Return the compiled profile from `path`, $SKVRNGN_PROFILE or the bundled default profile.
+
+    The result is cached, so every (worker) process reads and compiles the profile only once.
+    """
+    return load_profile(path or os.environ.get(PROFILE_ENV) or default_profile_path())
+
+
+def remap_uid(uid, salt):
+    """
+    Derive a new UID from `uid`. The same UID and salt always give the same result, in any process,
+    so references between the files of a study stay consistent.
+
+    The result is a UUID derived UID (2.25.<int>) from a SHA-512 of the salt and the source UID.
+    """
+    digest = hashlib.sha512(f'{salt}\0{uid}'.encode('ascii', 'replace')).digest()
+    return f'2.25.{int.from_bytes(digest[:16], "big")}'
+
+
+def _is_sequence(dataset, tag):
+    vr = dataset.get_item(tag).VR
+    if vr is None:
+        # Raw element of an implicit VR dataset
+        try:
+            vr = dictionary_VR(tag)
+        except KeyError:
+            return False
+    return vr == 'SQ'
+
+
+def apply_profile(dataset, profile):
+    """
+    De-identify `dataset` in place in a single pass over its elements, including nested sequences.
+
+    Elements without a rule are not decoded, so the cost of the pass depends only on the number
+    of elements the profile touches. Group length elements (gggg,0000) outside the file meta
+    information are removed as well, as their values would no longer be correct.
+
+    Parameters:
+        dataset (pydicom.Dataset): The dataset (or file meta information) to change.
+        profile (CompiledProfile): The compiled profile.
+    """
+    for tag in list(dataset.keys()):
+        if (profile.remove_private_tags and tag.is_private) or (tag.element == 0 and tag.group != 2):
+            del dataset[tag]
+            continue
+
+        rule = profile.actions.get(tag)
+        if rule is None or rule[0] == 'K':
+            if _is_sequence(dataset, tag):
+                for item in dataset[tag].value:
+                    apply_profile(item, profile)
+            continue
+
+        action, value = rule
+        if action == 'X':
+            del dataset[tag]
+            continue
+
+        element = dataset[tag]
+        if element.VR == 'SQ':
+            # Dummy and empty values of a sequence are both an empty sequence
+            element.value = []
+        elif action == 'Z':
+            element.value = None
+        elif action == 'D':
+            element.value = value
+        elif action == 'U' and not element.is_empty:
+            if element.VM > 1:
+                element.value = [remap_uid(uid, profile.uid_salt) for uid in element.value]
+            else:
+                element.value = remap_uid(element.value, profile.uid_salt)
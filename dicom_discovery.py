@@ -0,0 +1,107 @@
+import os
+import queue
+import threading
+
+DICOM_MAGIC = b'DICM'
+DICOM_MAGIC_OFFSET = 128
+
+# Directory listing and the magic check are I/O bound, threads overlap them well (also on network shares)
+DISCOVERY_THREADS = 16
+
+# Temporary files of interrupted atomic writes (see anonymization_utils) also start with a DICOM preamble
+SKIPPED_SUFFIXES = ('.tmp', '.link')
+
+_POLL_INTERVAL = 0.2
+_END = object()
+
+
+def is_dicom_file(path):
+    """
+    Check for the 'DICM' prefix after the 128-byte preamble of a DICOM Part 10 file.
+    """
+    try:
+        with open(path, 'rb') as f:
+            header = f.read(DICOM_MAGIC_OFFSET + len(DICOM_MAGIC))
+    except OSError:
+        return False
+    return header[DICOM_MAGIC_OFFSET:] == DICOM_MAGIC
+
+
+def iter_dicom_files(directory, threads=DISCOVERY_THREADS, max_buffered=10000):
+    """
+    Recursively find DICOM files by their content, not by extension, and yield them as they are found.
+
+    Directories are listed with `os.scandir` by a pool of threads, which also check the magic bytes,
+    so the first files are available almost immediately even for very large trees. The order of the
+    files is not defined. Symbolic links to directories are not followed; unreadable directories
+    are skipped, like in `os.walk`.
+
+    Parameters:
+        directory (str): The root directory to start the search.
+        threads (int): Number of scanning threads.
+        max_buffered (int): Number of found files kept in memory before the scanners wait for the consumer.
+
+    Yields:
+        str: Full paths of DICOM files.
+    """
+    directories = queue.Queue()
+    found = queue.Queue(maxsize=max_buffered)
+    stop = threading.Event()
+    lock = threading.Lock()
+    pending_directories = [1]
+
+    def put_found(item):
+        while not stop.is_set():
+            try:
+                found.put(item, timeout=_POLL_INTERVAL)
+                return
+            except queue.Full:
+                continue
+
+    def scan_directory(path):
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if stop.is_set():
+                    return
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        with lock:
+                            pending_directories[0] += 1
+                        directories.put(entry.path)
+                    elif (entry.is_file()
+                            and not entry.name.endswith(SKIPPED_SUFFIXES)
+                            and is_dicom_file(entry.path)):
+                        put_found(entry.path)
+                except OSError:
+                    continue
+
+    def scanner():
+        while True:
+            path = directories.get()
+            if path is _END:
+                return
+            try:
+                scan_directory(path)
+            except OSError:
+                pass
+            finally:
+                with lock:
+                    pending_directories[0] -= 1
+                    finished = pending_directories[0] == 0
+                if finished:
+                    put_found(_END)
+
+    directories.put(directory)
+    workers = [threading.Thread(target=scanner, name='dicom-discovery', daemon=True) for _ in range(threads)]
+    for worker in workers:
+        worker.start()
+    try:
+        while True:
+            path = found.get()
+            if path is _END:
+                return
+            yield path
+    finally:
+        stop.set()
+        for _ in workers:
+            directories.put(_END)
@@ -0,0 +1,196 @@
+import logging
+import os
+import queue
+import threading
+import time
+import tkinter as tk
+from tkinter import filedialog, messagebox, ttk
+
+from check_health import validate_system
+from processing import logging_setup, run_processing
+
+# Период опроса очереди прогресса окном, мс
+PROGRESS_POLL_MS = 200
+
+
+def browse_file(entry):
+    file_path = filedialog.askopenfilename()
+    if file_path:
+        entry.delete(0, tk.END)
+        entry.insert(0, file_path)
+
+
+def browse_directory(entry):
+    dir_path = filedialog.askdirectory()
+    if dir_path:
+        entry.delete(0, tk.END)
+        entry.insert(0, dir_path)
+
+
+def _processing_worker(medical_db_path, mkb10_db_path, output_dir, workers, cancel_event, progress_queue):
+    # Выполняется в фоновом потоке; с окном общается только через progress_queue
+    try:
+        validate_system()  # Info about sys
+        os.makedirs(output_dir, exist_ok=True)
+        logging_setup(output_dir)
+        run_processing(
+            medical_db_path, mkb10_db_path, output_dir, workers=workers, cancel_event=cancel_event,
+            on_progress=lambda **counters: progress_queue.put(('progress', counters)),
+        )
+    except Exception as e:
+        logging.exception(e)
+        progress_queue.put(('error', e))
+    else:
+        progress_queue.put(('cancelled' if cancel_event.is_set() else 'done', None))
+
+
+def _format_eta(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f'{hours}:{minutes:02d}:{seconds:02d}'
+
+
+def update_progress_view(state):
+    elapsed = max(time.monotonic() - state['started'], 1e-6)
+    done = state.get('files_done', 0)
+    finished = done + state.get('files_skipped', 0) + state.get('files_duplicate', 0)
+    total = state.get('files_total')
+    files_rate = done / elapsed
+    mb_rate = state.get('bytes_done', 0) / elapsed / (1024 * 1024)
+
+    text = (
+        f"Обработано: {finished}{f' из {total}' if total else ''}, ошибок: {state.get('files_failed', 0)} | "
+        f"{files_rate:.1f} файл/с, {mb_rate:.1f} МБ/с"
+    )
+    if total:
+        progress_bar['value'] = min(100.0, 100.0 * finished / total)
+        if files_rate > 0:
+            text += f' | осталось ~{_format_eta(max(total - finished, 0) / files_rate)}'
+    status_var.set(text)
+
+
+def poll_progress():
+    # Опрос очереди прогресса из главного потока Tk
+    while True:
+        try:
+            kind, value = progress_queue.get_nowait()
+        except queue.Empty:
+            break
+        if kind == 'progress':
+            processing_state.update(value)
+            continue
+
+        processing_state.clear()
+        start_button.config(state=tk.NORMAL)
+        cancel_button.config(state=tk.DISABLED)
+        if kind == 'done':
+            progress_bar['value'] = 100
+            messagebox.showinfo("Успех", "Обработка данных завершена. Проверьте журнал для получения деталей.")
+        elif kind == 'cancelled':
+            status_var.set("Обработка отменена. Повторный запуск продолжит с места остановки.")
+        else:
+            messagebox.showerror("Ошибка", f"Обработка прервана: {value}")
+        return
+
+    if processing_state:
+        update_progress_view(processing_state)
+    root.after(PROGRESS_POLL_MS, poll_progress)
+
+
+def start_processing():
+    medical_db_path = entry_medical_db.get()
+    mkb10_db_path = entry_mkb10_db.get()
+    output_dir = entry_output_dir.get()
+
+    if not os.path.exists(medical_db_path) or not os.path.exists(mkb10_db_path):
+        messagebox.showerror("Ошибка", "Указанные пути к файлам не существуют.")
+        return
+
+    if not os.path.isdir(output_dir):
+        messagebox.showerror("Ошибка", "Указанный путь для сохранения результатов не является директорией.")
+        return
+
+    # Запуск обработки в фоновом потоке, чтобы окно не зависало
+    cancel_event.clear()
+    processing_state.clear()
+    processing_state['started'] = time.monotonic()
+    progress_bar['value'] = 0
+    status_var.set("Обработка...")
+    start_button.config(state=tk.DISABLED)
+    cancel_button.config(state=tk.NORMAL)
+    threading.Thread(
+        target=_processing_worker,
+        args=(medical_db_path, mkb10_db_path, output_dir, worker_count, cancel_event, progress_queue),
+        name='processing',
+        daemon=True,
+    ).start()
+    root.after(PROGRESS_POLL_MS, poll_progress)
+
+
+def close_window():
+    # Закрытие окна во время обработки: сначала отменяем и дожидаемся остановки этапов
+    if start_button['state'] == tk.DISABLED:
+        if not cancel_event.is_set():
+            cancel_processing()
+        root.after(PROGRESS_POLL_MS, close_window)
+        return
+    root.destroy()
+
+
+def cancel_processing():
+    # Этапы завершают начатые файлы и останавливаются; манифест позволит продолжить позже
+    cancel_event.set()
+    cancel_button.config(state=tk.DISABLED)
+    status_var.set("Отмена: завершаются уже начатые файлы...")
+
+
+def run_gui(medical_db_path='', mkb10_db_path='', output_dir='', workers=None):
+    # Окно и его состояние - глобальные переменные модуля, их используют обработчики выше
+    global root, entry_medical_db, entry_mkb10_db, entry_output_dir, start_button, cancel_button
+    global progress_bar, status_var, progress_queue, processing_state, cancel_event, worker_count
+
+    worker_count = workers
+
+    progress_queue = queue.Queue()
+    processing_state = {}
+    cancel_event = threading.Event()
+
+    root = tk.Tk()
+    root.title("Обработка медицинских данных")
+
+    # Поля для ввода путей с предзаполненными значениями
+
+    tk.Label(root, text="Путь к базе данных Medical:").grid(row=0, column=0, padx=5, pady=5)
+    entry_medical_db = tk.Entry(root, width=50)
+    entry_medical_db.insert(0, medical_db_path)
+    entry_medical_db.grid(row=0, column=1, padx=5, pady=5)
+    tk.Button(root, text="Обзор", command=lambda: browse_file(entry_medical_db)).grid(row=0, column=2, padx=5, pady=5)
+
+    tk.Label(root, text="Путь к базе данных MKB10:").grid(row=1, column=0, padx=5, pady=5)
+    entry_mkb10_db = tk.Entry(root, width=50)
+    entry_mkb10_db.insert(0, mkb10_db_path)
+    entry_mkb10_db.grid(row=1, column=1, padx=5, pady=5)
+    tk.Button(root, text="Обзор", command=lambda: browse_file(entry_mkb10_db)).grid(row=1, column=2, padx=5, pady=5)
+
+    tk.Label(root, text="Директория для сохранения результатов:").grid(row=2, column=0, padx=5, pady=5)
+    entry_output_dir = tk.Entry(root, width=50)
+    entry_output_dir.insert(0, output_dir)
+    entry_output_dir.grid(row=2, column=1, padx=5, pady=5)
+    tk.Button(root, text="Обзор", command=lambda: browse_directory(entry_output_dir)).grid(
+        row=2, column=2, padx=5, pady=5,
+    )
+
+    # Кнопки для запуска и отмены обработки
+    start_button = tk.Button(root, text="Запуск", command=start_processing)
+    start_button.grid(row=3, column=1, pady=20)
+    cancel_button = tk.Button(root, text="Отмена", command=cancel_processing, state=tk.DISABLED)
+    cancel_button.grid(row=3, column=2, pady=20)
+
+    # Прогресс: доля файлов, скорость и оставшееся время
+    progress_bar = ttk.Progressbar(root, length=400, mode='determinate', maximum=100)
+    progress_bar.grid(row=4, column=0, columnspan=3, padx=5, pady=5)
+    status_var = tk.StringVar(value="")
+    tk.Label(root, textvariable=status_var).grid(row=5, column=0, columnspan=3, padx=5, pady=5)
+
+    root.protocol("WM_DELETE_WINDOW", close_window)
+    root.mainloop()
@@ -0,0 +1,95 @@
+import hashlib
+import logging
+import os
+import pickle
+
+import db_connection
+
+CACHE_DIR_ENV = 'SKVRNGN_CACHE_DIR'
+CACHE_FORMAT_VERSION = 1
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def default_cache_dir():
+    return os.environ.get(CACHE_DIR_ENV) or os.path.join(os.path.expanduser('~'), '.cache', 'skvrngn')
+
+
+def _content_hash(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _cache_path(database_path, cache_dir):
+    key = hashlib.sha1(os.path.abspath(database_path).encode('utf-8')).hexdigest()
+    return os.path.join(cache_dir, f'mkb10_{key}.pickle')
+
+
+def _read_cache(cache_path):
+    try:
+        with open(cache_path, 'rb') as f:
+            cache = pickle.load(f)
+    except (OSError, pickle.UnpicklingError, EOFError):
+        return None
+    if not isinstance(cache, dict) or cache.get('version') != CACHE_FORMAT_VERSION:
+        return None
+    return cache
+
+
+def _write_cache(cache_path, cache):
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    temp_path = f'{cache_path}.{os.getpid()}.tmp'
+    with open(temp_path, 'wb') as f:
+        pickle.dump(cache, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(temp_path, cache_path)
+
+
+def load_mkb10_values(database_path_mkb10, fetch, cache_dir=None):
+    """
+    Return the MKB10 dictionary from the local cache, querying the database only when it changed.
+
+    The cache is keyed by the absolute database path and stores its size, mtime and SHA-256.
+    If size and mtime match, the cache is used as is. Otherwise the file is hashed, and only a
+    different hash leads to a new query. After a query the fingerprint is taken again once the
+    connection is released, because attaching to a Firebird database rewrites its header page.
+
+    Parameters:
+        database_path_mkb10 (str): The path to the MKB10 database file.
+        fetch (Callable[[str], dict]): Function that reads the dictionary from the database.
+        cache_dir (Optional[str]): Cache directory. Defaults to $SKVRNGN_CACHE_DIR or ~/.cache/skvrngn.
+
+    Returns:
+        dict: MKB code to full MKB value.
+    """
+    cache_path = _cache_path(database_path_mkb10, cache_dir or default_cache_dir())
+    stat = os.stat(database_path_mkb10)
+    cache = _read_cache(cache_path)
+
+    if cache is not None and (cache['size'], cache['mtime_ns']) == (stat.st_size, stat.st_mtime_ns):
+        logging.info(f'MKB10 values loaded from cache {cache_path}')
+        return cache['values']
+
+    if cache is not None and cache['sha256'] == _content_hash(database_path_mkb10):
+        values = cache['values']
+        content_hash = cache['sha256']
+        logging.info(f'MKB10 values loaded from cache {cache_path} (database touched, content unchanged)')
+    else:
+        values = fetch(database_path_mkb10)
+        db_connection.close_all(database_path_mkb10)
+        stat = os.stat(database_path_mkb10)
+        content_hash = _content_hash(database_path_mkb10)
+        logging.info(f'MKB10 values read from {database_path_mkb10} and cached to {cache_path}')
+
+    try:
+        _write_cache(cache_path, {
+            'version': CACHE_FORMAT_VERSION,
+            'size': stat.st_size,
+            'mtime_ns': stat.st_mtime_ns,
+            'sha256': content_hash,
+            'values': values,
+        })
+    except OSError as e:
+        logging.warning(f'Could not write MKB10 cache {cache_path}: {e}')
+    return values
@@ -0,0 +1,127 @@
+import hashlib
+import multiprocessing
+import os
+import time
+from collections import namedtuple
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+FileResult = namedtuple(
+    'FileResult', ['source', 'destination', 'error', 'size', 'digest', 'linked_to', 'elapsed'],
+    defaults=(0, None, None, None),
+)
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+# Modules imported once by the fork server, so that every worker starts with them loaded
+WORKER_PRELOAD_MODULES = ['anonymization_utils', 'deidentification', 'pydicom']
+
+
+def default_workers():
+    return os.cpu_count() or 1
+
+
+def process_pool(max_workers):
+    """
+    Create a process pool whose workers are safe to start while other threads are running.
+
+    A plain fork copies the process at an arbitrary moment: an import in progress in another thread (the
+    pipeline stages import their dependencies lazily) stays locked forever in the child, which then hangs
+    on its first import of that module. Where available, workers are forked from a single-threaded fork
+    server instead, which has imported WORKER_PRELOAD_MODULES once. On Windows the pool spawns anyway.
+    """
+    if 'forkserver' not in multiprocessing.get_all_start_methods():
+        return ProcessPoolExecutor(max_workers=max_workers)
+    context = multiprocessing.get_context('forkserver')
+    context.set_forkserver_preload(WORKER_PRELOAD_MODULES)
+    return ProcessPoolExecutor(max_workers=max_workers, mp_context=context)
+
+
+def file_digest(path):
+    digest = hashlib.blake2b(digest_size=20)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _anonymize_task(source, destination):
+    # Исключения из дочернего процесса не всегда сериализуются, поэтому возвращаем текст ошибки.
+    # elapsed - время обработки файла в рабочем процессе, без ожидания в очереди пула.
+    from anonymization_utils import anonymize_dicom_file  # noqa: WPS433
+
+    started = time.perf_counter()
+    try:
+        anonymize_dicom_file(source, destination)
+    except Exception as e:
+        return FileResult(source, destination, f'{type(e).__name__}: {e}', elapsed=time.perf_counter() - started)
+    return FileResult(
+        source, destination, None, os.path.getsize(destination), elapsed=time.perf_counter() - started,
+    )
+
+
+def iter_anonymize_files(tasks, workers=None, max_in_flight=None, total=None, desc='Anonymizing DICOM files'):
+    """
+    Anonymize DICOM files in a process pool and yield a result for every file as soon as it is done.
+
+    At most `max_in_flight` files are submitted to the pool at any moment, so `tasks` may be a lazy
+    generator over an arbitrarily large archive.
+
+    Parameters:
+        tasks (Iterable[Tuple[str, str]]): Pairs of (source path, destination path).
+        workers (Optional[int]): Number of worker processes. Defaults to the number of CPUs.
+                                 With 1 worker the files are processed in the current process.
+        max_in_flight (Optional[int]): Upper bound of submitted but unfinished files.
+                                       Defaults to four times the number of workers.
+        total (Optional[int]): Number of tasks for the progress bar. Taken from `len(tasks)` if available.
+        desc (str): Progress bar description.
+
+    Yields:
+        FileResult: Source, destination, error message (None on success), output size and processing time
+                    in seconds of each processed file; the source digest is left empty.
+    """
+    from tqdm import tqdm  # noqa: WPS433
+
+    workers = workers or default_workers()
+    max_in_flight = max_in_flight or workers * 4
+    if total is None and hasattr(tasks, '__len__'):
+        total = len(tasks)
+
+    with tqdm(total=total, desc=desc, unit='file') as progress:
+        if workers == 1:
+            for source, destination in tasks:
+                result = _anonymize_task(source, destination)
+                progress.update(1)
+                yield result
+            return
+
+        executor = process_pool(workers)
+        try:
+            pending = set()
+            for source, destination in tasks:
+                if len(pending) >= max_in_flight:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        progress.update(1)
+                        yield future.result()
+                pending.add(executor.submit(_anonymize_task, source, destination))
+
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    progress.update(1)
+                    yield future.result()
+        finally:
+            # При прерывании (Ctrl-C, ошибка) не ждём файлы, которые ещё не начали обрабатываться
+            executor.shutdown(wait=True, cancel_futures=True)
+
+
+def anonymize_files(tasks, workers=None, max_in_flight=None, total=None, desc='Anonymizing DICOM files'):
+    """
+    Anonymize DICOM files in a process pool and collect the per-file results.
+
+    Parameters are the same as for `iter_anonymize_files`.
+
+    Returns:
+        list: A FileResult for every task, in completion order.
+    """
+    return list(iter_anonymize_files(tasks, workers, max_in_flight, total, desc))
@@ -0,0 +1,161 @@
+from array import array
+from collections.abc import Sequence
+
+# Both separators are recognized: the database may contain Windows paths also when processed on Linux
+_SEPARATORS = ('/', '\\')
+
+
+def split_directory(path):
+    """
+    Split `path` after its last separator into the directory prefix (with the separator) and the name.
+    """
+    position = max(path.rfind(separator) for separator in _SEPARATORS) + 1
+    return path[:position], path[position:]
+
+
+class StudyPaths(Sequence):
+    """Read-only view of the image paths of one study in a PathTable; paths are decoded on access."""
+
+    def __init__(self, table, start, stop):
+        self._table = table
+        self._start = start
+        self._stop = stop
+
+    def __len__(self):
+        return self._stop - self._start
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[position] for position in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('study path index out of range')
+        return self._table.path(self._start + index)
+
+    def __iter__(self):
+        return self._table.iter_paths(self._start, self._stop)
+
+    def __repr__(self):
+        return repr(list(self))
+
+
+class PathTable:
+    """
+    Compact in-memory inventory of image paths, optionally grouped by study.
+
+    Every path is stored as the id of its interned directory prefix and its file name; names are kept
+    in one UTF-8 buffer with array offsets, so millions of paths cost a few dozen bytes each instead
+    of one Python string (and list slot) per path. Studies get integer ids and own a contiguous range
+    of paths, so the table also works as a read-only mapping from study UID to its paths.
+
+    Paths are decoded on access, consumers iterate them without the table keeping string copies.
+    """
+
+    def __init__(self):
+        self._prefixes = []
+        self._prefix_ids = {}
+        self._path_prefixes = array('I')
+        self._name_offsets = array('Q', [0])
+        self._names = bytearray()
+        self._study_uids = []
+        self._study_ids = {}
+        self._study_bounds = array('Q')
+
+    def append(self, path):
+        """
+        Add a path (not assigned to a study) and return its index.
+        """
+        prefix, name = split_directory(path)
+        prefix_id = self._prefix_ids.get(prefix)
+        if prefix_id is None:
+            prefix_id = len(self._prefixes)
+            self._prefixes.append(prefix)
+            self._prefix_ids[prefix] = prefix_id
+        self._path_prefixes.append(prefix_id)
+        self._names += name.encode('utf-8', 'surrogatepass')
+        self._name_offsets.append(len(self._names))
+        return len(self._path_prefixes) - 1
+
+    def add_study(self, study_uid, paths):
+        """
+        Add the paths of a study and return the integer id of the study.
+
+        The paths of a study must be added at once; paths appended with `append` before belong to no study.
+        """
+        if study_uid in self._study_ids:
+            raise ValueError(f'Study {study_uid} is already in the table')
+        start = len(self._path_prefixes)
+        for path in paths:
+            self.append(path)
+        study_id = len(self._study_uids)
+        self._study_uids.append(study_uid)
+        self._study_ids[study_uid] = study_id
+        # Start and end index of the paths of every study, two values per study
+        self._study_bounds.append(start)
+        self._study_bounds.append(len(self._path_prefixes))
+        return study_id
+
+    def __len__(self):
+        return len(self._path_prefixes)
+
+    @property
+    def prefixes(self):
+        """The interned directory prefixes; `prefix_id` values index this list."""
+        return self._prefixes
+
+    def prefix_id(self, index):
+        return self._path_prefixes[index]
+
+    def name(self, index):
+        return self._names[self._name_offsets[index]:self._name_offsets[index + 1]].decode('utf-8', 'surrogatepass')
+
+    def path(self, index):
+        return self._prefixes[self._path_prefixes[index]] + self.name(index)
+
+    def iter_split(self, start=0, stop=None):
+        """
+        Yield (prefix id, file name) of the paths from `start` to `stop`.
+        """
+        stop = len(self) if stop is None else stop
+        names = memoryview(self._names)
+        offsets = self._name_offsets
+        for index in range(start, stop):
+            name = bytes(names[offsets[index]:offsets[index + 1]]).decode('utf-8', 'surrogatepass')
+            yield self._path_prefixes[index], name
+
+    def iter_paths(self, start=0, stop=None):
+        prefixes = self._prefixes
+        for prefix_id, name in self.iter_split(start, stop):
+            yield prefixes[prefix_id] + name
+
+    def __iter__(self):
+        return self.iter_paths()
+
+    def study_id(self, study_uid):
+        return self._study_ids[study_uid]
+
+    def study_paths(self, study_id):
+        return StudyPaths(self, self._study_bounds[2 * study_id], self._study_bounds[2 * study_id + 1])
+
+    # Read-only mapping interface: study UID -> StudyPaths
+
+    def __getitem__(self, study_uid):
+        return self.study_paths(self._study_ids[study_uid])
+
+    def __contains__(self, study_uid):
+        return study_uid in self._study_ids
+
+    def get(self, study_uid, default=None):
+        study_id = self._study_ids.get(study_uid)
+        return default if study_id is None else self.study_paths(study_id)
+
+    def keys(self):
+        return iter(self._study_uids)
+
+    def items(self):
+        for study_id, study_uid in enumerate(self._study_uids):
+            yield study_uid, self.study_paths(study_id)
+
+    def study_count(self):
+        return len(self._study_uids)
@@ -1,7 +1,134 @@
-from pathlib import Path
+import ntpath
+import os
+import posixpath
+import re
+from pathlib import Path, PurePosixPath, PureWindowsPath
+
+from path_table import split_directory
+
+IMAGES_FOLDER = 'images'
+
+WINDOWS = 'windows'
+POSIX = 'posix'
+LOCAL = WINDOWS if os.name == 'nt' else POSIX
+
+# Drive letter (C:\, C:/, C:) or UNC share (\\server\share) at the start of a path
+_WINDOWS_ANCHOR = re.compile(r'^(?:[A-Za-z]:|\\\\)')
+
+_PURE_PATHS = {WINDOWS: PureWindowsPath, POSIX: PurePosixPath}
+_SEPARATORS = {WINDOWS: ntpath.sep, POSIX: posixpath.sep}
+
+# Directories kept in the memo of a PathRewriter before it is cleared
+MAX_CACHED_DIRECTORIES = 100000
 
 
 def replace_drive_with_folder(input_path, new_folder):
     #         
     new_path = Path(new_folder) / Path(*Path(input_path).parts[1:])
     return str(new_path)
+
+
+def path_flavour(path):
+    """
+    Guess whether a path stored in the database was written on Windows or on a POSIX system.
+
+    A drive letter, a UNC share or a backslash without any forward slash mean Windows, a forward slash
+    means POSIX. A bare file name can be either and gets the flavour of the local system.
+    """
+    if _WINDOWS_ANCHOR.match(path) or ('\\' in path and '/' not in path):
+        return WINDOWS
+    if '/' in path:
+        return POSIX
+    return LOCAL
+
+
+class PathRewriter:
+    """
+    Translate image paths from the database into paths below the results 'images' folder.
+
+    An absolute path loses its anchor (drive, UNC share or root), a relative path is kept, and both are
+    put into `new_folder`: C:\\DB\\S1\\1.dcm -> images\\DB\\S1\\1.dcm, S1/1.dcm -> images/S1/1.dcm.
+    Paths are parsed as PureWindowsPath or PurePosixPath according to `flavour` (or `path_flavour`
+    of every path), so Windows paths are handled correctly on Linux and the other way round.
+
+    The translation of a directory is memoized, the file name is only appended, so rewriting a batch
+    costs about one dictionary lookup per path.
+    """
+
+    def __init__(self, new_folder=IMAGES_FOLDER, flavour=None):
+        """
+        Parameters:
+            new_folder (str): The folder that replaces the anchor.
+            flavour (Optional[str]): WINDOWS or POSIX if all database paths were written on one system,
+                                     None to detect it per path.
+        """
+        self.new_folder = new_folder
+        self.flavour = flavour
+        self._directories = {}
+
+    def _parse_directory(self, directory):
+        parsed = self._directories.get(directory)
+        if parsed is None:
+            if len(self._directories) >= MAX_CACHED_DIRECTORIES:
+                self._directories.clear()
+            flavour = self.flavour or path_flavour(directory)
+            pure_path = _PURE_PATHS[flavour](directory)
+            is_absolute = bool(pure_path.anchor)
+            parts = pure_path.parts[1:] if is_absolute else pure_path.parts
+            parsed = (flavour, is_absolute, parts, {})
+            self._directories[directory] = parsed
+        return parsed
+
+    def _directory_prefix(self, directory, kind, output_flavour, base_dir=None):
+        flavour, is_absolute, parts, prefixes = self._parse_directory(directory)
+        output_flavour = output_flavour or flavour
+        key = (kind, output_flavour, base_dir)
+        prefix = prefixes.get(key)
+        if prefix is None:
+            if kind == 'output':
+                prefix = str(_PURE_PATHS[output_flavour](self.new_folder, *parts))
+            else:
+                prefix = str(_PURE_PATHS[output_flavour](base_dir, *parts))
+            if not prefix.endswith(('\\', '/')):
+                prefix += _SEPARATORS[output_flavour]
+            prefixes[key] = prefix
+        return prefix
+
+    def rewrite(self, path, output_flavour=None):
+        """
+        Return the path below `new_folder`, with the separators of `output_flavour` (defaults to the
+        flavour of the source path, so that the database keeps its own style).
+        """
+        directory, name = split_directory(path)
+        return self._directory_prefix(directory, 'output', output_flavour) + name
+
+    def rewrite_batch(self, paths, output_flavour=None):
+        return [self.rewrite(path, output_flavour) for path in paths]
+
+    def iter_rewrite_table(self, table, output_flavour=None, start=0, stop=None):
+        """
+        Yield the rewritten paths of a `path_table.PathTable`, translating each of its directories only once.
+        """
+        prefixes = table.prefixes
+        rewritten = {}
+        for prefix_id, name in table.iter_split(start, stop):
+            prefix = rewritten.get(prefix_id)
+            if prefix is None:
+                prefix = self._directory_prefix(prefixes[prefix_id], 'output', output_flavour)
+                rewritten[prefix_id] = prefix
+            yield prefix + name
+
+    def source_path(self, path, base_dir):
+        """
+        Return the local path of the image file: relative paths are resolved against `base_dir`
+        (the directory of the database) with the local separators, absolute paths are kept.
+        """
+        directory, name = split_directory(path)
+        if self._parse_directory(directory)[1]:
+            # Absolute paths are used as they are, also those written on the other system
+            return path
+        return self._directory_prefix(directory, 'source', LOCAL, base_dir) + name
+
+
+# One rewriter for the whole run: the results writers, the image copier and the database update share its memo
+image_path_rewriter = PathRewriter()
@@ -0,0 +1,119 @@
+import logging
+import queue
+import threading
+import time
+
+# Poll interval for blocking queue operations, so that stages notice cancellation
+POLL_INTERVAL = 0.2
+
+_END = object()
+
+
+class PipelineError(Exception):
+    """A pipeline stage failed. The original exception is available as `__cause__`."""
+
+    def __init__(self, stage_name, error):
+        super().__init__(f"Stage '{stage_name}' failed: {type(error).__name__}: {error}")
+        self.stage_name = stage_name
+
+
+def feed_queue(items, output_queue, cancel_event):
+    """
+    Put every item into a bounded queue, then the end marker.
+
+    Blocks while the queue is full (back pressure from the next stage) and stops early if the
+    pipeline is cancelled. The end marker is put even if iterating `items` fails.
+    """
+    try:
+        for item in items:
+            while True:
+                if cancel_event.is_set():
+                    return
+                try:
+                    output_queue.put(item, timeout=POLL_INTERVAL)
+                    break
+                except queue.Full:
+                    continue
+    finally:
+        if hasattr(items, 'close'):
+            items.close()
+        _put_end(output_queue, cancel_event)
+
+
+def _put_end(output_queue, cancel_event):
+    while True:
+        try:
+            output_queue.put(_END, timeout=POLL_INTERVAL)
+            return
+        except queue.Full:
+            # A consumer that stopped because of cancellation will not drain the queue any more
+            if cancel_event.is_set():
+                return
+
+
+def iter_queue(input_queue, cancel_event):
+    """
+    Yield items from a queue filled by `feed_queue` until the end marker or cancellation.
+    """
+    while not cancel_event.is_set():
+        try:
+            item = input_queue.get(timeout=POLL_INTERVAL)
+        except queue.Empty:
+            continue
+        if item is _END:
+            return
+        yield item
+
+
+def run_pipeline(stages, cancel_event=None):
+    """
+    Run the stages concurrently, each in its own thread, and wait for all of them.
+
+    Stages exchange data through bounded queues (`feed_queue` / `iter_queue`), so the slowest
+    stage sets the pace and the total time is close to the longest stage instead of the sum.
+    If a stage raises, the cancel event is set, the other stages stop at their next queue
+    operation, and the first error is raised as PipelineError once all threads have finished.
+
+    Parameters:
+        stages (List[Tuple[str, Callable[[threading.Event], None]]]): Stage names and functions.
+            Every function receives the cancel event.
+        cancel_event (Optional[threading.Event]): Event to cancel the pipeline from outside.
+
+    Returns:
+        dict: Wall-clock duration in seconds of every stage.
+    """
+    cancel_event = cancel_event or threading.Event()
+    errors = []
+    durations = {}
+
+    def run_stage(name, func):
+        started = time.perf_counter()
+        try:
+            func(cancel_event)
+        except BaseException as e:
+            errors.append((name, e))
+            cancel_event.set()
+        finally:
+            durations[name] = time.perf_counter() - started
+            logging.info(f"Stage '{name}' finished in {durations[name]:.1f} s")
+
+    threads = [
+        threading.Thread(target=run_stage, args=(name, func), name=f'stage-{name}', daemon=True)
+        for name, func in stages
+    ]
+    for thread in threads:
+        thread.start()
+    try:
+        for thread in threads:
+            while thread.is_alive():
+                thread.join(POLL_INTERVAL)
+    except KeyboardInterrupt:
+        cancel_event.set()
+        for thread in threads:
+            thread.join()
+        raise
+
+    if errors:
+        name, error = errors[0]
+        raise PipelineError(name, error) from error
+    return durations
@@ -0,0 +1,487 @@
+import os
+import logging
+import queue
+import shutil
+from collections import namedtuple
+from datetime import datetime
+
+import db_connection
+from anonymization_utils import anonymize_medical_database, snapshot_medical_database
+from archive_output import DEFAULT_SHARD_SIZE, ShardedArchiveWriter, check_archive_format
+from deduplication import ContentDeduplicator, iter_unique_tasks
+from mkb10_cache import load_mkb10_values
+from parallel_processing import iter_anonymize_files
+from pipeline import PipelineError, feed_queue, iter_queue, run_pipeline
+from processing_manifest import MANIFEST_FILENAME, iter_pending_tasks, open_manifest, record_results
+from path_table import PathTable
+from path_utils import LOCAL, image_path_rewriter
+from results_writers import RESULT_FILENAMES, RESULT_WRITERS, check_output_format, stream_study_records_to_csv
+from run_metrics import RunMetrics, profiled
+
+# Размер порции строк, читаемых из курсора Firebird за один раз
+FETCH_CHUNK_SIZE = 10000
+# Максимальное число исследований в очереди между этапами конвейера
+STAGE_QUEUE_SIZE = 1000
+# Поддерживаемые форматы файла результатов
+OUTPUT_FORMATS = tuple(RESULT_WRITERS)
+# Этапы конвейера (см. run_processing); любой из них можно профилировать
+PIPELINE_STAGES = ('schema logging', 'database anonymization', 'fetch', 'export', 'image copy')
+# Имя архивов результатов: export_00001.tar и т.д.
+ARCHIVE_BASE_NAME = 'export'
+# Временная папка для анонимизированных файлов, ожидающих записи в архив
+ARCHIVE_SPOOL_FOLDER = '.archive_spool'
+
+StudyRecord = namedtuple('StudyRecord', ['study_uid', 'study_result', 'mkb_description', 'image_paths'])
+
+
+def logging_setup(output_dir):
+    # Настройка логирования
+    os.makedirs(os.path.join(output_dir, 'logs'), exist_ok=True)
+    logging.basicConfig(
+        filename=os.path.join(output_dir, 'logs',
+                              f'medical_data_processing_{datetime.now().strftime("%d_%m_%Y_%H_%M_%S")}.log'),
+        level=logging.INFO,
+        format='%(asctime)s - %(levelname)s - %(message)s'
+    )
+
+
+def get_all_columns(database_path):
+    # SQL-запрос для получения всех таблиц и их столбцов
+    query = """
+        SELECT rdb$relation_name AS table_name, rdb$field_name AS column_name
+        FROM rdb$relation_fields
+        WHERE rdb$system_flag = 0
+        ORDER BY rdb$relation_name, rdb$field_position
+    """
+    # Подключение к базе данных (соединение берётся из общего пула)
+    with db_connection.cursor(database_path, read_only=True) as cur:
+        cur.execute(query)
+        columns = cur.fetchall()
+
+    # Создание словаря для хранения столбцов по таблицам
+    table_columns = {}
+    for row in columns:
+        table_name = row[0].strip()
+        column_name = row[1].strip()
+        if table_name not in table_columns:
+            table_columns[table_name] = []
+        table_columns[table_name].append(column_name)
+
+    return table_columns
+
+
+def log_columns_for_database(database_path, db_name):
+    logging.info(f"Проверка столбцов в {db_name}...")
+    table_columns = get_all_columns(database_path)
+    for table, columns in table_columns.items():
+        logging.info(f"Таблица '{table}': Столбцы: {', '.join(columns)}")
+    logging.info(f"Завершена проверка столбцов в {db_name}.")
+
+
+def _iter_rows(cursor, chunk_size):
+    # Строки читаются порциями, чтобы не держать в памяти всю выборку
+    while True:
+        rows = cursor.fetchmany(chunk_size)
+        if not rows:
+            return
+        yield from rows
+
+
+def fetch_mkb10_values(database_path_mkb10, chunk_size=FETCH_CHUNK_SIZE):
+    mkb10_values = {}
+
+    # Считывание значений MKB из таблицы MKB10
+    with db_connection.cursor(database_path_mkb10, read_only=True) as cur_mkb10:
+        cur_mkb10.execute('SELECT MKB_VALUES FROM MKB10')
+        for row in _iter_rows(cur_mkb10, chunk_size):
+            mkb_value = row[0].split(' ')[0]
+            mkb10_values[mkb_value] = row[0]
+
+    return mkb10_values
+
+
+def _log_orphan_images(cur_medical, chunk_size):
+    # Изображения, серия которых ссылается на отсутствующее в STUDIES исследование, в выборку
+    # iter_study_records (от STUDIES) не попадают - о них пишется предупреждение, по одному на исследование
+    cur_medical.execute("""
+        SELECT SE.STUDY_UID, I.IMAGE_PATH
+        FROM IMAGES I
+        JOIN SERIES SE ON SE.SERIES_UID = I.SERIES_UID
+        LEFT JOIN STUDIES S ON S.STUDY_UID = SE.STUDY_UID
+        WHERE S.STUDY_UID IS NULL
+        ORDER BY SE.STUDY_UID
+    """)
+    orphan_images = 0
+    study_uid = None
+    for row in _iter_rows(cur_medical, chunk_size):
+        orphan_images += 1
+        if row[0] != study_uid:
+            study_uid = row[0]
+            logging.warning(f"Study UID {str(study_uid).strip()} not found in Medical database, "
+                            f"its images are skipped (first: {row[1]})")
+    return orphan_images
+
+
+def iter_study_records(database_path_medical, mkb10_values, chunk_size=FETCH_CHUNK_SIZE):
+    """
+    Читает исследования вместе с путями к их изображениям и отдаёт их по одному, по мере получения.
+
+    Исследования и изображения соединяются в SQL и сортируются по STUDY_UID, поэтому в памяти
+    одновременно находится только одно исследование и одна порция строк курсора.
+    """
+    # Запрос для получения исследований и путей к изображениям (LEFT JOIN - исследования без изображений тоже)
+    select_command = """
+            SELECT S.STUDY_UID, S.STUDY_RESULT, I.IMAGE_PATH
+            FROM STUDIES S
+            LEFT JOIN SERIES SE ON SE.STUDY_UID = S.STUDY_UID
+            LEFT JOIN IMAGES I ON I.SERIES_UID = SE.SERIES_UID
+            ORDER BY S.STUDY_UID
+        """
+    total_images = 0
+    images_with_mkb = 0
+
+    with db_connection.cursor(database_path_medical, read_only=True) as cur_medical:
+        cur_medical.execute(select_command)
+        record = None
+        for row in _iter_rows(cur_medical, chunk_size):
+            study_uid = str(row[0]).strip()
+            if record is None or record.study_uid != study_uid:
+                if record is not None:
+                    yield record
+                study_result = str(row[1]).strip()
+                diagnosis_code = study_result.split(' ')[0]
+                record = StudyRecord(
+                    study_uid, study_result, mkb10_values.get(diagnosis_code, 'Description not found'), [],
+                )
+                has_mkb = bool(diagnosis_code) and diagnosis_code in mkb10_values
+                if not has_mkb:
+                    # Если код МКБ отсутствует или пустой
+                    logging.info(f"No valid MKB code found for study UID: {study_uid}")
+
+            if row[2] is not None:
+                total_images += 1
+                record.image_paths.append(str(row[2]))
+                if has_mkb:
+                    images_with_mkb += 1
+
+        if record is not None:
+            yield record
+
+        orphan_images = _log_orphan_images(cur_medical, chunk_size)
+
+    # Вывод информации в консоль
+    print(f"Всего изображений: {total_images}")
+    print(f"Всего изображений с кодом МКБ: {images_with_mkb}")
+    if orphan_images:
+        print(f"Изображений, исследование которых не найдено в базе Medical: {orphan_images}")
+
+
+def fetch_study_results(database_path_medical, database_path_mkb10):
+    # image_names - PathTable: компактная таблица путей с доступом по STUDY_UID как у словаря
+    # (get, items), пути не хранятся отдельными строками
+    mkb10_values = load_mkb10_values(database_path_mkb10, fetch_mkb10_values)
+    study_results = {}
+    image_names = PathTable()
+
+    for record in iter_study_records(database_path_medical, mkb10_values):
+        study_results[record.study_uid] = record.study_result
+        if record.image_paths:
+            image_names.add_study(record.study_uid, record.image_paths)
+
+    return study_results, mkb10_values, image_names
+
+
+def write_study_results_to_csv(study_results, mkb10_values, image_names, output_filename, output_dir):
+    records = (
+        StudyRecord(
+            study_uid,
+            study_result,
+            mkb10_values.get(study_result.split(' ')[0], 'Description not found'),
+            image_names.get(study_uid, ()),
+        )
+        for study_uid, study_result in study_results.items()
+    )
+    for _ in stream_study_records_to_csv(records, output_filename):
+        pass
+
+
+def iter_image_copy_tasks(study_images, database_path_medical, output_dir, image_root=None):
+    # Абсолютные пути копируются в output_dir/images без диска (корня), относительные - из папки базы
+    # (или из image_root, если изображения лежат отдельно) в output_dir/images.
+    # Пути Windows из базы разбираются правильно и на Linux.
+    base_dir = image_root or os.path.dirname(database_path_medical)
+
+    for study_uid, images in study_images:
+        output_image_paths = image_path_rewriter.rewrite_batch(images, LOCAL)
+        for image_path, output_image_path in zip(images, output_image_paths):
+            yield image_path_rewriter.source_path(image_path, base_dir), os.path.join(output_dir, output_image_path)
+
+
+def copy_images_and_process_dicom(study_images, database_path_medical, output_dir, workers=None, on_progress=None,
+                                  metrics=None, image_root=None, on_failure=None):
+    # study_images - пары (STUDY_UID, список путей); может быть потоком, копирование начинается сразу.
+    # on_progress (если задан) получает счётчики files_done, files_failed, files_skipped, files_duplicate,
+    # files_linked, bytes_done, bytes_saved. on_failure (если задан) вызывается с исходным путём и путём
+    # результата каждого файла, который не удалось обработать. В metrics (RunMetrics) попадают те же
+    # счётчики, время обработки каждого файла и ошибки по типу исключения. Возвращает словарь счётчиков.
+    counters = {
+        'files_done': 0, 'files_failed': 0, 'files_skipped': 0, 'files_duplicate': 0, 'files_linked': 0,
+        'bytes_done': 0, 'bytes_saved': 0,
+    }
+
+    def count_skipped(source, destination):
+        counters['files_skipped'] += 1
+        if on_progress is not None:
+            on_progress(**counters)
+
+    def count_duplicate(source, destination):
+        counters['files_duplicate'] += 1
+        if on_progress is not None:
+            on_progress(**counters)
+
+    # Уже обработанные и не изменившиеся с тех пор файлы пропускаются по манифесту в output_dir.
+    # Повторная ссылка на тот же файл с тем же путём результата обрабатывается один раз. Из исходников
+    # с одинаковым содержимым (в том числе один файл под разными путями) анонимизируется только первый,
+    # остальные результаты - жёсткие ссылки на него; хэш считается только для файлов, размер которых
+    # совпал с размером другого исходника.
+    manifest = open_manifest(os.path.join(output_dir, MANIFEST_FILENAME))
+    tasks = iter_image_copy_tasks(study_images, database_path_medical, output_dir, image_root)
+    tasks = iter_unique_tasks(tasks, on_duplicate=count_duplicate)
+    pending_tasks = iter_pending_tasks(manifest, tasks, on_skip=count_skipped)
+
+    deduplicator = ContentDeduplicator(manifest)
+    results = iter_anonymize_files(deduplicator.iter_tasks(pending_tasks), workers=workers)
+    results = record_results(manifest, deduplicator.iter_results(results))
+    try:
+        for result in results:
+            counters['files_done'] += 1
+            counters['bytes_done'] += result.size
+            if metrics is not None and result.elapsed is not None:
+                metrics.observe('file', result.elapsed)
+            if result.error is not None:
+                counters['files_failed'] += 1
+                if metrics is not None:
+                    metrics.count_failure(result.error.split(':', 1)[0])
+                logging.warning(f'Не найден или недоступен файл {result.source}: {result.error}')
+                if on_failure is not None:
+                    on_failure(result.source, result.destination)
+            elif result.linked_to is not None:
+                counters['files_linked'] += 1
+                counters['bytes_saved'] += result.size
+            if on_progress is not None:
+                on_progress(**counters)
+    finally:
+        results.close()
+        manifest.close()
+        if metrics is not None:
+            for name, value in counters.items():
+                metrics.count(name, value)
+    logging.info(
+        f"Обработано изображений: {counters['files_done']}, с ошибками: {counters['files_failed']}, "
+        f"пропущено (обработаны ранее): {counters['files_skipped']}, "
+        f"повторных ссылок на тот же файл: {counters['files_duplicate']}"
+    )
+    logging.info(
+        f"Одинаковых по содержимому файлов заменено ссылками: {counters['files_linked']}, "
+        f"сэкономлено {counters['bytes_saved'] / (1024 * 1024):.1f} МБ"
+    )
+    return counters
+
+
+def stream_images_to_archive(study_images, database_path_medical, output_dir, archive, workers=None,
+                             on_progress=None, metrics=None, image_root=None):
+    # То же, что copy_images_and_process_dicom, но файлы не остаются в output_dir/images: рабочие процессы
+    # пишут анонимизированный файл во временную папку output_dir/.archive_spool и возвращают только путь,
+    # а этот поток дописывает файл в архив archive (ShardedArchiveWriter) под путём images/... потоково
+    # и сразу удаляет его. Так в памяти не бывает содержимого файлов, а на диске - больше файлов, чем
+    # обрабатывается одновременно. Манифест и замена одинаковых файлов ссылками в этом режиме не
+    # используются, пропускаются только повторы с тем же исходником и тем же путём в архиве.
+    counters = {'files_done': 0, 'files_failed': 0, 'files_duplicate': 0, 'bytes_done': 0}
+
+    def count_duplicate(source, destination):
+        counters['files_duplicate'] += 1
+        if on_progress is not None:
+            on_progress(**counters)
+
+    spool_dir = os.path.join(output_dir, ARCHIVE_SPOOL_FOLDER)
+    os.makedirs(spool_dir, exist_ok=True)
+    # Путь в архиве для каждого файла, который сейчас обрабатывается (по временному пути)
+    member_names = {}
+
+    def iter_spool_tasks(tasks):
+        for number, (source, destination) in enumerate(tasks):
+            spool_path = os.path.join(spool_dir, f'{number:09d}.dcm')
+            member_names[spool_path] = os.path.relpath(destination, output_dir).replace(os.sep, '/')
+            yield source, spool_path
+
+    tasks = iter_image_copy_tasks(study_images, database_path_medical, output_dir, image_root)
+    tasks = iter_unique_tasks(tasks, on_duplicate=count_duplicate)
+    results = iter_anonymize_files(iter_spool_tasks(tasks), workers=workers)
+    try:
+        for result in results:
+            counters['files_done'] += 1
+            member_name = member_names.pop(result.destination)
+            if metrics is not None and result.elapsed is not None:
+                metrics.observe('file', result.elapsed)
+            if result.error is not None:
+                counters['files_failed'] += 1
+                if metrics is not None:
+                    metrics.count_failure(result.error.split(':', 1)[0])
+                logging.warning(f'Не найден или недоступен файл {result.source}: {result.error}')
+            else:
+                archive.add_file(member_name, result.destination)
+                os.remove(result.destination)
+                counters['bytes_done'] += result.size
+            if on_progress is not None:
+                on_progress(**counters)
+    finally:
+        results.close()
+        shutil.rmtree(spool_dir, ignore_errors=True)
+        if metrics is not None:
+            for name, value in counters.items():
+                metrics.count(name, value)
+    logging.info(
+        f"Записано в архив изображений: {counters['files_done'] - counters['files_failed']}, "
+        f"с ошибками: {counters['files_failed']}, повторных ссылок на тот же файл: {counters['files_duplicate']}"
+    )
+    return counters
+
+
+def count_study_images(database_path_medical):
+    with db_connection.cursor(database_path_medical, read_only=True) as cur_medical:
+        cur_medical.execute("""
+            SELECT COUNT(*)
+            FROM STUDIES S
+            JOIN SERIES SE ON SE.STUDY_UID = S.STUDY_UID
+            JOIN IMAGES I ON I.SERIES_UID = SE.SERIES_UID
+        """)
+        return cur_medical.fetchone()[0]
+
+
+def run_processing(medical_db_path, mkb10_db_path, output_dir, workers=None, chunk_size=FETCH_CHUNK_SIZE,
+                   output_format='csv', cancel_event=None, on_progress=None, metrics=None, profile_stage=None,
+                   image_root=None, mkb10_values=None, archive_format=None, shard_size=DEFAULT_SHARD_SIZE):
+    """
+    Запускает полную обработку как конвейер одновременно работающих этапов.
+
+    Сначала снимается копия базы Medical (пока к ней нет подключений). Затем параллельно выполняются
+    логирование схем, анонимизация копии базы и цепочка "чтение исследований -> файл результатов ->
+    копирование изображений", звенья которой связаны ограниченными очередями: изображения начинают
+    копироваться с первыми прочитанными исследованиями. Ошибка любого этапа останавливает остальные
+    и поднимается как PipelineError; уже записанные файлы остаются, повторный запуск продолжит работу
+    по манифесту.
+
+    chunk_size - размер порции строк при чтении из базы, output_format - формат файла результатов.
+    cancel_event позволяет остановить обработку извне. on_progress (если задан) вызывается из рабочих
+    потоков со счётчиками: files_total, затем files_done, files_failed, files_skipped, bytes_done.
+
+    По каждому этапу собираются время (общее и процессорное), счётчики строк, файлов и байт, ошибки
+    по типу и задержки обработки файлов (p50/p95) - в metrics (RunMetrics, создаётся при None). В конце,
+    в том числе при ошибке, отчёт записывается в logs/run_report_<время>.json. Этап profile_stage
+    (одно из PIPELINE_STAGES) выполняется под cProfile, статистика - в logs/profile_<время>.pstats.
+    image_root - папка, от которой считаются относительные пути изображений (по умолчанию папка базы).
+    mkb10_values - уже загруженный словарь МКБ10 (пакетная обработка нескольких баз), иначе он читается
+    из mkb10_db_path.
+
+    С archive_format (одно из ARCHIVE_FORMATS) изображения не создаются отдельными файлами, а сразу
+    пишутся из пула процессов в архивы export_00001.<формат>, ... по shard_size байт; готовый архив
+    переименовывается из .partial, и его можно передавать, пока пишутся следующие. В последний архив
+    добавляются файл результатов и обновлённая база. Возвращает путь к отчёту.
+    """
+    # Проверка до снятия копии базы: без pyarrow Parquet/Arrow записать не получится
+    check_output_format(output_format)
+    if archive_format is not None:
+        check_archive_format(archive_format)
+    if profile_stage is not None and profile_stage not in PIPELINE_STAGES:
+        raise ValueError(f'Unknown pipeline stage: {profile_stage}')
+
+    metrics = metrics or RunMetrics()
+    logs_dir = os.path.join(output_dir, 'logs')
+    os.makedirs(logs_dir, exist_ok=True)
+    timestamp = datetime.now().strftime("%d_%m_%Y_%H_%M_%S")
+
+    with metrics.stage('snapshot'):
+        updated_db_path = snapshot_medical_database(medical_db_path, output_dir)
+    results_path = os.path.join(output_dir, RESULT_FILENAMES[output_format])
+    write_results = RESULT_WRITERS[output_format]
+    records_queue = queue.Queue(STAGE_QUEUE_SIZE)
+    exported_queue = queue.Queue(STAGE_QUEUE_SIZE)
+    archive = None
+    if archive_format is not None:
+        archive = ShardedArchiveWriter(output_dir, ARCHIVE_BASE_NAME, archive_format, shard_size)
+
+    def log_schemas(cancel_event):
+        log_columns_for_database(medical_db_path, "Medical Database")
+        log_columns_for_database(mkb10_db_path, "MKB10 Database")
+
+    def anonymize_database(cancel_event):
+        metrics.count('db_image_paths_rewritten', anonymize_medical_database(updated_db_path))
+
+    def count_fetched(records):
+        for record in records:
+            metrics.count('studies_fetched')
+            metrics.count('image_rows_fetched', len(record.image_paths))
+            yield record
+
+    def fetch_studies(cancel_event):
+        if on_progress is not None:
+            on_progress(files_total=count_study_images(medical_db_path))
+        mkb10 = mkb10_values if mkb10_values is not None else load_mkb10_values(mkb10_db_path, fetch_mkb10_values)
+        records = count_fetched(iter_study_records(medical_db_path, mkb10, chunk_size))
+        feed_queue(records, records_queue, cancel_event)
+
+    def export_results(cancel_event):
+        records = write_results(iter_queue(records_queue, cancel_event), results_path)
+        feed_queue(records, exported_queue, cancel_event)
+
+    def copy_images(cancel_event):
+        records = iter_queue(exported_queue, cancel_event)
+        study_images = ((record.study_uid, record.image_paths) for record in records)
+        if archive is not None:
+            stream_images_to_archive(
+                study_images, medical_db_path, output_dir, archive, workers=workers, on_progress=on_progress,
+                metrics=metrics, image_root=image_root,
+            )
+            return
+        copy_images_and_process_dicom(
+            study_images, medical_db_path, output_dir, workers=workers, on_progress=on_progress, metrics=metrics,
+            image_root=image_root,
+        )
+
+    def instrumented(name, func):
+        def run_stage(cancel_event):
+            with metrics.stage(name):
+                if name != profile_stage:
+                    func(cancel_event)
+                    return
+                with profiled(os.path.join(logs_dir, f'profile_{name.replace(" ", "_")}_{timestamp}.pstats')):
+                    func(cancel_event)
+        return name, run_stage
+
+    stages = dict(zip(PIPELINE_STAGES, (log_schemas, anonymize_database, fetch_studies, export_results, copy_images)))
+    try:
+        run_pipeline([instrumented(name, func) for name, func in stages.items()], cancel_event)
+        metrics.status = 'cancelled' if cancel_event is not None and cancel_event.is_set() else 'done'
+        if archive is not None:
+            archive.add_file(RESULT_FILENAMES[output_format], results_path)
+            archive.add_file(os.path.basename(updated_db_path), updated_db_path)
+            shards = archive.close()
+            metrics.count('archive_shards', len(shards))
+            logging.info(f'Результаты записаны в архивы: {", ".join(shards)}')
+    except PipelineError as e:
+        metrics.status = 'failed'
+        metrics.count_failure(f'stage {e.stage_name}: {type(e.__cause__).__name__}')
+        raise
+    except BaseException:
+        metrics.status = 'interrupted'
+        raise
+    finally:
+        if archive is not None:
+            archive.abort()
+        db_connection.close_all()
+        report_path = metrics.write_report(
+            os.path.join(logs_dir, f'run_report_{timestamp}.json'),
+            workers=workers, chunk_size=chunk_size, output_format=output_format, archive_format=archive_format,
+        )
+        logging.info(f'Отчёт о запуске записан в {report_path}')
+    return report_path
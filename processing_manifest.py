@@ -0,0 +1,175 @@
+import os
+import sqlite3
+import time
+
+MANIFEST_FILENAME = 'manifest.sqlite'
+
+STATUS_DONE = 'done'
+STATUS_FAILED = 'failed'
+
+
+def open_manifest(manifest_path):
+    """
+    Open (and create if needed) the SQLite manifest of processed image files.
+
+    Every row describes one output file: the source it was produced from, the size and mtime of the source
+    when it was processed, the status ('done' or 'failed'), the error message of the last attempt and
+    the content digest of the source (if it was computed). Rows are keyed by the output path, as one source
+    may be written to several outputs; source sizes and digests are indexed for deduplication.
+
+    Parameters:
+        manifest_path (str): Path to the manifest file.
+
+    Returns:
+        sqlite3.Connection: Connection to the manifest.
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(manifest_path)), exist_ok=True)
+    con = sqlite3.connect(manifest_path)
+    con.execute('PRAGMA journal_mode=WAL')
+    con.execute('PRAGMA synchronous=NORMAL')
+    con.execute("""
+        CREATE TABLE IF NOT EXISTS processed_files (
+            output_path TEXT PRIMARY KEY,
+            source_path TEXT NOT NULL,
+            source_size INTEGER,
+            source_mtime_ns INTEGER,
+            status TEXT NOT NULL,
+            error TEXT,
+            processed_at REAL NOT NULL,
+            content_digest TEXT
+        )
+    """)
+    con.execute('CREATE INDEX IF NOT EXISTS processed_files_digest ON processed_files (content_digest)')
+    con.execute('CREATE INDEX IF NOT EXISTS processed_files_size ON processed_files (source_size)')
+    con.commit()
+    return con
+
+
+def _file_signature(path):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None, None
+    return stat.st_size, stat.st_mtime_ns
+
+
+def iter_pending_tasks(con, tasks, on_skip=None):
+    """
+    Skip the tasks that were already processed successfully and whose source has not changed since.
+
+    A task is repeated if its output is not in the manifest, failed last time, was produced from a different
+    source, the source size or mtime changed, or the output file is missing.
+
+    Parameters:
+        con (sqlite3.Connection): Manifest connection from `open_manifest`.
+        tasks (Iterable[Tuple[str, str]]): Pairs of (source path, destination path).
+        on_skip (Optional[Callable[[str, str], None]]): Called with the source and destination of every skipped task.
+
+    Yields:
+        Tuple[str, str]: The tasks that still have to be processed.
+    """
+    for source, destination in tasks:
+        row = con.execute(
+            'SELECT source_size, source_mtime_ns, source_path, status FROM processed_files WHERE output_path = ?',
+            (destination,),
+        ).fetchone()
+        if row is not None:
+            size, mtime_ns, source_path, status = row
+            if (status == STATUS_DONE
+                    and source_path == source
+                    and (size, mtime_ns) == _file_signature(source)
+                    and os.path.exists(destination)):
+                if on_skip is not None:
+                    on_skip(source, destination)
+                continue
+        yield source, destination
+
+
+def record_results(con, results, commit_every=1000):
+    """
+    Store every result in the manifest and pass it through.
+
+    The source signature is taken after processing, so files anonymized in place are recognized
+    as finished on the next run. Records are committed in batches and once more at the end,
+    including when the run is interrupted.
+
+    Parameters:
+        con (sqlite3.Connection): Manifest connection from `open_manifest`.
+        results (Iterable[FileResult]): Results from `parallel_processing.iter_anonymize_files`.
+        commit_every (int): Number of results per transaction.
+
+    Yields:
+        FileResult: The same results.
+    """
+    pending_commit = 0
+    try:
+        for result in results:
+            size, mtime_ns = _file_signature(result.source)
+            con.execute(
+                """
+                INSERT OR REPLACE INTO processed_files (
+                    source_path, source_size, source_mtime_ns, output_path, status, error, processed_at, content_digest
+                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                """,
+                (
+                    result.source,
+                    size,
+                    mtime_ns,
+                    result.destination,
+                    STATUS_DONE if result.error is None else STATUS_FAILED,
+                    result.error,
+                    time.time(),
+                    result.digest,
+                ),
+            )
+            pending_commit += 1
+            if pending_commit >= commit_every:
+                con.commit()
+                pending_commit = 0
+            yield result
+    finally:
+        con.commit()
+
+
+def find_output_by_digest(con, digest):
+    """
+    Return the path of an existing output of a successfully processed file with the given source digest, or None.
+    """
+    rows = con.execute(
+        'SELECT output_path FROM processed_files WHERE content_digest = ? AND status = ?', (digest, STATUS_DONE),
+    )
+    for (output_path,) in rows:
+        if os.path.exists(output_path):
+            return output_path
+    return None
+
+
+def has_source_size(con, size):
+    """
+    Check whether a successfully processed file had a source of `size` bytes.
+    """
+    row = con.execute(
+        'SELECT 1 FROM processed_files WHERE source_size = ? AND status = ? LIMIT 1', (size, STATUS_DONE),
+    ).fetchone()
+    return row is not None
+
+
+def find_unhashed_outputs(con, size):
+    """
+    Return (output path, source path, source size, source mtime in ns) of the successfully processed files
+    with a source of `size` bytes whose digest was not computed.
+    """
+    return con.execute(
+        """
+        SELECT output_path, source_path, source_size, source_mtime_ns FROM processed_files
+        WHERE source_size = ? AND status = ? AND content_digest IS NULL
+        """,
+        (size, STATUS_DONE),
+    ).fetchall()
+
+
+def set_source_digest(con, output_path, digest):
+    """
+    Store the source digest of an output computed after it was recorded.
+    """
+    con.execute('UPDATE processed_files SET content_digest = ? WHERE output_path = ?', (digest, output_path))
@@ -0,0 +1,211 @@
+import csv
+
+from path_utils import LOCAL, image_path_rewriter
+
+CSV_FIELDS = ['Image Name', 'Study UID', 'Study Result', 'MKB Description']
+
+# Number of studies per Parquet row group / Arrow record batch
+ROW_GROUP_SIZE = 10000
+
+RESULT_FILENAMES = {
+    'csv': 'results.csv',
+    'parquet': 'results.parquet',
+    'arrow': 'results.arrow',
+}
+
+
+def output_image_paths(image_paths):
+    """
+    Return the image paths as they are stored in the results directory: the anchor of an absolute
+    path is replaced with the 'images' folder, a relative path is put into the 'images' folder.
+    Windows paths from the database are translated also on Linux, with the local separators.
+    """
+    return image_path_rewriter.rewrite_batch(image_paths, LOCAL)
+
+
+def stream_study_records_to_csv(records, output_filename, append=False):
+    """
+    Write every study record to a CSV file as soon as it arrives and pass it through.
+
+    The 'Image Name' column holds the Python representation of the list of image paths.
+
+    Parameters:
+        records (Iterable[StudyRecord]): Study records.
+        output_filename (str): Path to the CSV file.
+        append (bool): Append to an existing file; the header is written only to a new or empty file.
+
+    Yields:
+        StudyRecord: The same records.
+    """
+    with open(output_filename, 'a' if append else 'w', encoding='utf-8') as csvfile:
+        writer = csv.DictWriter(csvfile, fieldnames=CSV_FIELDS)
+        if csvfile.tell() == 0:
+            writer.writeheader()
+
+        for record in records:
+            writer.writerow({
+                'Image Name': output_image_paths(record.image_paths),
+                'Study UID': record.study_uid,
+                'Study Result': record.study_result,
+                'MKB Description': record.mkb_description,
+            })
+            yield record
+
+
+def _import_pyarrow():
+    try:
+        import pyarrow  # noqa: WPS433
+    except ImportError:
+        raise RuntimeError('Parquet and Arrow output requires pyarrow: pip install pyarrow') from None
+    return pyarrow
+
+
+def _results_schema(pa):
+    return pa.schema([
+        ('image_paths', pa.list_(pa.string())),
+        ('study_uid', pa.string()),
+        ('study_result', pa.string()),
+        ('mkb_code', pa.string()),
+        ('mkb_description', pa.string()),
+    ])
+
+
+def _record_batch(pa, schema, records):
+    return pa.RecordBatch.from_arrays(
+        [
+            pa.array([output_image_paths(record.image_paths) for record in records], schema.field('image_paths').type),
+            pa.array([record.study_uid for record in records], pa.string()),
+            pa.array([record.study_result for record in records], pa.string()),
+            pa.array([record.study_result.split(' ')[0] for record in records], pa.string()),
+            pa.array([record.mkb_description for record in records], pa.string()),
+        ],
+        schema=schema,
+    )
+
+
+def _stream_record_batches(records, write_batch, pa, schema, row_group_size):
+    batch = []
+    for record in records:
+        batch.append(record)
+        yield record
+        if len(batch) >= row_group_size:
+            write_batch(_record_batch(pa, schema, batch))
+            batch = []
+    if batch:
+        write_batch(_record_batch(pa, schema, batch))
+
+
+def stream_study_records_to_parquet(records, output_filename, row_group_size=ROW_GROUP_SIZE):
+    """
+    Write the study records to a Parquet file in row groups and pass every record through.
+
+    Image paths are stored as a list column, the MKB code as a separate column, so the file can be
+    filtered by code and read without parsing text. Requires pyarrow.
+
+    Parameters:
+        records (Iterable[StudyRecord]): Study records.
+        output_filename (str): Path to the Parquet file.
+        row_group_size (int): Number of studies per row group.
+
+    Yields:
+        StudyRecord: The same records.
+    """
+    pa = _import_pyarrow()
+    import pyarrow.parquet as pq  # noqa: WPS433
+
+    schema = _results_schema(pa)
+    with pq.ParquetWriter(output_filename, schema) as writer:
+        yield from _stream_record_batches(records, writer.write_batch, pa, schema, row_group_size)
+
+
+def stream_study_records_to_arrow(records, output_filename, row_group_size=ROW_GROUP_SIZE):
+    """
+    Write the study records to an Arrow IPC file (memory-mappable) in record batches and pass every
+    record through. The columns are the same as in `stream_study_records_to_parquet`. Requires pyarrow.
+
+    Parameters:
+        records (Iterable[StudyRecord]): Study records.
+        output_filename (str): Path to the Arrow file.
+        row_group_size (int): Number of studies per record batch.
+
+    Yields:
+        StudyRecord: The same records.
+    """
+    pa = _import_pyarrow()
+
+    schema = _results_schema(pa)
+    with pa.OSFile(output_filename, 'wb') as sink, pa.ipc.new_file(sink, schema) as writer:
+        yield from _stream_record_batches(records, writer.write_batch, pa, schema, row_group_size)
+
+
+RESULT_WRITERS = {
+    'csv': stream_study_records_to_csv,
+    'parquet': stream_study_records_to_parquet,
+    'arrow': stream_study_records_to_arrow,
+}
+
+
+def check_output_format(output_format):
+    """
+    Raise ValueError for an unknown format and RuntimeError if its dependencies are missing.
+    """
+    if output_format not in RESULT_WRITERS:
+        raise ValueError(f'Unknown output format: {output_format}')
+    if output_format != 'csv':
+        _import_pyarrow()
+
+
+def _combine_csv(parts, output_path):
+    with open(output_path, 'w', encoding='utf-8', newline='') as output_file:
+        writer = csv.writer(output_file)
+        writer.writerow(CSV_FIELDS + ['Database'])
+        for name, path in parts:
+            with open(path, encoding='utf-8', newline='') as part_file:
+                reader = csv.reader(part_file)
+                next(reader, None)
+                for row in reader:
+                    writer.writerow(row + [name])
+
+
+def _iter_arrow_batches(pa, output_format, path):
+    if output_format == 'parquet':
+        import pyarrow.parquet as pq  # noqa: WPS433
+        yield from pq.ParquetFile(path).iter_batches(batch_size=ROW_GROUP_SIZE)
+        return
+    with pa.memory_map(path) as source:
+        reader = pa.ipc.open_file(source)
+        for index in range(reader.num_record_batches):
+            yield reader.get_batch(index)
+
+
+def _combine_arrow(parts, output_path, output_format):
+    pa = _import_pyarrow()
+    import pyarrow.parquet as pq  # noqa: WPS433
+
+    schema = _results_schema(pa).append(pa.field('database', pa.string()))
+    if output_format == 'parquet':
+        writer = pq.ParquetWriter(output_path, schema)
+    else:
+        writer = pa.ipc.new_file(output_path, schema)
+    with writer:
+        for name, path in parts:
+            for batch in _iter_arrow_batches(pa, output_format, path):
+                database = pa.array([name] * batch.num_rows, pa.string())
+                writer.write_batch(pa.RecordBatch.from_arrays(batch.columns + [database], schema=schema))
+
+
+def combine_results(parts, output_path, output_format):
+    """
+    Concatenate the result files of several databases into one, with the database name as an extra column
+    ('Database' in CSV, 'database' in Parquet and Arrow). The files are streamed, not loaded at once.
+
+    Parameters:
+        parts (Iterable[Tuple[str, str]]): Pairs of (database name, path of its result file).
+        output_path (str): Path of the combined file.
+        output_format (str): Format of the parts and of the combined file, a key of RESULT_WRITERS.
+    """
+    check_output_format(output_format)
+    if output_format == 'csv':
+        _combine_csv(parts, output_path)
+    else:
+        _combine_arrow(parts, output_path, output_format)
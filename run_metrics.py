@@ -0,0 +1,137 @@
+import contextlib
+import cProfile
+import io
+import json
+import os
+import platform
+import pstats
+import threading
+import time
+from array import array
+from collections import Counter
+
+# Number of functions in the text summary of a profile
+PROFILE_SUMMARY_LINES = 40
+
+
+def percentile(sorted_values, fraction):
+    """
+    Return the nearest-rank percentile of already sorted values, or None if there are none.
+    """
+    if not sorted_values:
+        return None
+    rank = max(int(fraction * len(sorted_values) + 0.5), 1)
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+class RunMetrics:
+    """
+    Thread-safe collector of the metrics of one processing run.
+
+    Stages report their wall and CPU time through `stage`, counters through `count`, failures
+    through `count_failure` and per-item latencies through `observe`. `report` turns everything
+    into a JSON-serializable dict.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._started_at = time.time()
+        self._started = time.perf_counter()
+        self._cpu_started = time.process_time()
+        self.stages = {}
+        self.counters = Counter()
+        self.failures = Counter()
+        self._latencies = {}
+        self.status = 'running'
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """
+        Measure the wall time and the CPU time of the current thread for the enclosed code.
+
+        The CPU time covers only the calling thread; time spent in worker processes is not included.
+        """
+        started = time.perf_counter()
+        cpu_started = time.thread_time()
+        status = 'failed'
+        try:
+            yield
+            status = 'done'
+        finally:
+            with self._lock:
+                self.stages[name] = {
+                    'wall_s': round(time.perf_counter() - started, 3),
+                    'cpu_s': round(time.thread_time() - cpu_started, 3),
+                    'status': status,
+                }
+
+    def count(self, name, value=1):
+        with self._lock:
+            self.counters[name] += value
+
+    def count_failure(self, reason):
+        with self._lock:
+            self.failures[reason] += 1
+
+    def observe(self, name, seconds):
+        with self._lock:
+            self._latencies.setdefault(name, array('d')).append(seconds)
+
+    def report(self):
+        with self._lock:
+            latencies = {}
+            for name, values in self._latencies.items():
+                ordered = sorted(values)
+                latencies[name] = {
+                    'count': len(ordered),
+                    'mean_ms': round(1000 * sum(ordered) / len(ordered), 3),
+                    'p50_ms': round(1000 * percentile(ordered, 0.5), 3),
+                    'p95_ms': round(1000 * percentile(ordered, 0.95), 3),
+                    'max_ms': round(1000 * ordered[-1], 3),
+                }
+            return {
+                'status': self.status,
+                'started_at': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self._started_at)),
+                'wall_s': round(time.perf_counter() - self._started, 3),
+                'cpu_s': round(time.process_time() - self._cpu_started, 3),
+                'host': {
+                    'platform': platform.platform(),
+                    'python': platform.python_version(),
+                    'cpu_count': os.cpu_count(),
+                },
+                'stages': dict(self.stages),
+                'counters': dict(self.counters),
+                'failures': dict(self.failures),
+                'latencies': latencies,
+            }
+
+    def write_report(self, path, **extra):
+        """
+        Write the report (with the `extra` fields added) to a JSON file and return its path.
+        """
+        report = self.report()
+        report.update(extra)
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        return path
+
+
+@contextlib.contextmanager
+def profiled(output_path):
+    """
+    Profile the enclosed code of the current thread with cProfile.
+
+    The raw statistics are written to `output_path` (open with `pstats` or snakeviz) and a summary
+    of the most expensive functions by cumulative time next to it, with the `.txt` suffix.
+    """
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield profiler
+    finally:
+        profiler.disable()
+        profiler.dump_stats(output_path)
+        summary = io.StringIO()
+        pstats.Stats(profiler, stream=summary).sort_stats('cumulative').print_stats(PROFILE_SUMMARY_LINES)
+        with open(f'{output_path}.txt', 'w', encoding='utf-8') as f:
+            f.write(summary.getvalue())
@@ -0,0 +1,110 @@
+import os
+import re
+import sqlite3
+
+# Firebird system tables used by the processing code, emulated with temporary views over the SQLite catalog
+_CATALOG_VIEWS = (
+    """
+    CREATE TEMP VIEW IF NOT EXISTS rdb$relation_fields AS
+    SELECT m.name AS rdb$relation_name, p.name AS rdb$field_name, p.cid AS rdb$field_position,
+           0 AS rdb$system_flag
+    FROM main.sqlite_master m JOIN pragma_table_info(m.name) p
+    WHERE m.type = 'table' AND m.name NOT LIKE 'sqlite_%'
+    """,
+    """
+    CREATE TEMP VIEW IF NOT EXISTS rdb$indices AS
+    SELECT name AS rdb$index_name, tbl_name AS rdb$relation_name
+    FROM main.sqlite_master
+    WHERE type = 'index' AND sql IS NOT NULL
+    """,
+)
+
+_DB_KEY = re.compile(r'\bRDB\$DB_KEY\b', re.IGNORECASE)
+_ALTER_TABLE_DROP = re.compile(r'^\s*ALTER\s+TABLE\s+(\S+)\s+(DROP\s+.+)$', re.IGNORECASE | re.DOTALL)
+
+
+def _translate(statement):
+    """
+    Rewrite the Firebird specific parts of a statement for SQLite.
+
+    Returns a list of statements: SQLite drops only one column per ALTER TABLE.
+    """
+    statement = _DB_KEY.sub('rowid', statement)
+    match = _ALTER_TABLE_DROP.match(statement)
+    if match is None:
+        return [statement]
+    table, drops = match.groups()
+    return [f'ALTER TABLE {table} {drop.strip()}' for drop in drops.split(',')]
+
+
+class Cursor:
+    """The subset of the fdb cursor API used by the processing code."""
+
+    def __init__(self, cursor):
+        self._cursor = cursor
+
+    def execute(self, statement, parameters=()):
+        for translated in _translate(statement):
+            self._cursor.execute(translated, parameters)
+        return self
+
+    def executemany(self, statement, seq_of_parameters):
+        self._cursor.executemany(_DB_KEY.sub('rowid', statement), seq_of_parameters)
+        return self
+
+    def fetchone(self):
+        return self._cursor.fetchone()
+
+    def fetchmany(self, size=None):
+        return self._cursor.fetchmany(size or self._cursor.arraysize)
+
+    def fetchall(self):
+        return self._cursor.fetchall()
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def close(self):
+        self._cursor.close()
+
+
+class Connection:
+    """
+    SQLite connection with the subset of the fdb connection API used by the processing code.
+
+    Transaction parameter blocks are ignored: every transaction is a SQLite deferred transaction,
+    which already reads from a consistent snapshot.
+    """
+
+    def __init__(self, path):
+        # Pooled connections are handed between pipeline threads, but only used by one thread at a time
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        for statement in _CATALOG_VIEWS:
+            self._connection.execute(statement)
+        self.closed = False
+
+    def cursor(self):
+        return Cursor(self._connection.cursor())
+
+    def begin(self, tpb=None):
+        if not self._connection.in_transaction:
+            self._connection.execute('BEGIN')
+
+    def commit(self):
+        self._connection.commit()
+
+    def rollback(self):
+        self._connection.rollback()
+
+    def close(self):
+        self._connection.close()
+        self.closed = True
+
+
+def connect(path):
+    """
+    Open a SQLite stand-in database. Like Firebird, a missing database file is an error, not a new database.
+    """
+    if not os.path.isfile(path):
+        raise sqlite3.OperationalError(f'Database file not found: {path}')
+    return Connection(path)
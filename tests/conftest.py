@@ -0,0 +1,81 @@
+import os
+import sys
+
+import pytest
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.uid import ExplicitVRLittleEndian, generate_uid
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# A fixed salt, so that the profile never generates and stores the salt of this installation
+os.environ['SKVRNGN_UID_SALT'] = 'tests'
+
+CT_IMAGE_STORAGE = '1.2.840.10008.5.1.4.1.1.2'
+
+
+def make_dataset(**attributes):
+    """
+    Return a small CT image with patient data, 4x4 pixels of explicit VR little endian and `attributes` set on top.
+    """
+    dataset = Dataset()
+    dataset.file_meta = FileMetaDataset()
+    dataset.file_meta.MediaStorageSOPClassUID = CT_IMAGE_STORAGE
+    dataset.file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    dataset.is_little_endian = True
+    dataset.is_implicit_VR = False
+    dataset.SOPClassUID = CT_IMAGE_STORAGE
+    dataset.SOPInstanceUID = generate_uid()
+    dataset.file_meta.MediaStorageSOPInstanceUID = dataset.SOPInstanceUID
+    dataset.StudyInstanceUID = generate_uid()
+    dataset.SeriesInstanceUID = generate_uid()
+    dataset.PatientName = 'Ivanov^Ivan'
+    dataset.PatientID = '12345'
+    dataset.PatientBirthDate = '19700101'
+    dataset.InstitutionName = 'City Hospital'
+    dataset.Modality = 'CT'
+    dataset.Rows = 4
+    dataset.Columns = 4
+    dataset.SamplesPerPixel = 1
+    dataset.PhotometricInterpretation = 'MONOCHROME2'
+    dataset.BitsAllocated = 16
+    dataset.BitsStored = 12
+    dataset.HighBit = 11
+    dataset.PixelRepresentation = 0
+    dataset.PixelData = bytes(range(32))
+    for name, value in attributes.items():
+        setattr(dataset, name, value)
+    return dataset
+
+
+@pytest.fixture
+def dicom_dataset():
+    """`make_dataset`: a new small CT image with patient data."""
+    return make_dataset
+
+
+@pytest.fixture
+def write_dicom():
+    """Write `make_dataset(**attributes)` to `path` and return the dataset."""
+    def write(path, **attributes):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        dataset = make_dataset(**attributes)
+        dataset.save_as(path, write_like_original=False)
+        return dataset
+    return write
+
+
+@pytest.fixture
+def stand_in(tmp_path):
+    """
+    SQLite stand-ins of the medical and MKB10 databases (see benchmarks/synthetic_data.py) with 40 images
+    in 2 studies, half of the image paths absolute. Returns (medical path, MKB10 path).
+    """
+    from benchmarks.synthetic_data import create_stand_in_databases, generate_dicom_corpus
+
+    database_dir = tmp_path / 'database'
+    database_dir.mkdir()
+    generate_dicom_corpus(str(database_dir), 40, rows=8, columns=8)
+    medical_path = str(database_dir / 'MEDICAL.sqlite')
+    mkb10_path = str(database_dir / 'MKB10.sqlite')
+    create_stand_in_databases(medical_path, mkb10_path, 40)
+    return medical_path, mkb10_path
@@ -1,7 +1,11 @@
-import fdb
 import os
 import shutil
 import random
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import db_connection  # noqa: E402
 
 
 def create_test_database_with_absolute_paths(original_db_path, new_db_path, path_prefix):
@@ -9,26 +13,22 @@ def create_test_database_with_absolute_paths(original_db_path, new_db_path, path
     shutil.copyfile(original_db_path, new_db_path)
 
     # Подключение к новой базе данных
-    con = fdb.connect(
-        dsn=new_db_path,
-        user='sysdba',
-        password='masterkey',
-        charset='UTF8',
-    )
-    cur = con.cursor()
-
-    # Запрос для получения всех путей изображений
-    cur.execute("SELECT IMAGE_PATH FROM IMAGES")
-    image_paths = cur.fetchall()
-
-    # Обновление каждого IMAGE_PATH на абсолютный путь
-    for (image_path,) in image_paths:
-        if not os.path.isabs(image_path):
-            new_image_path = os.path.join(path_prefix, image_path)
-            cur.execute("UPDATE IMAGES SET IMAGE_PATH = ? WHERE IMAGE_PATH = ?", (new_image_path, image_path))
-            con.commit()
+    with db_connection.connection(new_db_path) as con:
+        cur = con.cursor()
 
-    con.close()
+        # Запрос для получения всех путей изображений
+        cur.execute("SELECT IMAGE_PATH FROM IMAGES")
+        image_paths = cur.fetchall()
+
+        # Обновление каждого IMAGE_PATH на абсолютный путь
+        for (image_path,) in image_paths:
+            if not os.path.isabs(image_path):
+                new_image_path = os.path.join(path_prefix, image_path)
+                cur.execute("UPDATE IMAGES SET IMAGE_PATH = ? WHERE IMAGE_PATH = ?", (new_image_path, image_path))
+                con.commit()
+
+    # Освободить файл базы данных
+    db_connection.close_all(new_db_path)
     print(f"База данных '{new_db_path}' успешно создана с абсолютными путями для изображений.")
 
 
@@ -37,27 +37,23 @@ def create_test_database_with_mixed_paths(original_db_path, new_db_path, path_pr
     shutil.copyfile(original_db_path, new_db_path)
 
     # Подключение к новой базе данных
-    con = fdb.connect(
-        dsn=new_db_path,
-        user='sysdba',
-        password='masterkey',
-        charset='UTF8',
-    )
-    cur = con.cursor()
-
-    # Запрос для получения всех путей изображений
-    cur.execute("SELECT IMAGE_PATH FROM IMAGES")
-    image_paths = cur.fetchall()
-
-    # Случайное обновление 50% путей на абсолютные
-    for (image_path,) in image_paths:
-        if not os.path.isabs(image_path):
-            if random.choice([True, False]):  # Случайный выбор, чтобы сделать 50% путей абсолютными
-                new_image_path = os.path.join(path_prefix, image_path)
-                cur.execute("UPDATE IMAGES SET IMAGE_PATH = ? WHERE IMAGE_PATH = ?", (new_image_path, image_path))
-                con.commit()
-
-    con.close()
+    with db_connection.connection(new_db_path) as con:
+        cur = con.cursor()
+
+        # Запрос для получения всех путей изображений
+        cur.execute("SELECT IMAGE_PATH FROM IMAGES")
+        image_paths = cur.fetchall()
+
+        # Случайное обновление 50% путей на абсолютные
+        for (image_path,) in image_paths:
+            if not os.path.isabs(image_path):
+                if random.choice([True, False]):  # Случайный выбор, чтобы сделать 50% путей абсолютными
+                    new_image_path = os.path.join(path_prefix, image_path)
+                    cur.execute("UPDATE IMAGES SET IMAGE_PATH = ? WHERE IMAGE_PATH = ?", (new_image_path, image_path))
+                    con.commit()
+
+    # Освободить файл базы данных
+    db_connection.close_all(new_db_path)
     print(f"База данных '{new_db_path}' успешно создана с 50% абсолютных и 50% относительных путей для изображений.")
 
 
@@ -66,32 +62,28 @@ def create_medical_test_db(original_db_path, test_db_path, path_prefix):
     shutil.copyfile(original_db_path, test_db_path)
 
     # Подключение к тестовой базе данных
-    con = fdb.connect(
-        dsn=test_db_path,
-        user='sysdba',
-        password='masterkey',
-        charset='UTF8',
-    )
-    cur = con.cursor()
-
-    # Запрос для получения всех путей изображений
-    cur.execute("SELECT IMAGE_PATH FROM IMAGES")
-    image_paths = cur.fetchall()
-
-    # Оставить только 2 относительных и 2 абсолютных пути
-    relative_paths = [ip[0] for ip in image_paths if not os.path.isabs(ip[0])]
-    absolute_paths = [os.path.join(path_prefix, ip[0]) for ip in image_paths if not os.path.isabs(ip[0])]
-
-    # Выборка 2 относительных и 2 абсолютных путей
-    selected_relative_paths = random.sample(relative_paths, min(2, len(relative_paths)))
-    selected_absolute_paths = random.sample(absolute_paths, min(2, len(absolute_paths)))
-
-    # Обновление базы данных с выбранными путями
-    for path in selected_relative_paths + selected_absolute_paths:
-        cur.execute("DELETE FROM IMAGES WHERE IMAGE_PATH != ?", (path,))
-        con.commit()
-
-    con.close()
+    with db_connection.connection(test_db_path) as con:
+        cur = con.cursor()
+
+        # Запрос для получения всех путей изображений
+        cur.execute("SELECT IMAGE_PATH FROM IMAGES")
+        image_paths = cur.fetchall()
+
+        # Оставить только 2 относительных и 2 абсолютных пути
+        relative_paths = [ip[0] for ip in image_paths if not os.path.isabs(ip[0])]
+        absolute_paths = [os.path.join(path_prefix, ip[0]) for ip in image_paths if not os.path.isabs(ip[0])]
+
+        # Выборка 2 относительных и 2 абсолютных путей
+        selected_relative_paths = random.sample(relative_paths, min(2, len(relative_paths)))
+        selected_absolute_paths = random.sample(absolute_paths, min(2, len(absolute_paths)))
+
+        # Обновление базы данных с выбранными путями
+        for path in selected_relative_paths + selected_absolute_paths:
+            cur.execute("DELETE FROM IMAGES WHERE IMAGE_PATH != ?", (path,))
+            con.commit()
+
+    # Освободить файл базы данных
+    db_connection.close_all(test_db_path)
     print(f"Тестовая база данных '{test_db_path}' успешно создана с 2 относительными и 2 абсолютными путями.")
 
 
@@ -0,0 +1,121 @@
+import io
+import struct
+
+from pydicom import dcmread
+from pydicom.encaps import encapsulate
+from pydicom.uid import JPEGBaseline8Bit
+
+from anonymization_utils import _element_end, _read_header_for_rewrite, anonymize_dicom_file
+
+
+def explicit_element(group, element, vr, value):
+    if vr in (b'OB', b'OW', b'SQ', b'UN', b'UT'):
+        return struct.pack('<HH2s2xL', group, element, vr, len(value)) + value
+    return struct.pack('<HH2sH', group, element, vr, len(value)) + value
+
+
+def item(group, element, value=b'', length=None):
+    return struct.pack('<HHL', group, element, len(value) if length is None else length) + value
+
+
+def element_end(data, offset=0, is_implicit_vr=False):
+    return _element_end(io.BytesIO(data), offset, is_implicit_vr)
+
+
+def test_explicit_vr_short_length():
+    data = explicit_element(0x0010, 0x0010, b'PN', b'Doe^John') + b'rest'
+    assert element_end(data) == len(data) - 4
+
+
+def test_explicit_vr_long_length():
+    data = b'prefix' + explicit_element(0x7FE0, 0x0010, b'OB', bytes(300))
+    assert element_end(data, offset=6) == len(data)
+
+
+def test_implicit_vr():
+    data = struct.pack('<HHL', 0x7FE0, 0x0010, 6) + bytes(6)
+    assert element_end(data, is_implicit_vr=True) == len(data)
+
+
+def test_encapsulated_pixel_data_is_followed_to_the_delimiter():
+    data = (
+        struct.pack('<HH2s2xL', 0x7FE0, 0x0010, b'OB', 0xFFFFFFFF)
+        + item(0xFFFE, 0xE000)
+        + item(0xFFFE, 0xE000, b'frame 1!')
+        + item(0xFFFE, 0xE000, b'frame 2!')
+        + item(0xFFFE, 0xE0DD)
+    )
+    assert element_end(data + b'trailing') == len(data)
+
+
+def test_end_of_file():
+    data = explicit_element(0x0010, 0x0010, b'PN', b'Doe^John')
+    assert element_end(data, offset=len(data)) == len(data)
+
+
+def test_unparsable_elements():
+    # Truncated header
+    assert element_end(b'\xe0\x7f\x10\x00OB') is None
+    # Truncated long length
+    assert element_end(b'\xe0\x7f\x10\x00OB\x00\x00') is None
+    undefined = struct.pack('<HH2s2xL', 0x7FE0, 0x0010, b'OB', 0xFFFFFFFF)
+    # No sequence delimiter
+    assert element_end(undefined + item(0xFFFE, 0xE000, b'frame 1!')) is None
+    # Nested item of undefined length
+    assert element_end(undefined + item(0xFFFE, 0xE000, length=0xFFFFFFFF)) is None
+    # Something else than an item
+    assert element_end(undefined + item(0x0008, 0x0016)) is None
+
+
+def test_header_only_rewrite_keeps_pixel_data_bytes(tmp_path, write_dicom):
+    source = str(tmp_path / 'source.dcm')
+    destination = str(tmp_path / 'out' / 'destination.dcm')
+    write_dicom(source)
+    with open(source, 'rb') as f:
+        assert _read_header_for_rewrite(f) is not None
+
+    anonymize_dicom_file(source, destination)
+
+    with open(source, 'rb') as f:
+        source_bytes = f.read()
+    with open(destination, 'rb') as f:
+        destination_bytes = f.read()
+    pixel_data = source_bytes[source_bytes.rindex(b'\xe0\x7f\x10\x00'):]
+    assert destination_bytes.endswith(pixel_data)
+    dataset = dcmread(destination)
+    assert dataset.PatientName == 'Anonymous'
+    assert 'InstitutionName' not in dataset
+
+
+def test_encapsulated_pixel_data_is_copied(tmp_path, dicom_dataset):
+    source = str(tmp_path / 'source.dcm')
+    destination = str(tmp_path / 'destination.dcm')
+    dataset = dicom_dataset()
+    dataset.file_meta.TransferSyntaxUID = JPEGBaseline8Bit
+    dataset.PixelData = encapsulate([b'\xff\xd8frame 1\xff\xd9', b'\xff\xd8frame 2\xff\xd9'])
+    dataset['PixelData'].is_undefined_length = True
+    dataset.save_as(source, write_like_original=False)
+    with open(source, 'rb') as f:
+        assert _read_header_for_rewrite(f) is not None
+
+    anonymize_dicom_file(source, destination)
+
+    assert dcmread(destination).PixelData == dataset.PixelData
+    assert dcmread(destination).PatientName == 'Anonymous'
+
+
+def test_elements_after_pixel_data_need_a_full_rewrite(tmp_path, dicom_dataset):
+    source = str(tmp_path / 'source.dcm')
+    destination = str(tmp_path / 'destination.dcm')
+    dataset = dicom_dataset()
+    block = dataset.private_block(0x7FE1, 'VENDOR', create=True)
+    block.add_new(0x01, 'LO', 'Ivanov^Ivan')
+    dataset.save_as(source, write_like_original=False)
+    with open(source, 'rb') as f:
+        assert _read_header_for_rewrite(f) is None
+
+    anonymize_dicom_file(source, destination)
+
+    result = dcmread(destination)
+    assert not any(tag.is_private for tag in result.keys())
+    assert result.PixelData == dataset.PixelData
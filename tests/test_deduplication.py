@@ -0,0 +1,140 @@
+import os
+import shutil
+
+import pytest
+
+from deduplication import ContentDeduplicator, iter_unique_tasks
+from parallel_processing import FileResult, file_digest, iter_anonymize_files
+from processing_manifest import STATUS_FAILED, iter_pending_tasks, open_manifest, record_results
+
+
+@pytest.fixture
+def manifest(tmp_path):
+    con = open_manifest(str(tmp_path / 'out' / 'manifest.sqlite'))
+    yield con
+    con.close()
+
+
+@pytest.fixture
+def sources(tmp_path, write_dicom):
+    """Two files with the same content, one of the same size with another content, one of another size."""
+    paths = {name: str(tmp_path / 'source' / f'{name}.dcm') for name in ('a', 'copy_of_a', 'b', 'c')}
+    write_dicom(paths['a'], SOPInstanceUID='1.2.3.1', PatientID='00001')
+    shutil.copyfile(paths['a'], paths['copy_of_a'])
+    write_dicom(paths['b'], SOPInstanceUID='1.2.3.2', PatientID='00002')
+    write_dicom(paths['c'], SOPInstanceUID='1.2.3.3', PatientID='0000000003')
+    assert os.path.getsize(paths['a']) == os.path.getsize(paths['b']) != os.path.getsize(paths['c'])
+    return paths
+
+
+def destination(tmp_path, name):
+    return str(tmp_path / 'out' / 'images' / f'{name}.dcm')
+
+
+def run(con, tasks):
+    deduplicator = ContentDeduplicator(con)
+    results = iter_anonymize_files(deduplicator.iter_tasks(tasks), workers=1)
+    return list(record_results(con, deduplicator.iter_results(results)))
+
+
+def test_iter_pending_tasks_skips_unchanged_outputs(tmp_path, manifest, sources):
+    tasks = [(sources[name], destination(tmp_path, name)) for name in ('a', 'b', 'c')]
+    run(manifest, tasks)
+    skipped = []
+
+    assert list(iter_pending_tasks(manifest, tasks, on_skip=lambda *task: skipped.append(task))) == []
+    assert skipped == tasks
+
+
+def test_iter_pending_tasks_repeats_changed_tasks(tmp_path, manifest, sources):
+    tasks = [(sources[name], destination(tmp_path, name)) for name in ('a', 'b', 'c')]
+    run(manifest, tasks)
+    # Changed source
+    with open(sources['a'], 'ab') as f:
+        f.write(b'\0\0')
+    # Missing output
+    os.remove(destination(tmp_path, 'b'))
+    # Another source for the same output
+    moved = (sources['copy_of_a'], destination(tmp_path, 'c'))
+
+    assert list(iter_pending_tasks(manifest, tasks[:2] + [moved])) == tasks[:2] + [moved]
+
+
+def test_iter_pending_tasks_repeats_failed_tasks(tmp_path, manifest):
+    task = (str(tmp_path / 'missing.dcm'), destination(tmp_path, 'missing'))
+    results = run(manifest, [task])
+
+    assert results[0].error is not None
+    assert manifest.execute('SELECT status FROM processed_files').fetchone() == (STATUS_FAILED,)
+    assert list(iter_pending_tasks(manifest, [task])) == [task]
+
+
+def test_iter_unique_tasks():
+    duplicates = []
+    tasks = [('a', '1'), ('a', '2'), ('a', '1'), ('b', '1')]
+
+    unique = list(iter_unique_tasks(tasks, on_duplicate=lambda *task: duplicates.append(task)))
+
+    assert unique == [('a', '1'), ('a', '2'), ('b', '1')]
+    assert duplicates == [('a', '1')]
+
+
+def test_same_content_is_anonymized_once_and_linked(tmp_path, manifest, sources):
+    tasks = [(sources[name], destination(tmp_path, name)) for name in ('a', 'copy_of_a', 'b', 'c')]
+
+    results = {os.path.basename(result.destination): result for result in run(manifest, tasks)}
+
+    assert all(result.error is None for result in results.values())
+    assert results['copy_of_a.dcm'].linked_to == destination(tmp_path, 'a')
+    assert os.path.samefile(destination(tmp_path, 'copy_of_a'), destination(tmp_path, 'a'))
+    assert results['b.dcm'].linked_to is None
+    assert results['copy_of_a.dcm'].digest == file_digest(sources['a'])
+    # The first file was done before the collision, its digest was added to the manifest afterwards
+    digests = dict(manifest.execute('SELECT output_path, content_digest FROM processed_files'))
+    assert digests[destination(tmp_path, 'a')] == file_digest(sources['a'])
+    # A file of a unique size is never hashed
+    assert digests[destination(tmp_path, 'c')] is None
+
+
+def test_content_of_earlier_runs_is_linked(tmp_path, manifest, sources):
+    run(manifest, [(sources['a'], destination(tmp_path, 'a'))])
+    # The first run had no size collision, so the digest is computed now
+    assert manifest.execute('SELECT content_digest FROM processed_files').fetchone() == (None,)
+
+    results = run(manifest, [(sources['copy_of_a'], destination(tmp_path, 'copy_of_a'))])
+
+    assert results[0].linked_to == destination(tmp_path, 'a')
+    assert os.path.samefile(destination(tmp_path, 'copy_of_a'), destination(tmp_path, 'a'))
+
+
+def test_duplicates_wait_for_the_unfinished_task(tmp_path, manifest, sources):
+    deduplicator = ContentDeduplicator(manifest)
+    first = (sources['a'], destination(tmp_path, 'a'))
+    second = (sources['copy_of_a'], destination(tmp_path, 'copy_of_a'))
+    other = (sources['b'], destination(tmp_path, 'b'))
+
+    # All tasks are submitted before any of them is done
+    assert list(deduplicator.iter_tasks([first, second, other])) == [first, other]
+
+    os.makedirs(os.path.dirname(first[1]))
+    shutil.copyfile(first[0], first[1])
+    shutil.copyfile(other[0], other[1])
+    done = [FileResult(*first, None, 1), FileResult(*other, None, 1)]
+    results = list(deduplicator.iter_results(done))
+
+    assert [result.destination for result in results] == [first[1], second[1], other[1]]
+    assert results[1].linked_to == first[1]
+
+
+def test_duplicates_of_a_failed_task_fail(tmp_path, manifest, sources):
+    deduplicator = ContentDeduplicator(manifest)
+    first = (sources['a'], destination(tmp_path, 'a'))
+    second = (sources['copy_of_a'], destination(tmp_path, 'copy_of_a'))
+
+    assert list(deduplicator.iter_tasks([first, second])) == [first]
+    results = list(deduplicator.iter_results([FileResult(*first, 'InvalidDicomError: broken')]))
+
+    assert [(result.destination, result.error) for result in results] == [
+        (first[1], 'InvalidDicomError: broken'), (second[1], 'InvalidDicomError: broken'),
+    ]
+    assert not os.path.exists(second[1])
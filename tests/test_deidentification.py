@@ -0,0 +1,94 @@
+import pytest
+from pydicom.dataset import Dataset
+from pydicom.sequence import Sequence
+
+from deidentification import UID_SALT_ENV, apply_profile, compile_profile, get_profile, remap_uid
+
+
+def test_remap_uid_is_deterministic_and_salted():
+    uid = '1.2.826.0.1.3680043.10.543.3.1000000000001'
+    assert remap_uid(uid, 'salt') == remap_uid(uid, 'salt')
+    assert remap_uid(uid, 'salt') != remap_uid(uid, 'other salt')
+    assert remap_uid(uid, 'salt') != remap_uid(uid + '1', 'salt')
+    assert remap_uid(uid, 'salt').startswith('2.25.')
+    assert len(remap_uid(uid, 'salt')) <= 64
+
+
+def test_apply_profile(dicom_dataset):
+    profile = get_profile()
+    dataset = dicom_dataset(PatientAge='050Y')
+    study_uid = dataset.StudyInstanceUID
+    dataset.private_block(0x0011, 'VENDOR', create=True).add_new(0x01, 'LO', 'Ivanov^Ivan')
+    dataset.add_new(0x00080000, 'UL', 100)
+
+    apply_profile(dataset, profile)
+
+    assert dataset.PatientName == 'Anonymous'  # D
+    assert dataset.PatientID == '00000000'  # D
+    assert dataset['PatientBirthDate'].is_empty  # Z
+    assert 'PatientAge' not in dataset  # X
+    assert 'InstitutionName' not in dataset  # X
+    assert dataset.StudyInstanceUID == remap_uid(study_uid, profile.uid_salt)  # U
+    assert dataset.Modality == 'CT'  # not in the profile
+    assert not any(tag.is_private for tag in dataset.keys())
+    assert 0x00080000 not in dataset
+
+
+def test_apply_profile_to_sequences(dicom_dataset):
+    profile = get_profile()
+    reference = Dataset()
+    reference.ReferencedSOPInstanceUID = '1.2.3.4'
+    reference.PatientName = 'Ivanov^Ivan'
+    dataset = dicom_dataset(ReferencedImageSequence=Sequence([reference]))
+
+    apply_profile(dataset, profile)
+
+    item = dataset.ReferencedImageSequence[0]
+    assert item.ReferencedSOPInstanceUID == remap_uid('1.2.3.4', profile.uid_salt)
+    assert item.PatientName == 'Anonymous'
+
+
+def test_apply_profile_to_multi_valued_uids(monkeypatch):
+    monkeypatch.delenv(UID_SALT_ENV)
+    profile = compile_profile({'dicom': {'(0008,1150)': 'U'}, 'uid_salt': 'salt'})
+    dataset = Dataset()
+    dataset.ReferencedSOPClassUID = ['1.2.3', '1.2.4']
+
+    apply_profile(dataset, profile)
+
+    assert list(dataset.ReferencedSOPClassUID) == [remap_uid('1.2.3', 'salt'), remap_uid('1.2.4', 'salt')]
+
+
+def test_compile_profile(monkeypatch):
+    monkeypatch.delenv(UID_SALT_ENV)
+    profile = compile_profile({
+        'uid_salt': 'salt',
+        'remove_private_tags': False,
+        'dicom': {'PatientBirthDate': 'd', '(0010,0010)': {'action': 'D', 'value': 'Nobody'}},
+        'database': {'table': 'patients', 'drop_columns': ['name']},
+    })
+    assert profile.actions[0x00100030] == ('D', '19000101')
+    assert profile.actions[0x00100010] == ('D', 'Nobody')
+    assert profile.uid_salt == 'salt'
+    assert not profile.remove_private_tags
+    assert profile.database_table == 'PATIENTS'
+    assert profile.drop_columns == ['NAME']
+
+
+def test_compile_profile_errors():
+    with pytest.raises(ValueError, match='Unknown action'):
+        compile_profile({'dicom': {'PatientName': 'R'}})
+    with pytest.raises(ValueError, match='Unknown DICOM attribute'):
+        compile_profile({'dicom': {'NoSuchKeyword': 'X'}})
+
+
+def test_empty_salt_uses_the_installation_salt(monkeypatch, tmp_path):
+    salt_path = tmp_path / 'uid_salt'
+    monkeypatch.delenv(UID_SALT_ENV)
+    monkeypatch.setenv('SKVRNGN_UID_SALT_FILE', str(salt_path))
+
+    salt = compile_profile({'uid_salt': ''}).uid_salt
+
+    assert salt
+    assert salt_path.read_text(encoding='ascii') == salt
+    assert compile_profile({'uid_salt': ''}).uid_salt == salt
@@ -0,0 +1,81 @@
+import os
+
+import pytest
+
+import path_utils
+from path_table import PathTable
+from path_utils import LOCAL, POSIX, WINDOWS, PathRewriter, path_flavour
+
+
+@pytest.mark.parametrize('path, flavour', [
+    ('C:\\DB\\S1\\1.dcm', WINDOWS),
+    ('c:/DB/S1/1.dcm', WINDOWS),
+    ('\\\\server\\share\\1.dcm', WINDOWS),
+    ('S1\\1.dcm', WINDOWS),
+    ('/data/S1/1.dcm', POSIX),
+    ('S1/1.dcm', POSIX),
+    ('1.dcm', LOCAL),
+])
+def test_path_flavour(path, flavour):
+    assert path_flavour(path) == flavour
+
+
+@pytest.mark.parametrize('path, rewritten', [
+    ('C:\\DB\\S1\\1.dcm', 'images\\DB\\S1\\1.dcm'),
+    ('C:/DB/S1/1.dcm', 'images\\DB\\S1\\1.dcm'),
+    ('\\\\server\\share\\S1\\1.dcm', 'images\\S1\\1.dcm'),
+    ('S1\\1.dcm', 'images\\S1\\1.dcm'),
+    ('/data/S1/1.dcm', 'images/data/S1/1.dcm'),
+    ('S1/1.dcm', 'images/S1/1.dcm'),
+])
+def test_rewrite_keeps_the_style_of_the_database(path, rewritten):
+    assert PathRewriter().rewrite(path) == rewritten
+
+
+def test_rewrite_to_another_flavour():
+    rewriter = PathRewriter()
+    assert rewriter.rewrite('C:\\DB\\S1\\1.dcm', POSIX) == 'images/DB/S1/1.dcm'
+    assert rewriter.rewrite('/data/S1/1.dcm', WINDOWS) == 'images\\data\\S1\\1.dcm'
+    # The memo of the directory holds both output flavours
+    assert rewriter.rewrite('C:\\DB\\S1\\2.dcm') == 'images\\DB\\S1\\2.dcm'
+
+
+def test_fixed_flavour():
+    rewriter = PathRewriter(flavour=WINDOWS)
+    assert rewriter.rewrite('1.dcm') == 'images\\1.dcm'
+    assert PathRewriter(new_folder='out', flavour=POSIX).rewrite('1.dcm') == 'out/1.dcm'
+
+
+def test_rewrite_batch_and_table():
+    paths = ['C:\\DB\\S1\\1.dcm', 'C:\\DB\\S1\\2.dcm', '/data/S2/1.dcm', 'S3/1.dcm']
+    table = PathTable()
+    for path in paths:
+        table.append(path)
+    rewriter = PathRewriter()
+
+    expected = [rewriter.rewrite(path) for path in paths]
+
+    assert PathRewriter().rewrite_batch(paths) == expected
+    assert list(PathRewriter().iter_rewrite_table(table)) == expected
+    assert list(PathRewriter().iter_rewrite_table(table, start=1, stop=3)) == expected[1:3]
+
+
+def test_memo_is_bounded(monkeypatch):
+    monkeypatch.setattr(path_utils, 'MAX_CACHED_DIRECTORIES', 2)
+    rewriter = PathRewriter()
+
+    rewritten = [rewriter.rewrite(f'/data/S{number}/1.dcm') for number in range(5)]
+
+    assert rewritten == [f'images/data/S{number}/1.dcm' for number in range(5)]
+    assert len(rewriter._directories) <= 2
+
+
+def test_source_path():
+    rewriter = PathRewriter()
+    base_dir = os.path.join(os.sep, 'db')
+
+    assert rewriter.source_path('S1/1.dcm', base_dir) == os.path.join(base_dir, 'S1', '1.dcm')
+    assert rewriter.source_path('S1\\1.dcm', base_dir) == os.path.join(base_dir, 'S1', '1.dcm')
+    # Absolute paths are kept, also those written on the other system
+    assert rewriter.source_path('/data/S1/1.dcm', base_dir) == '/data/S1/1.dcm'
+    assert rewriter.source_path('C:\\DB\\1.dcm', base_dir) == 'C:\\DB\\1.dcm'
@@ -0,0 +1,151 @@
+import glob
+import os
+import shutil
+
+import pytest
+from pydicom import dcmread
+
+from anonymization_utils import anonymize_dicom_file
+from deidentification import get_profile, remap_uid
+from processing import run_processing
+from verification import NOT_DICOM_FINDING, STATUS_FAIL, STATUS_PASS, check_dicom_file, verify_database, verify_output
+
+
+@pytest.fixture
+def anonymized(tmp_path, write_dicom):
+    """An anonymized file and its source."""
+    source = str(tmp_path / 'source.dcm')
+    destination = str(tmp_path / 'destination.dcm')
+    write_dicom(source)
+    anonymize_dicom_file(source, destination)
+    return source, destination
+
+
+def first_image(output_dir):
+    return sorted(glob.glob(os.path.join(output_dir, 'images', '**', '*.dcm'), recursive=True))[0]
+
+
+def test_clean_file_has_no_findings(anonymized):
+    source, destination = anonymized
+    assert check_dicom_file(destination) == []
+    assert check_dicom_file(destination, source_path=source) == []
+
+
+def test_findings_of_a_file_that_was_not_anonymized(tmp_path, dicom_dataset):
+    path = str(tmp_path / 'source.dcm')
+    dataset = dicom_dataset(PatientBirthDate='19700101')
+    dataset.private_block(0x0011, 'VENDOR', create=True).add_new(0x01, 'LO', 'Ivanov^Ivan')
+    dataset.save_as(path, write_like_original=False)
+
+    findings = check_dicom_file(path)
+
+    assert 'PatientName: not replaced with the dummy value' in findings
+    assert 'PatientBirthDate: must be empty' in findings
+    assert 'InstitutionName: must be removed' in findings
+    assert 'StudyInstanceUID: UID not replaced' in findings
+    assert '(0011,0010): private tag' in findings
+
+
+def test_remapped_uids_are_compared_with_the_source(anonymized):
+    source, destination = anonymized
+    dataset = dcmread(destination)
+    # UUID derived, but not the remapped source UID
+    dataset.SOPInstanceUID = remap_uid('1.2.3', get_profile().uid_salt)
+    dataset.save_as(destination)
+
+    assert check_dicom_file(destination) == []
+    assert check_dicom_file(destination, source_path=source) == [
+        'SOPInstanceUID: UID does not match the remapped source UID',
+    ]
+
+
+def test_sequences_are_checked(tmp_path, anonymized):
+    _, destination = anonymized
+    dataset = dcmread(destination)
+    reference = dcmread(destination, stop_before_pixels=True)
+    dataset.ReferencedImageSequence = [reference]
+    dataset.ReferencedImageSequence[0].PatientName = 'Ivanov^Ivan'
+    dataset.save_as(destination)
+
+    assert check_dicom_file(destination) == [
+        'ReferencedImageSequence[0].PatientName: not replaced with the dummy value',
+    ]
+
+
+@pytest.fixture
+def output_dir(tmp_path, stand_in):
+    medical_path, mkb10_path = stand_in
+    output_dir = str(tmp_path / 'output')
+    run_processing(medical_path, mkb10_path, output_dir, workers=1)
+    return output_dir
+
+
+def test_verify_output(output_dir):
+    report = verify_output(output_dir, workers=1)
+
+    assert report['status'] == STATUS_PASS
+    assert report['files_checked'] == 40
+    assert report['files_with_source'] == 40
+    assert report['database_findings'] == []
+    assert os.path.exists(report['report_path'])
+
+
+def test_verify_moved_output(tmp_path, output_dir):
+    moved = str(tmp_path / 'moved')
+    shutil.copytree(output_dir, moved)
+    path = first_image(moved)
+    dataset = dcmread(path)
+    dataset.SOPInstanceUID = remap_uid('1.2.3', get_profile().uid_salt)
+    dataset.save_as(path)
+
+    report = verify_output(moved, workers=1)
+
+    assert report['files_with_source'] == 40
+    assert report['status'] == STATUS_FAIL
+    assert report['failed_files'] == [
+        {'path': path, 'findings': ['SOPInstanceUID: UID does not match the remapped source UID']},
+    ]
+
+
+def test_verify_output_problems(tmp_path, output_dir):
+    with open(os.path.join(output_dir, 'images', 'notes.txt'), 'w') as f:
+        f.write('not an image')
+
+    report = verify_output(output_dir, workers=1)
+
+    assert report['status'] == STATUS_FAIL
+    assert report['findings'] == {NOT_DICOM_FINDING: 1}
+
+    assert verify_output(str(tmp_path / 'missing'), workers=1)['problems'] == [
+        f'output directory not found: {tmp_path / "missing"}',
+    ]
+    empty = tmp_path / 'empty'
+    empty.mkdir()
+    assert verify_output(str(empty), workers=1)['status'] == STATUS_FAIL
+
+
+@pytest.mark.parametrize('archive_format', ['tar', 'zip'])
+def test_verify_archive_output(tmp_path, stand_in, archive_format):
+    medical_path, mkb10_path = stand_in
+    output_dir = str(tmp_path / 'output')
+    run_processing(medical_path, mkb10_path, output_dir, workers=1, archive_format=archive_format)
+
+    report = verify_output(output_dir, workers=1)
+
+    assert report['status'] == STATUS_PASS
+    assert report['files_checked'] == 40
+
+    shard = glob.glob(os.path.join(output_dir, 'export_*'))[0]
+    shutil.copyfile(shard, shard.replace('_00001.', '_00002.') + '.partial')
+    report = verify_output(output_dir, workers=1)
+
+    assert report['status'] == STATUS_FAIL
+    assert report['problems'][0].startswith('incomplete archive shard:')
+
+
+def test_verify_database(stand_in, output_dir):
+    medical_path, _ = stand_in
+    profile = get_profile()
+
+    assert verify_database(glob.glob(os.path.join(output_dir, 'Medical_update.*'))[0]) == []
+    assert f'{profile.database_table}.{profile.drop_columns[0]}: column still exists' in verify_database(medical_path)
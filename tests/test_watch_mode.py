@@ -0,0 +1,156 @@
+import os
+import shutil
+import sqlite3
+
+import pytest
+
+from processing import StudyRecord
+from watch_mode import FAILED_MAX_POLLS, StudyWatcher, copy_images_with_retries
+
+KEY = 'RDB$DB_KEY'
+
+
+def execute(database_path, statement, parameters=()):
+    with sqlite3.connect(database_path) as con:
+        con.execute(statement, parameters)
+    con.close()
+
+
+def add_study(database_path, number, image_paths=(), key=None):
+    """Add a study with one series and its images; `key` is the rowid of the first image."""
+    study_uid = f'1.2.3.{number}'
+    execute(database_path, 'INSERT INTO STUDIES VALUES (?, ?, ?)', (study_uid, 'A00.0 result', number))
+    execute(database_path, 'INSERT INTO SERIES VALUES (?, ?)', (f'{study_uid}.1', study_uid))
+    for offset, image_path in enumerate(image_paths):
+        add_image(database_path, f'{study_uid}.1', image_path, None if key is None else key + offset)
+    return study_uid
+
+
+def add_image(database_path, series_uid, image_path, key=None):
+    execute(
+        database_path, 'INSERT INTO IMAGES (rowid, IMAGE_UID, IMAGE_PATH, SERIES_UID) VALUES (?, ?, ?, ?)',
+        (key, f'{series_uid}.{image_path}', image_path, series_uid),
+    )
+
+
+@pytest.fixture
+def watcher(stand_in):
+    medical_path, _ = stand_in
+    watcher = StudyWatcher(medical_path, KEY, KEY, lookback_polls=3)
+    watcher.current_marks()
+    return watcher
+
+
+def test_only_new_rows_are_found(stand_in, watcher):
+    medical_path, _ = stand_in
+    assert watcher.poll({}) == []
+
+    study_uid = add_study(medical_path, 100, ['new/1.dcm', 'new/2.dcm'])
+    records = watcher.poll({'A00.0': 'Diagnosis'})
+
+    assert records == [StudyRecord(study_uid, 'A00.0 result', 'Diagnosis', ['new/1.dcm', 'new/2.dcm'])]
+    assert watcher.poll({}) == []
+
+
+def test_new_images_of_an_exported_study(stand_in, watcher):
+    medical_path, _ = stand_in
+    study_uid = add_study(medical_path, 100, ['new/1.dcm'])
+    watcher.poll({})
+
+    add_image(medical_path, f'{study_uid}.1', 'new/2.dcm')
+
+    assert [record.image_paths for record in watcher.poll({})] == [['new/2.dcm']]
+
+
+def test_late_commits_below_the_mark_are_found_once(stand_in, watcher):
+    medical_path, _ = stand_in
+    study_uid = add_study(medical_path, 100, ['new/1.dcm'], key=1000)
+    watcher.poll({})
+    assert watcher.image_mark == 1000
+
+    # A key taken before 1000 and committed after it
+    add_image(medical_path, f'{study_uid}.1', 'late.dcm', key=990)
+
+    assert [record.image_paths for record in watcher.poll({})] == [['late.dcm']]
+    assert watcher.poll({}) == []
+    assert watcher.image_mark == 1000
+
+
+def test_late_commits_outside_the_window_are_not_found(stand_in, watcher):
+    medical_path, _ = stand_in
+    study_uid = add_study(medical_path, 100, ['new/1.dcm'], key=1000)
+    for _ in range(watcher.lookback_polls + 1):
+        watcher.poll({})
+
+    add_image(medical_path, f'{study_uid}.1', 'late.dcm', key=990)
+
+    assert watcher.poll({}) == []
+    assert len(watcher.image_window) == watcher.lookback_polls
+
+
+def test_orphan_images_wait_for_their_study(stand_in, watcher):
+    medical_path, _ = stand_in
+    add_image(medical_path, '1.2.3.100.1', 'orphan.dcm')
+    assert watcher.poll({}) == []
+
+    study_uid = add_study(medical_path, 100)
+
+    assert watcher.poll({}) == [StudyRecord(study_uid, 'A00.0 result', 'Description not found', ['orphan.dcm'])]
+
+
+def test_orphan_images_are_skipped(stand_in, watcher):
+    medical_path, _ = stand_in
+    add_image(medical_path, '1.2.3.100.1', 'orphan.dcm')
+
+    for _ in range(watcher.lookback_polls):
+        assert watcher.poll({}) == []
+    add_study(medical_path, 100)
+
+    assert [record.image_paths for record in watcher.poll({})] == [[]]
+
+
+def test_state_resumes_the_window(stand_in, watcher):
+    medical_path, _ = stand_in
+    study_uid = add_study(medical_path, 100, ['new/1.dcm'], key=1000)
+    watcher.poll({})
+
+    resumed = StudyWatcher(medical_path, KEY, KEY, lookback_polls=3)
+    state = watcher.state()
+    resumed.study_mark, resumed.image_mark = state['study_mark'], state['image_mark']
+    resumed.study_window, resumed.image_window = state['study_window'], state['image_window']
+    add_image(medical_path, f'{study_uid}.1', 'late.dcm', key=990)
+
+    assert [record.image_paths for record in resumed.poll({})] == [['late.dcm']]
+
+
+def test_failed_images_are_retried(tmp_path, stand_in):
+    medical_path, _ = stand_in
+    output_dir = str(tmp_path / 'output')
+    database_dir = os.path.dirname(medical_path)
+    record = StudyRecord('1.2.3.100', '', '', ['corpus/00000/00000000.dcm', 'later/1.dcm'])
+
+    counters, retry = copy_images_with_retries([record], [], medical_path, output_dir, workers=1)
+
+    assert counters['files_failed'] == 1
+    assert retry == [['1.2.3.100', 'later/1.dcm', 1]]
+
+    os.makedirs(os.path.join(database_dir, 'later'))
+    shutil.copyfile(
+        os.path.join(database_dir, 'corpus', '00000', '00000000.dcm'), os.path.join(database_dir, 'later', '1.dcm'),
+    )
+    counters, retry = copy_images_with_retries([], retry, medical_path, output_dir, workers=1)
+
+    assert counters['files_failed'] == 0
+    assert retry == []
+    assert os.path.exists(os.path.join(output_dir, 'images', 'later', '1.dcm'))
+
+
+def test_failed_images_are_given_up(tmp_path, stand_in):
+    medical_path, _ = stand_in
+    output_dir = str(tmp_path / 'output')
+    retry = [['1.2.3.100', 'missing.dcm', FAILED_MAX_POLLS - 1]]
+
+    counters, retry = copy_images_with_retries([], retry, medical_path, output_dir, workers=1)
+
+    assert counters['files_failed'] == 1
+    assert retry == []
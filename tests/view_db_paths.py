@@ -1,19 +1,17 @@
-import fdb
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import db_connection  # noqa: E402
 
 
 def display_image_paths(database_path_medical):
-    # Подключаемся к базе данных
-    con_medical = fdb.connect(
-        dsn=database_path_medical,
-        user='sysdba',
-        password='masterkey',
-        charset='UTF8',
-    )
-    cur_medical = con_medical.cursor()
-
-    # Запрашиваем несколько значений IMAGE_PATH из таблицы IMAGES
-    cur_medical.execute(f"SELECT IMAGE_PATH FROM IMAGES")
-    image_paths = cur_medical.fetchall()
+    # Подключаемся к базе данных (только чтение)
+    with db_connection.cursor(database_path_medical, read_only=True) as cur_medical:
+        # Запрашиваем несколько значений IMAGE_PATH из таблицы IMAGES
+        cur_medical.execute(f"SELECT IMAGE_PATH FROM IMAGES")
+        image_paths = cur_medical.fetchall()
 
     # Выводим полученные пути на экран
     print("Примеры IMAGE_PATH из базы данных:")
@@ -21,7 +19,7 @@ def display_image_paths(database_path_medical):
         print(f"{idx + 1}. {path[0]}")
 
     # Закрываем подключение к базе данных
-    con_medical.close()
+    db_connection.close_all()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,450 @@
+import argparse
+import contextlib
+import glob
+import json
+import multiprocessing
+import os
+import sqlite3
+import stat
+import sys
+import time
+from collections import Counter
+from concurrent.futures import FIRST_COMPLETED, wait
+from datetime import datetime
+from itertools import islice
+
+from pydicom import dcmread
+from pydicom.datadict import keyword_for_tag
+from pydicom.errors import InvalidDicomError
+from tqdm import tqdm
+
+import db_connection
+from anonymization_utils import UPDATED_DATABASE_FILENAME, existing_patient_objects
+from archive_output import find_shards, iter_archive_members
+from deidentification import apply_profile, get_profile
+from parallel_processing import default_workers, process_pool
+from processing_manifest import MANIFEST_FILENAME, STATUS_DONE
+
+# Files per task sent to a worker process; reading a header is much cheaper than the inter-process round trip
+FILES_PER_TASK = 64
+
+# Failed files listed in the report with their findings
+MAX_REPORTED_FILES = 100
+
+STATUS_PASS = 'pass'
+STATUS_FAIL = 'fail'
+
+NOT_DICOM_FINDING = 'not a DICOM file'
+
+# Folder of the anonymized files in the output directory and in the archive shards
+IMAGES_FOLDER = 'images'
+
+
+def _tag_name(tag):
+    return keyword_for_tag(tag) or f'({tag.group:04X},{tag.element:04X})'
+
+
+def _uid_values(element):
+    if element is None or element.is_empty:
+        return []
+    return [str(uid) for uid in (element.value if element.VM > 1 else [element.value])]
+
+
+def _iter_dataset_findings(dataset, profile, location='', expected=None):
+    # expected - the source dataset at the same location with the profile applied, if the source is known
+    for tag in dataset.keys():
+        name = location + _tag_name(tag)
+        if profile.remove_private_tags and tag.is_private:
+            yield f'{name}: private tag'
+            continue
+
+        rule = profile.actions.get(tag)
+        element = dataset[tag]
+        if rule is None or rule[0] == 'K':
+            if element.VR == 'SQ':
+                expected_items = expected[tag].value if expected is not None and tag in expected else []
+                for number, item in enumerate(element.value):
+                    expected_item = expected_items[number] if number < len(expected_items) else None
+                    yield from _iter_dataset_findings(item, profile, f'{name}[{number}].', expected_item)
+            continue
+
+        action, value = rule
+        if action == 'X':
+            yield f'{name}: must be removed'
+        elif action == 'Z' and not element.is_empty:
+            yield f'{name}: must be empty'
+        elif action == 'D' and element.VR != 'SQ' and not element.is_empty and str(element.value) != str(value):
+            yield f'{name}: not replaced with the dummy value'
+        elif action == 'U' and not element.is_empty:
+            if expected is not None:
+                # Source UIDs are often UUID derived too: only the remapped source UID is right
+                if _uid_values(element) != _uid_values(expected.get(tag)):
+                    yield f'{name}: UID does not match the remapped source UID'
+            # Without the source: remap_uid always produces UUID derived UIDs
+            elif any(not uid.startswith('2.25.') for uid in _uid_values(element)):
+                yield f'{name}: UID not replaced'
+
+
+def _read_expected(source_path, profile):
+    # The source header with the profile applied, or None if the source cannot be read any more
+    try:
+        expected = dcmread(source_path, stop_before_pixels=True)
+    except (OSError, InvalidDicomError):
+        return None
+    apply_profile(expected, profile)
+    if getattr(expected, 'file_meta', None) is not None:
+        apply_profile(expected.file_meta, profile)
+    return expected
+
+
+def check_dicom_file(path, profile=None, source_path=None):
+    """
+    Read the header of an anonymized DICOM file (a path or a seekable binary file object, no pixel data) and
+    return its residual PHI findings.
+
+    Attributes are checked against the de-identification profile: removed ones must be absent, emptied ones
+    empty, dummy ones equal to the dummy value, and private tags must be gone if the profile removes them.
+    Remapped UIDs must equal the remapped UIDs of the source file if it is given and readable (this needs the
+    UID salt of the run), otherwise they must at least be UUID derived. Sequences are checked recursively.
+
+    Returns:
+        List[str]: Findings such as 'PatientBirthDate: must be empty'; an empty list for a clean file.
+    """
+    profile = profile or get_profile()
+    dataset = dcmread(path, stop_before_pixels=True)
+    expected = _read_expected(source_path, profile) if source_path is not None else None
+    findings = list(_iter_dataset_findings(dataset, profile, expected=expected))
+    if getattr(dataset, 'file_meta', None) is not None:
+        expected_meta = getattr(expected, 'file_meta', None)
+        findings.extend(_iter_dataset_findings(dataset.file_meta, profile, expected=expected_meta))
+    return findings
+
+
+def _file_findings(file, source_path=None):
+    try:
+        return check_dicom_file(file, source_path=source_path)
+    except InvalidDicomError:
+        return [NOT_DICOM_FINDING]
+    except Exception as e:
+        return [f'unreadable: {type(e).__name__}: {e}']
+
+
+def _check_files(files):
+    # Runs in a worker process: findings of every file with problems, and the number of checked files
+    results = []
+    for path, source_path in files:
+        findings = _file_findings(path, source_path)
+        if findings:
+            results.append((path, findings))
+    return len(files), results
+
+
+def _check_archive(path):
+    # Runs in a worker process: the same as _check_files for the members of one shard below images/,
+    # reported as <shard>:<member>; the other members (database, results) are not checked
+    checked = 0
+    results = []
+    try:
+        for name, member in iter_archive_members(path):
+            if not name.startswith(IMAGES_FOLDER + '/'):
+                continue
+            checked += 1
+            findings = ['not a regular file'] if member is None else _file_findings(member)
+            if findings:
+                results.append((f'{path}:{name}', findings))
+    except Exception as e:
+        checked += 1
+        results.append((path, [f'unreadable: {type(e).__name__}: {e}']))
+    return checked, results
+
+
+def _iter_batches(items, size):
+    iterator = iter(items)
+    while True:
+        batch = list(islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+def _iter_pool_results(function, items, workers):
+    # function(item) for every item, in a process pool with a bounded number of submitted items
+    if workers == 1:
+        for item in items:
+            yield function(item)
+        return
+
+    with process_pool(workers) as executor:
+        pending = set()
+        for item in items:
+            if len(pending) >= workers * 4:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+            pending.add(executor.submit(function, item))
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+
+
+def iter_verify_files(files, workers=None, files_per_task=FILES_PER_TASK):
+    """
+    Check DICOM files in a process pool and yield (number of checked files, [(path, findings), ...]) per batch.
+
+    `files` are pairs of (path, source path or None), see `check_dicom_file`.
+    """
+    workers = workers or default_workers()
+    yield from _iter_pool_results(_check_files, _iter_batches(files, files_per_task), workers)
+
+
+def iter_verify_archives(shards, workers=None):
+    """
+    Check the files below images/ in archive shards (see archive_output) in a process pool, one shard per task,
+    and yield (number of checked files, [(path, findings), ...]) per shard.
+
+    The members are read without extracting the shards; their paths in the findings are <shard>:<member>.
+    There is no manifest for archive output, so remapped UIDs are only checked to be UUID derived.
+    """
+    workers = workers or default_workers()
+    yield from _iter_pool_results(_check_archive, shards, workers)
+
+
+def _iter_image_files(images_dir, problems):
+    # Every file below images/ is checked, not only those with a DICOM preamble: anything else found there
+    # (temporary files, copies of other formats) is reported. Unreadable directories and entries that are not
+    # regular files are added to `problems`.
+    def on_error(error):
+        problems.append(f'unreadable directory: {error}')
+
+    for root, _, names in os.walk(images_dir, onerror=on_error):
+        for name in names:
+            path = os.path.join(root, name)
+            try:
+                mode = os.lstat(path).st_mode
+            except OSError as e:
+                problems.append(f'unreadable: {e}')
+                continue
+            if stat.S_ISREG(mode):
+                yield path
+            else:
+                problems.append(f'not a regular file: {path}')
+
+
+class _SourceLookup:
+    """
+    Finds the source of an output file in the manifest of the run.
+
+    The manifest paths start with the output directory as it was given to the run, which may be spelled
+    differently (relative, through a link) from the directory being verified, or be moved since; the prefix
+    is found once from the first manifest row. Sources anonymized in place are not returned, they no longer hold the
+    original UIDs.
+    """
+
+    def __init__(self, output_dir):
+        self.output_dir = output_dir
+        self.con = None
+        self.prefix = None
+        manifest_path = os.path.join(output_dir, MANIFEST_FILENAME)
+        if not os.path.isfile(manifest_path):
+            return
+        self.con = sqlite3.connect(manifest_path)
+        row = self.con.execute('SELECT output_path FROM processed_files LIMIT 1').fetchone()
+        if row is None:
+            return
+        candidates = []
+        directory = os.path.dirname(row[0])
+        while directory and directory not in candidates:
+            candidates.append(directory)
+            directory = os.path.dirname(directory)
+        for directory in candidates:
+            with contextlib.suppress(OSError):
+                if os.path.samefile(directory, output_dir):
+                    self.prefix = directory
+                    return
+        # A moved or copied output directory: the prefix under which the file is found in `output_dir`
+        for directory in reversed(candidates):
+            if os.path.isfile(os.path.join(output_dir, os.path.relpath(row[0], directory))):
+                self.prefix = directory
+                return
+
+    def source(self, path):
+        if self.prefix is None:
+            return None
+        output_path = os.path.join(self.prefix, os.path.relpath(path, self.output_dir))
+        row = self.con.execute(
+            'SELECT source_path FROM processed_files WHERE output_path = ? AND status = ?',
+            (output_path, STATUS_DONE),
+        ).fetchone()
+        if row is None or not os.path.isfile(row[0]):
+            return None
+        try:
+            if os.path.samefile(row[0], path):
+                return None
+        except OSError:
+            return None
+        return row[0]
+
+    def close(self):
+        if self.con is not None:
+            self.con.close()
+
+
+def verify_database(database_path, profile=None):
+    """
+    Check that the patient columns and indices of the profile are gone from the updated database.
+
+    Returns:
+        List[str]: Findings; an empty list if the database is clean.
+    """
+    profile = profile or get_profile()
+    with db_connection.cursor(database_path, read_only=True) as cur:
+        indices, columns = existing_patient_objects(cur, profile)
+    db_connection.close_all(database_path)
+
+    findings = [f'{profile.database_table}.{column}: column still exists' for column in columns]
+    findings.extend(f'{index}: index still exists' for index in indices)
+    return findings
+
+
+def find_updated_database(output_dir):
+    """
+    Return the path of the anonymized database copy in `output_dir`, or None.
+    """
+    stem = os.path.splitext(UPDATED_DATABASE_FILENAME)[0]
+    candidates = sorted(
+        path for path in glob.glob(os.path.join(output_dir, f'{stem}.*')) if not path.endswith(('.tmp', '.json'))
+    )
+    return candidates[0] if candidates else None
+
+
+def verify_output(output_dir, database_path=None, workers=None, report_path=None):
+    """
+    Verify the results of a run: all files below `output_dir`/images, or below images/ in the archive shards
+    of a run with --archive, and the updated database.
+
+    The verdict is 'pass' only if at least one file was checked, every file is a readable DICOM file without
+    findings and the database check found nothing (or there is no database). A missing `output_dir`, an output
+    directory with neither the images folder nor archive shards, and shards left incomplete (.partial) fail
+    the check. The report is written as JSON to `report_path`, by default
+    `output_dir`/logs/verification_report_<time>.json; without `report_path` nothing is written if `output_dir`
+    does not exist. The sources of the files are taken from the manifest of the run, where available, to check
+    the remapped UIDs exactly ('files_with_source' in the report).
+
+    Returns:
+        dict: The report, with its path in 'report_path' (None if it was not written).
+    """
+    started_at = datetime.now()
+    started = time.perf_counter()
+    images_dir = os.path.join(output_dir, IMAGES_FOLDER)
+    database_path = database_path or find_updated_database(output_dir)
+
+    files_checked = 0
+    files_failed = 0
+    findings_by_kind = Counter()
+    failed_files = []
+    problems = []
+    shards = []
+    if not os.path.isdir(output_dir):
+        problems.append(f'output directory not found: {output_dir}')
+    else:
+        shards, partial_shards = find_shards(output_dir)
+        problems.extend(f'incomplete archive shard: {path}' for path in partial_shards)
+        if not os.path.isdir(images_dir) and not shards and not partial_shards:
+            problems.append(f'images directory or archive shards not found in {output_dir}')
+    files_with_source = 0
+    source_lookup = _SourceLookup(output_dir) if os.path.isdir(output_dir) else None
+
+    def iter_files(paths):
+        nonlocal files_with_source
+        for path in paths:
+            source_path = source_lookup.source(path)
+            files_with_source += source_path is not None
+            yield path, source_path
+
+    def iter_results():
+        if os.path.isdir(images_dir):
+            yield from iter_verify_files(iter_files(_iter_image_files(images_dir, problems)), workers)
+        yield from iter_verify_archives(shards, workers)
+
+    with tqdm(desc='Verifying DICOM files', unit='file') as progress:
+        for checked, results in iter_results():
+            files_checked += checked
+            progress.update(checked)
+            for path, findings in results:
+                files_failed += 1
+                findings_by_kind.update(
+                    'unreadable' if finding.startswith('unreadable') else finding for finding in findings
+                )
+                if len(failed_files) < MAX_REPORTED_FILES:
+                    failed_files.append({'path': path, 'findings': findings})
+
+    if source_lookup is not None:
+        source_lookup.close()
+    if files_checked == 0 and not problems:
+        problems.append(f'no files to check in {output_dir}')
+
+    database_findings = []
+    if database_path is not None:
+        try:
+            database_findings = verify_database(database_path)
+        except db_connection.DatabaseError as e:
+            database_findings = [f'database check failed: {e}']
+
+    report = {
+        'status': STATUS_PASS if files_failed == 0 and not problems and not database_findings else STATUS_FAIL,
+        'started_at': started_at.strftime('%Y-%m-%dT%H:%M:%S'),
+        'wall_s': round(time.perf_counter() - started, 3),
+        'output_dir': output_dir,
+        'files_checked': files_checked,
+        'files_failed': files_failed,
+        'files_with_source': files_with_source,
+        'findings': dict(findings_by_kind.most_common()),
+        'failed_files': failed_files,
+        'problems': problems,
+        'database': database_path,
+        'database_findings': database_findings,
+    }
+    if report_path is None and os.path.isdir(output_dir):
+        os.makedirs(os.path.join(output_dir, 'logs'), exist_ok=True)
+        report_path = os.path.join(
+            output_dir, 'logs', f'verification_report_{started_at.strftime("%d_%m_%Y_%H_%M_%S")}.json',
+        )
+    if report_path is not None:
+        with open(report_path, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    report['report_path'] = report_path
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Check anonymized results for residual PHI: DICOM headers in the images folder or the archive '
+                    'shards and the patient columns and indices of the updated database. Exit code 0 means pass, '
+                    '1 means fail.',
+    )
+    parser.add_argument(
+        'output_dir', help='Results directory of main.py (with the images folder or the archive shards).',
+    )
+    parser.add_argument(
+        '--database', help='Updated database to check (default: Medical_update.* in the results directory).',
+    )
+    parser.add_argument(
+        '--workers', type=int, default=default_workers(),
+        help='Number of worker processes (default: number of CPUs).',
+    )
+    parser.add_argument('--report', help='Path of the JSON report (default: logs/verification_report_<time>.json).')
+    args = parser.parse_args(argv)
+
+    report = verify_output(args.output_dir, args.database, args.workers, args.report)
+    print(f"Verification {report['status'].upper()}: {report['files_checked']} files checked, "
+          f"{report['files_failed']} with findings, {len(report['database_findings'])} database findings.")
+    for problem in report['problems'][:MAX_REPORTED_FILES]:
+        print(f'  {problem}')
+    print(f"Report: {report['report_path'] or 'not written'}")
+    return 0 if report['status'] == STATUS_PASS else 1
+
+
+if __name__ == '__main__':
+    multiprocessing.freeze_support()
+    sys.exit(main())
@@ -0,0 +1,422 @@
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import sys
+import threading
+import time
+from datetime import datetime
+
+import db_connection
+from mkb10_cache import load_mkb10_values
+from parallel_processing import default_workers
+from processing import (
+    StudyRecord,
+    copy_images_and_process_dicom,
+    fetch_mkb10_values,
+    iter_image_copy_tasks,
+    logging_setup,
+)
+from results_writers import RESULT_FILENAMES, RESULT_WRITERS, check_output_format, stream_study_records_to_csv
+
+WATCH_STATE_FILENAME = 'watch_state.json'
+# Folder of the result parts written by every poll in Parquet and Arrow format (they cannot be appended to)
+WATCH_PARTS_FOLDER = 'watch_results'
+
+DEFAULT_POLL_INTERVAL = 60
+# Upper limit of new IMAGES rows taken by one poll, the rest is taken by the next ones
+DEFAULT_MAX_ROWS = 100000
+# Polls whose rows are read again, to find rows committed after rows with higher keys
+DEFAULT_LOOKBACK_POLLS = 20
+# Polls an image row may wait for its series or study to appear before it is skipped
+ORPHAN_MAX_POLLS = 10
+# Rows fetched from the cursor at once
+WATCH_FETCH_SIZE = 10000
+# Polls an image that failed to anonymize (e.g. not copied to the archive yet) is retried before it is given up
+FAILED_MAX_POLLS = 60
+
+
+def load_watch_state(path):
+    """
+    Return the saved state (high-water marks, key columns and images to retry) or None if there is none.
+    """
+    try:
+        with open(path, encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def save_watch_state(path, state):
+    # Written to a temporary file and renamed, so a crash never leaves a broken state
+    temp_path = path + '.tmp'
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        json.dump(state, f, ensure_ascii=False, indent=2)
+    os.replace(temp_path, path)
+
+
+class StudyWatcher:
+    """
+    Finds rows added to STUDIES and IMAGES since the last poll by a high-water mark per table.
+
+    The mark is the largest value of a key column that only grows for new rows, such as an ID filled
+    from a generator. Every poll reads the new rows in one read-only snapshot and groups them into study
+    records: a new study with its images, and for an already exported study a record with only its new images.
+
+    Generator values are taken outside transactions, so a row may commit after a row with a higher key and
+    show up below the mark. Every poll therefore re-reads the rows above the mark as it was `lookback_polls`
+    polls ago and skips the keys taken by those polls (the window of taken keys is part of the state).
+    A row that commits more than `lookback_polls` polls after a higher key is not found.
+
+    An image row whose series or study is not visible yet is left for a later poll; after ORPHAN_MAX_POLLS
+    polls (or `lookback_polls`, if smaller) it is skipped with a warning.
+    """
+
+    def __init__(self, database_path, study_key, image_key, study_mark=None, image_mark=None,
+                 max_rows=DEFAULT_MAX_ROWS, lookback_polls=DEFAULT_LOOKBACK_POLLS, study_window=None,
+                 image_window=None):
+        if lookback_polls < 1:
+            raise ValueError('lookback_polls must be at least 1')
+        self.database_path = database_path
+        self.study_key = study_key
+        self.image_key = image_key
+        self.study_mark = study_mark
+        self.image_mark = image_mark
+        self.max_rows = max_rows
+        self.lookback_polls = lookback_polls
+        # Per poll of the window: [the mark before the poll, keys taken by the poll]
+        self.study_window = study_window or []
+        self.image_window = image_window or []
+        self._orphan_polls = {}
+
+    def current_marks(self):
+        """
+        Set the marks to the current maximum keys, so that only rows added from now on are found.
+        """
+        with db_connection.cursor(self.database_path, read_only=True) as cur:
+            cur.execute(f'SELECT MAX({self.study_key}) FROM STUDIES')
+            self.study_mark = cur.fetchone()[0]
+            cur.execute(f'SELECT MAX({self.image_key}) FROM IMAGES')
+            self.image_mark = cur.fetchone()[0]
+        self.study_window = []
+        self.image_window = []
+
+    @staticmethod
+    def _above(column, mark, window):
+        # Rows above the oldest mark of the window, to find late commits below the current mark
+        lower_mark = window[0][0] if window else mark
+        return ('', ()) if lower_mark is None else (f'WHERE {column} > ?', (lower_mark,))
+
+    @staticmethod
+    def _iter_unseen_rows(cur, window):
+        seen = {key for _, keys in window for key in keys}
+        while True:
+            rows = cur.fetchmany(WATCH_FETCH_SIZE)
+            if not rows:
+                return
+            for row in rows:
+                if row[0] not in seen:
+                    yield row
+
+    def _advance(self, mark, window, taken):
+        # Returns the new mark and window after a poll that took the keys `taken`
+        window = (window + [[mark, taken]])[-self.lookback_polls:]
+        if taken:
+            mark = max(taken) if mark is None else max(mark, max(taken))
+        return mark, window
+
+    def _take_images(self, cur, records, mkb10_values):
+        where, parameters = self._above(f'I.{self.image_key}', self.image_mark, self.image_window)
+        cur.execute(
+            f"""
+            SELECT I.{self.image_key}, S.STUDY_UID, S.STUDY_RESULT, I.IMAGE_PATH
+            FROM IMAGES I
+            LEFT JOIN SERIES SE ON SE.SERIES_UID = I.SERIES_UID
+            LEFT JOIN STUDIES S ON S.STUDY_UID = SE.STUDY_UID
+            {where}
+            ORDER BY I.{self.image_key}
+            """,
+            parameters,
+        )
+        taken = []
+        orphan_max_polls = min(ORPHAN_MAX_POLLS, self.lookback_polls)
+        for key, study_uid, study_result, image_path in self._iter_unseen_rows(cur, self.image_window):
+            if len(taken) >= self.max_rows:
+                break
+            if study_uid is None:
+                polls = self._orphan_polls.get(key, 0) + 1
+                if polls < orphan_max_polls:
+                    self._orphan_polls[key] = polls
+                    continue
+                self._orphan_polls.pop(key, None)
+                logging.warning(f'Image {image_path} ({self.image_key} {key}) has no series or study, skipped')
+            else:
+                self._orphan_polls.pop(key, None)
+                record = self._record(records, study_uid, study_result, mkb10_values)
+                if image_path is not None:
+                    record.image_paths.append(str(image_path))
+            taken.append(key)
+        self.image_mark, self.image_window = self._advance(self.image_mark, self.image_window, taken)
+
+    def _take_studies(self, cur, records, mkb10_values):
+        where, parameters = self._above(f'S.{self.study_key}', self.study_mark, self.study_window)
+        cur.execute(
+            f'SELECT S.{self.study_key}, S.STUDY_UID, S.STUDY_RESULT FROM STUDIES S {where} '
+            f'ORDER BY S.{self.study_key}',
+            parameters,
+        )
+        taken = []
+        for key, study_uid, study_result in self._iter_unseen_rows(cur, self.study_window):
+            self._record(records, study_uid, study_result, mkb10_values)
+            taken.append(key)
+        self.study_mark, self.study_window = self._advance(self.study_mark, self.study_window, taken)
+
+    @staticmethod
+    def _record(records, study_uid, study_result, mkb10_values):
+        study_uid = str(study_uid).strip()
+        record = records.get(study_uid)
+        if record is None:
+            study_result = str(study_result).strip()
+            mkb_description = mkb10_values.get(study_result.split(' ')[0], 'Description not found')
+            record = records[study_uid] = StudyRecord(study_uid, study_result, mkb_description, [])
+        return record
+
+    def poll(self, mkb10_values):
+        """
+        Return the study records of the rows added since the previous poll and move the marks past them.
+
+        Returns:
+            List[StudyRecord]: New studies and new images of known studies, in the order of their keys.
+        """
+        records = {}
+        with db_connection.cursor(self.database_path, read_only=True) as cur:
+            self._take_studies(cur, records, mkb10_values)
+            self._take_images(cur, records, mkb10_values)
+        return list(records.values())
+
+    def state(self):
+        return {
+            'study_key': self.study_key,
+            'image_key': self.image_key,
+            'study_mark': self.study_mark,
+            'image_mark': self.image_mark,
+            'study_window': self.study_window,
+            'image_window': self.image_window,
+        }
+
+
+def copy_images_with_retries(records, retry, medical_db_path, output_dir, workers=None, image_root=None):
+    """
+    Anonymize the images of new study records together with the images that failed on earlier polls.
+
+    Parameters:
+        records (List[StudyRecord]): Records of the current poll.
+        retry (List[list]): Images to try again, as [study UID, image path from the database, failed polls].
+
+    Returns:
+        Tuple[dict, List[list]]: Counters of `copy_images_and_process_dicom` and the images to try again on
+        the next poll, in the format of `retry`. Images that failed FAILED_MAX_POLLS times are dropped.
+    """
+    attempts = {(study_uid, image_path): failed_polls for study_uid, image_path, failed_polls in retry}
+    study_images = [(record.study_uid, record.image_paths) for record in records if record.image_paths]
+    study_images.extend((study_uid, [image_path]) for study_uid, image_path in attempts)
+
+    # Output tasks of every image, to map the failed files back to their rows
+    images_by_task = {}
+    for study_uid, image_paths in study_images:
+        tasks = iter_image_copy_tasks([(study_uid, image_paths)], medical_db_path, output_dir, image_root)
+        for image_path, task in zip(image_paths, tasks):
+            images_by_task.setdefault(task, (study_uid, image_path))
+
+    failed = set()
+    counters = copy_images_and_process_dicom(
+        study_images, medical_db_path, output_dir, workers=workers, image_root=image_root,
+        on_failure=lambda source, destination: failed.add((source, destination)),
+    )
+
+    next_retry = []
+    for task in failed:
+        study_uid, image_path = images_by_task[task]
+        failed_polls = attempts.get((study_uid, image_path), 0) + 1
+        if failed_polls >= FAILED_MAX_POLLS:
+            logging.warning(f'Image {image_path} of study {study_uid} failed {failed_polls} times, given up')
+        else:
+            next_retry.append([study_uid, image_path, failed_polls])
+    return counters, next_retry
+
+
+def write_new_records(records, output_dir, output_format):
+    """
+    Add study records to the results: appended to results.csv, or written as a new part file to
+    `output_dir`/watch_results for Parquet and Arrow.
+
+    Returns:
+        str: Path of the written file.
+    """
+    if output_format == 'csv':
+        output_path = os.path.join(output_dir, RESULT_FILENAMES['csv'])
+        for _ in stream_study_records_to_csv(records, output_path, append=True):
+            pass
+        return output_path
+
+    parts_dir = os.path.join(output_dir, WATCH_PARTS_FOLDER)
+    os.makedirs(parts_dir, exist_ok=True)
+    stem, extension = os.path.splitext(RESULT_FILENAMES[output_format])
+    output_path = os.path.join(parts_dir, f'{stem}_{datetime.now().strftime("%Y%m%d_%H%M%S_%f")}{extension}')
+    for _ in RESULT_WRITERS[output_format](records, output_path):
+        pass
+    return output_path
+
+
+def run_watch(medical_db_path, mkb10_db_path, output_dir, study_key, image_key, interval=DEFAULT_POLL_INTERVAL,
+              workers=None, output_format='csv', image_root=None, from_beginning=False, max_rows=DEFAULT_MAX_ROWS,
+              max_polls=None, cancel_event=None, lookback_polls=DEFAULT_LOOKBACK_POLLS):
+    """
+    Poll the medical database and export and anonymize new studies and images as they are added.
+
+    The marks are kept in `output_dir`/watch_state.json and saved after the records of a poll are written
+    and their images anonymized, so a restart continues where the previous run stopped; a crash in between
+    can at worst repeat the rows of one poll, the images are then skipped by the manifest. Images that
+    failed are kept in the state too and tried again on the next polls. Without a saved state the watch
+    starts at the current end of the tables (the existing rows are expected to be exported by a full run
+    already), or with `from_beginning` at the first row.
+
+    Parameters:
+        medical_db_path (str): The medical database (the original, not the anonymized copy).
+        mkb10_db_path (str): The MKB10 database.
+        output_dir (str): Results directory of the full run.
+        study_key (str): Growing key column of STUDIES, e.g. an ID filled from a generator.
+        image_key (str): Growing key column of IMAGES.
+        interval (float): Seconds between polls.
+        workers (Optional[int]): Number of worker processes for the image anonymization.
+        output_format (str): Format of the results, a key of RESULT_WRITERS.
+        image_root (Optional[str]): Base of relative image paths. Defaults to the database directory.
+        from_beginning (bool): Without a saved state, start at the first row instead of the end.
+        max_rows (int): Upper limit of IMAGES rows per poll.
+        max_polls (Optional[int]): Stop after this number of polls (None - until cancelled).
+        cancel_event (Optional[threading.Event]): Event to stop the watch from outside.
+        lookback_polls (int): Polls whose rows are read again for late commits, see StudyWatcher.
+
+    Returns:
+        dict: Totals of the watch: polls, studies, images and failed images.
+    """
+    check_output_format(output_format)
+    cancel_event = cancel_event or threading.Event()
+    os.makedirs(output_dir, exist_ok=True)
+    state_path = os.path.join(output_dir, WATCH_STATE_FILENAME)
+    state = load_watch_state(state_path)
+    if state is not None and (state['study_key'], state['image_key']) != (study_key, image_key):
+        raise ValueError(
+            f"{state_path} was written for the key columns {state['study_key']}, {state['image_key']}; "
+            f'delete it to start again with {study_key}, {image_key}',
+        )
+
+    watcher = StudyWatcher(medical_db_path, study_key, image_key, max_rows=max_rows, lookback_polls=lookback_polls)
+    retry = []
+    if state is not None:
+        watcher.study_mark, watcher.image_mark = state['study_mark'], state['image_mark']
+        watcher.study_window, watcher.image_window = state.get('study_window', []), state.get('image_window', [])
+        retry = state.get('retry', [])
+    elif not from_beginning:
+        watcher.current_marks()
+    logging.info(f'Watching {medical_db_path} from {watcher.state()}')
+
+    totals = {'polls': 0, 'studies': 0, 'images': 0, 'images_failed': 0}
+    while not cancel_event.is_set():
+        started = time.perf_counter()
+        mkb10_values = load_mkb10_values(mkb10_db_path, fetch_mkb10_values)
+        records = watcher.poll(mkb10_values)
+        if records:
+            write_new_records(records, output_dir, output_format)
+        if records or retry:
+            retried = len(retry)
+            counters, retry = copy_images_with_retries(
+                records, retry, medical_db_path, output_dir, workers=workers, image_root=image_root,
+            )
+            image_count = sum(len(record.image_paths) for record in records)
+            totals['studies'] += len(records)
+            totals['images'] += image_count
+            totals['images_failed'] += counters['files_failed']
+            logging.info(
+                f'Watch: {len(records)} studies and {image_count} images added in '
+                f'{time.perf_counter() - started:.1f} s; {retried} failed images retried, {len(retry)} left to retry',
+            )
+        save_watch_state(state_path, {**watcher.state(), 'retry': retry})
+        totals['polls'] += 1
+        if max_polls is not None and totals['polls'] >= max_polls:
+            break
+        cancel_event.wait(interval)
+    db_connection.close_all()
+    return totals
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Режим наблюдения: опрашивает базу Medical и дописывает в результаты новые исследования '
+                    'и изображения по мере их появления, анонимизируя только новые файлы.',
+    )
+    parser.add_argument('medical_db', help='Путь к базе данных Medical.')
+    parser.add_argument('mkb10_db', help='Путь к базе данных MKB10.')
+    parser.add_argument('output_dir', help='Директория результатов (как у полного запуска main.py).')
+    parser.add_argument(
+        '--study-key', required=True,
+        help='Возрастающий ключ таблицы STUDIES (например, ID из генератора). Для SQLite-заглушки - RDB$DB_KEY.',
+    )
+    parser.add_argument('--image-key', required=True, help='Возрастающий ключ таблицы IMAGES.')
+    parser.add_argument(
+        '--interval', type=float, default=DEFAULT_POLL_INTERVAL,
+        help=f'Интервал опроса в секундах (по умолчанию {DEFAULT_POLL_INTERVAL}).',
+    )
+    parser.add_argument(
+        '--from-beginning', action='store_true',
+        help='Без сохранённого состояния начать с первых строк, а не с текущего конца таблиц.',
+    )
+    parser.add_argument(
+        '--max-rows', type=int, default=DEFAULT_MAX_ROWS,
+        help=f'Не более строк IMAGES за один опрос (по умолчанию {DEFAULT_MAX_ROWS}).',
+    )
+    parser.add_argument(
+        '--lookback-polls', type=int, default=DEFAULT_LOOKBACK_POLLS,
+        help='Сколько последних опросов перечитывать, чтобы найти строки, закоммиченные позже строк с большим '
+             f'ключом (значения генератора выдаются вне транзакций; по умолчанию {DEFAULT_LOOKBACK_POLLS}).',
+    )
+    parser.add_argument('--image-root', help='Папка, от которой считаются относительные пути изображений.')
+    parser.add_argument(
+        '--workers', type=int, default=default_workers(),
+        help='Количество процессов для анонимизации изображений (по умолчанию - число ядер).',
+    )
+    parser.add_argument('--output-format', choices=tuple(RESULT_WRITERS), default='csv')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    try:
+        check_output_format(args.output_format)
+    except RuntimeError as e:
+        print(f'Ошибка: {e}', file=sys.stderr)
+        return 2
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    logging_setup(args.output_dir)
+    try:
+        totals = run_watch(
+            args.medical_db, args.mkb10_db, args.output_dir, args.study_key, args.image_key,
+            interval=args.interval, workers=args.workers, output_format=args.output_format,
+            image_root=args.image_root, from_beginning=args.from_beginning, max_rows=args.max_rows,
+            lookback_polls=args.lookback_polls,
+        )
+    except ValueError as e:
+        print(f'Ошибка: {e}', file=sys.stderr)
+        return 2
+    except KeyboardInterrupt:
+        print('Наблюдение остановлено.')
+        return 0
+    print(f"Опросов: {totals['polls']}, исследований: {totals['studies']}, изображений: {totals['images']}")
+    return 0
+
+
+if __name__ == '__main__':
+    multiprocessing.freeze_support()
+    sys.exit(main())